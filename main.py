@@ -3,20 +3,114 @@ import logging
 import asyncio
 import time
 import pickle
-from typing import List, Optional, Any, Tuple
+import sqlite3
+import io
+import csv
+import gzip
+import tempfile
+import json
+import cProfile
+import pstats
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+from typing import List, Optional, Any, Tuple, Callable
+from datetime import datetime, timezone
 from dotenv import load_dotenv
 from aiogram import Bot, Dispatcher
 from aiogram.filters import Command
-from aiogram.types import Message, CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup
+from aiogram.types import Message, CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup, BufferedInputFile, FSInputFile
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from cachetools import TTLCache
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from cachetools import TTLCache, LRUCache
 import aiohttp
+from aiohttp import web
 
 # ==================== КОНФИГУРАЦИЯ ====================
 load_dotenv()
 BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN_MAIN")
 DATA_FILE = "user_data.pkl"
+IMPORT_MAX_BYTES = 1024 * 1024
+IMPORT_MAX_LINES = 5000
+TOKEN_CACHE_FILE = "token_cache.pkl"
+TOKEN_CACHE_SIZE = 5000
+HISTORY_FILE = "tx_history.db"
+HISTORY_RETENTION_DAYS = int(os.getenv("HISTORY_RETENTION_DAYS", "30"))
+HISTORY_MAX_PER_WALLET = 1000
+HISTORY_COMPACT_INTERVAL = 3600
+HISTORY_PAGE_SIZE = 10
+HISTORY_EXPORT_BATCH = 1000
+EXPORT_PART_BYTES = 45 * 1024 * 1024  # лимит документа Bot API - 50 МБ
+BALANCE_CHAIN_TIMEOUT = 5
+BALANCE_CACHE_TTL = 30
+RPC_BATCH_SIZE = 50
+# Отклоненные (reverted) транзакции: 'flag' - уведомлять с пометкой, 'suppress' - не уведомлять
+FAILED_TX_MODE = os.getenv("FAILED_TX_MODE", "flag")
+# SLO отставания от head (секунды): если кошелек отстал сильнее, живой скан берет
+# только последние LIVE_WINDOW секунд, а пропущенный диапазон уходит в очередь догона
+HEAD_LAG_SLO = int(os.getenv("HEAD_LAG_SLO", "300"))
+LIVE_WINDOW = 60
+REPAIR_BLOCKS_PER_CYCLE = 100  # блоков догона на цепь за цикл
+# Mempool: цепи через запятую (пусто - выключено) и WebSocket RPC "chain=wss://...,..."
+# для eth_subscribe; цепи без WebSocket опрашивают eth_newPendingTransactionFilter
+MEMPOOL_CHAINS = [c.strip() for c in os.getenv("MEMPOOL_CHAINS", "").split(',') if c.strip()]
+MEMPOOL_WS_URLS = dict(
+    (chain.strip(), url.strip()) for chain, _, url in
+    (item.partition('=') for item in os.getenv("MEMPOOL_WS_URLS", "").split(',')) if url.strip()
+)
+MEMPOOL_MAX_TPS = float(os.getenv("MEMPOOL_MAX_TPS", "200"))  # tx/с на цепь, остальное отбрасывается
+MEMPOOL_POLL_INTERVAL = 2
+MEMPOOL_INDEX_TTL = 10
+MEMPOOL_RECONNECT_DELAY = 5
+MEMPOOL_UNSUPPORTED_RETRY = 600
+PENDING_ALERT_TTL = 3600  # pending-уведомление без включения в блок за это время - "не подтверждена"
+PENDING_ALERTS_MAX = 10000
+PENDING_SWEEP_INTERVAL = 60
+# Блоки, не полученные ни с одного RPC: очередь повторов с задержкой GAP_RETRY_BASE * 2^попытка
+GAP_FILE = "block_gaps.pkl"
+GAP_REPAIR_INTERVAL = 10
+GAP_RETRY_BASE = 5
+GAP_RETRY_MAX = 600
+GAP_MAX_ATTEMPTS = 30
+
+# Лимиты запросов в секунду по хостам RPC (переопределяются через RPC_RATE_LIMITS="host=rps,...")
+RPC_RATE_LIMITS = {
+    'rpc.ankr.com': 5,
+    '1rpc.io': 3,
+    'cloudflare-eth.com': 5,
+    'eth.llamarpc.com': 5,
+    'polygon-rpc.com': 5,
+    'polygon.llamarpc.com': 5,
+    'arbitrum.llamarpc.com': 5,
+    'optimism.llamarpc.com': 5,
+    'base.llamarpc.com': 5,
+    'avalanche.llamarpc.com': 5,
+    'hyperliquid.llamarpc.com': 5,
+}
+RPC_DEFAULT_RATE_LIMIT = float(os.getenv("RPC_DEFAULT_RATE_LIMIT", "10"))
+RATE_LIMIT_MAX_WAIT = 2
+RATE_LIMIT_QUEUE_TIMEOUT = 15
+
+# Профилирование: PROFILING=1 включает таймеры этапов и монитор event loop;
+# /profile доступна пользователям из ADMIN_IDS (id через запятую)
+PROFILING = os.getenv("PROFILING", "0") == "1"
+ADMIN_IDS = {int(uid) for uid in os.getenv("ADMIN_IDS", "").split(',') if uid.strip().isdigit()}
+LOOP_LAG_INTERVAL = 0.5
+LOOP_LAG_WARNING = 0.5
+PROFILE_MAX_SECONDS = 120
+PROFILE_TOP = 25
+
+# Режим получения апдейтов: 'polling' (по умолчанию) или 'webhook' - встроенный aiohttp-сервер.
+# WEBHOOK_BASE_URL - публичный https-адрес, по нему бот сам вызывает setWebhook;
+# WEBHOOK_SECRET обязателен и сверяется с заголовком X-Telegram-Bot-Api-Secret-Token
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "").rstrip('/')
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT_MAIN", "8080"))
+WEBHOOK_PATH = "/webhook/main"
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -150,6 +244,12 @@ RPC_CONFIGS = {
     }
 }
 
+# Ожидаемое время блока (сек): кэш eth_blockNumber обновляется не чаще
+BLOCK_TIMES = {
+    'ethereum': 12, 'bsc': 3, 'polygon': 2, 'arbitrum': 1, 'optimism': 2, 'avalanche': 2,
+    'base': 2, 'fantom': 1, 'gnosis': 5, 'celo': 5, 'moonbeam': 6, 'hyperliquid': 1,
+}
+
 # Добавляем стандартные поля
 for chain, config in RPC_CONFIGS.items():
     config.setdefault('type', 'evm')
@@ -157,6 +257,9 @@ for chain, config in RPC_CONFIGS.items():
     config.setdefault('explorer', f'https://{chain}scan.com/tx/')
     config.setdefault('timeout', 10)
     config.setdefault('retries', 3)
+    config.setdefault('block_time', BLOCK_TIMES.get(chain, 2))
+    config.setdefault('lag_slo_blocks', max(1, HEAD_LAG_SLO // config['block_time']))
+    config.setdefault('live_window_blocks', max(1, LIVE_WINDOW // config['block_time']))
     config['all_rpcs'] = config['primary'] + config.get('fallback', [])
 
 
@@ -166,6 +269,10 @@ class RPCCache:
         self.latency = TTLCache(maxsize=200, ttl=300)
         self.errors = TTLCache(maxsize=200, ttl=600)
         self.blocks = TTLCache(maxsize=500, ttl=30)
+        self.receipts = TTLCache(maxsize=500, ttl=300)  # chain_block -> frozenset отклоненных хешей
+        self.block_receipts = TTLCache(maxsize=50, ttl=3600)  # chain -> поддерживает ли eth_getBlockReceipts
+        self.heads = {}  # chain -> (номер блока, time.monotonic() получения)
+        self.inflight = {}  # (chain, method, params) -> Future выполняющегося запроса
 
     def get_best_rpc(self, chain: str) -> str:
         config = RPC_CONFIGS[chain]
@@ -180,6 +287,648 @@ class RPCCache:
 
 rpc_cache = RPCCache()
 
+# ==================== ПРОФИЛИРОВАНИЕ ====================
+class StageTimers:
+    """
+    Суммарное время этапов цикла (fetch, decode, match, persist, deliver).
+
+    Меряется время по часам, включая ожидание в await; параллельные этапы
+    суммируются. Выключенные таймеры почти ничего не стоят.
+    """
+
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self.totals = {}  # этап -> [секунды, вызовы]
+
+    def add(self, stage: str, seconds: float):
+        if self.enabled:
+            total = self.totals.setdefault(stage, [0.0, 0])
+            total[0] += seconds
+            total[1] += 1
+
+    @contextmanager
+    def stage(self, name: str):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def report(self) -> str:
+        return ", ".join(
+            f"{stage} {seconds:.2f}с/{count}"
+            for stage, (seconds, count) in sorted(self.totals.items(), key=lambda item: -item[1][0])
+        ) or "нет данных"
+
+    def reset(self):
+        self.totals.clear()
+
+
+class LoopLagMonitor:
+    """Задержка event loop: насколько позже срабатывает sleep(interval)"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.max_lag = 0.0
+        self.total_lag = 0.0
+        self.samples = 0
+
+    async def run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = time.perf_counter() - start - self.interval
+            self.max_lag = max(self.max_lag, lag)
+            self.total_lag += lag
+            self.samples += 1
+            if lag > LOOP_LAG_WARNING:
+                logger.warning(f"Event loop заблокирован на {lag:.2f}с")
+
+    def report(self) -> str:
+        avg = self.total_lag / self.samples if self.samples else 0
+        return f"лаг event loop: сред {avg * 1000:.1f}мс, макс {self.max_lag * 1000:.1f}мс"
+
+    def reset(self):
+        self.max_lag = self.total_lag = 0.0
+        self.samples = 0
+
+
+timers = StageTimers(PROFILING)
+loop_lag = LoopLagMonitor(LOOP_LAG_INTERVAL)
+profile_lock = asyncio.Lock()
+gauges = {}  # текущие значения метрик (например, gap_backlog), попадают в итоги цикла и /profile
+
+
+def format_gauges() -> str:
+    return "".join(f"; {name}={value}" for name, value in sorted(gauges.items()))
+
+
+def log_cycle_stats():
+    """Итоги цикла в лог (только при PROFILING)"""
+    if not timers.enabled:
+        return
+    logger.info(f"⏱ Этапы цикла: {timers.report()}; {loop_lag.report()}{format_gauges()}")
+    timers.reset()
+    loop_lag.reset()
+
+
+async def profile_process(seconds: int) -> Tuple[str, str]:
+    """
+    Профилировать живой процесс seconds секунд.
+
+    cProfile включается в потоке event loop, поэтому видит все корутины бота;
+    tracemalloc сравнивает снимки памяти до и после.
+
+    Returns:
+        (краткая сводка, полный отчет)
+    """
+    started_tracemalloc = not tracemalloc.is_tracing()
+    if started_tracemalloc:
+        tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.disable()
+
+    after = tracemalloc.take_snapshot()
+    if started_tracemalloc:
+        tracemalloc.stop()
+
+    out = io.StringIO()
+    stats = pstats.Stats(profiler, stream=out)
+    out.write(f"=== cProfile, {seconds}с, по собственному времени ===\n")
+    stats.sort_stats('tottime').print_stats(PROFILE_TOP)
+    out.write("=== cProfile, по суммарному времени ===\n")
+    stats.sort_stats('cumulative').print_stats(PROFILE_TOP)
+
+    allocations = after.compare_to(before, 'lineno')[:PROFILE_TOP]
+    out.write("=== tracemalloc, прирост памяти ===\n")
+    for stat in allocations:
+        out.write(f"{stat}\n")
+
+    top_functions = sorted(stats.stats.items(), key=lambda item: -item[1][2])[:5]
+    summary = ["*Топ функций (собственное время):*"]
+    for (filename, line, name), (_, _, tottime, cumtime, _) in top_functions:
+        summary.append(f"`{name}` `{os.path.basename(filename)}:{line}` - {tottime:.3f}с / {cumtime:.3f}с")
+    summary.append("*Топ аллокаций:*")
+    for stat in allocations[:5]:
+        frame = stat.traceback[0]
+        summary.append(f"`{os.path.basename(frame.filename)}:{frame.lineno}` {stat.size_diff / 1024:+.1f} КБ")
+    if timers.enabled:
+        summary.append(f"*Этапы:* {timers.report()}")
+    if loop_lag.samples:
+        summary.append(loop_lag.report())
+    if gauges:
+        # В коде: имена метрик с '_' ломают разметку Markdown
+        summary.append("Метрики: " + ", ".join(f"`{name}={value}`" for name, value in sorted(gauges.items())))
+    return "\n".join(summary), out.getvalue()
+
+# ==================== ЛИМИТЫ ЗАПРОСОВ ====================
+def parse_rate_limits(value: str) -> dict:
+    """Разобрать строку вида `host=rps,host=rps`"""
+    limits = {}
+    for item in value.split(','):
+        host, _, rate = item.partition('=')
+        try:
+            limits[host.strip()] = float(rate)
+        except ValueError:
+            continue
+    return limits
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Retry-After: число секунд или HTTP-дата"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """
+    Token bucket одного endpoint'а.
+
+    Скорость адаптивная: каждый 429 вдвое снижает rate (не ниже 10% от базовой)
+    и блокирует bucket на Retry-After, успешные ответы постепенно возвращают
+    скорость к базовой.
+    """
+
+    def __init__(self, rate: float):
+        self.base_rate = rate
+        self.rate = rate
+        self.capacity = max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def delay(self) -> float:
+        """Сколько секунд ждать следующего токена"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        wait = max(0.0, self.blocked_until - now)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    async def acquire(self, max_wait: float) -> bool:
+        """Взять токен, подождав не дольше max_wait; False - endpoint перегружен"""
+        while True:
+            wait = self.delay()
+            if wait <= 0:
+                self.tokens -= 1
+                return True
+            if wait > max_wait:
+                return False
+            await asyncio.sleep(wait)
+            max_wait -= wait
+
+    def try_acquire(self) -> bool:
+        """Взять токен без ожидания"""
+        if self.delay() <= 0:
+            self.tokens -= 1
+            return True
+        return False
+
+    def on_throttled(self, retry_after: Optional[float] = None):
+        self.rate = max(self.base_rate * 0.1, self.rate / 2)
+        self.tokens = 0
+        self.blocked_until = time.monotonic() + (retry_after if retry_after is not None else 1 / self.rate)
+
+    def on_success(self):
+        if self.rate < self.base_rate:
+            self.rate = min(self.base_rate, self.rate + self.base_rate * 0.05)
+
+
+class RateLimiter:
+    """Общие для всех вызывающих token bucket'ы, по одному на хост"""
+
+    def __init__(self, limits: dict, default_rate: float):
+        self.limits = limits
+        self.default_rate = default_rate
+        self.buckets = {}
+
+    def bucket(self, url: str) -> TokenBucket:
+        host = urlparse(url).netloc or url
+        if host not in self.buckets:
+            self.buckets[host] = TokenBucket(self.limits.get(host, self.default_rate))
+        return self.buckets[host]
+
+    def delay(self, url: str) -> float:
+        return self.bucket(url).delay()
+
+    async def acquire(self, url: str, max_wait: float) -> bool:
+        return await self.bucket(url).acquire(max_wait)
+
+
+rate_limiter = RateLimiter(
+    {**RPC_RATE_LIMITS, **parse_rate_limits(os.getenv("RPC_RATE_LIMITS", ""))},
+    RPC_DEFAULT_RATE_LIMIT
+)
+
+# ==================== ТОКЕНЫ ====================
+ERC20_TRANSFER = '0xa9059cbb'
+ERC20_TRANSFER_FROM = '0x23b872dd'
+ERC20_SYMBOL = '0x95d89b41'
+ERC20_DECIMALS = '0x313ce567'
+
+# Популярные токены каждой сети: адрес контракта -> (символ, decimals)
+KNOWN_TOKENS = {
+    'ethereum': {
+        '0xdac17f958d2ee523a2206206994597c13d831ec7': ('USDT', 6),
+        '0xa0b86991c6218b36c1d19d4a2e9eb0ce3606eb48': ('USDC', 6),
+        '0x6b175474e89094c44da98b954eedeac495271d0f': ('DAI', 18),
+        '0xc02aaa39b223fe8d0a0e5c4f27ead9083c756cc2': ('WETH', 18),
+        '0x2260fac5e5542a773aa44fbcfedf7c193bc2c599': ('WBTC', 8),
+    },
+    'bsc': {
+        '0x55d398326f99059ff775485246999027b3197955': ('USDT', 18),
+        '0x8ac76a51cc950d9822d68b83fe1ad97b32cd580d': ('USDC', 18),
+        '0xe9e7cea3dedca5984780bafc599bd69add087d56': ('BUSD', 18),
+        '0xbb4cdb9cbd36b01bd1cbaebf2de08d9173bc095c': ('WBNB', 18),
+    },
+    'polygon': {
+        '0xc2132d05d31c914a87c6611c10748aeb04b58e8f': ('USDT', 6),
+        '0x3c499c542cef5e3811e1192ce70d8cc03d5c3359': ('USDC', 6),
+        '0x2791bca1f2de4661ed88a30c99a7a9449aa84174': ('USDC.e', 6),
+        '0x0d500b1d8e8ef31e21c99d1db9a6444d3adf1270': ('WMATIC', 18),
+    },
+    'arbitrum': {
+        '0xfd086bc7cd5c481dcc9c85ebe478a1c0b69fcbb9': ('USDT', 6),
+        '0xaf88d065e77c8cc2239327c5edb3a432268e5831': ('USDC', 6),
+        '0x82af49447d8a07e3bd95bd0d56f35241523fbab1': ('WETH', 18),
+    },
+    'optimism': {
+        '0x94b008aa00579c1307b0ef2c499ad98a8ce58e58': ('USDT', 6),
+        '0x0b2c639c533813f4aa9d7837caf62653d097ff85': ('USDC', 6),
+        '0x4200000000000000000000000000000000000006': ('WETH', 18),
+    },
+    'avalanche': {
+        '0x9702230a8ea53601f5cd2dc00fdbc13d4df4a8c7': ('USDT', 6),
+        '0xb97ef9ef8734c71904d8002f8b6bc66dd9c48a6e': ('USDC', 6),
+        '0xb31f66aa3c1e785363f0875a1b74e27b85fd66c7': ('WAVAX', 18),
+    },
+    'base': {
+        '0x833589fcd6edb6e08f4c7c32d4f71b54bda02913': ('USDC', 6),
+        '0x4200000000000000000000000000000000000006': ('WETH', 18),
+    },
+    'fantom': {
+        '0x04068da6c83afcfa0e13ba15a6696662335d5b75': ('USDC', 6),
+        '0x21be370d5312f44cb42ce377bc9b8a0cef1a4c83': ('WFTM', 18),
+    },
+    'gnosis': {
+        '0xddafbb505ad214d7b80b1f830fccc89b60fb7a83': ('USDC', 6),
+        '0x4ecaba5870353805a9f068101a40e0f32ed605c6': ('USDT', 6),
+        '0xe91d153e0b41518a2ce8dd3d7944fa863463a97d': ('WXDAI', 18),
+    },
+    'celo': {
+        '0x765de816845861e75a25fca122bb6898b8b1282a': ('cUSD', 18),
+    },
+    'moonbeam': {
+        '0xacc15dc74880c9944775448304b263d191c6077f': ('WGLMR', 18),
+    },
+    'hyperliquid': {
+        '0x5555555555555555555555555555555555555555': ('WHYPE', 18),
+    },
+}
+
+
+def decode_abi_uint(result: Optional[str]) -> Optional[int]:
+    if not result or result == '0x':
+        return None
+    try:
+        return int(result[2:66], 16)
+    except ValueError:
+        return None
+
+
+def clean_symbol(symbol) -> Optional[str]:
+    """
+    Символ токена в безопасном для Markdown виде.
+
+    symbol() задает автор контракта: '_', '*', '`' или '[' в спам-токене
+    сломали бы разметку, и Telegram отклонил бы уведомление целиком.
+    """
+    symbol = ''.join(c for c in str(symbol or '') if c.isalnum() or c in '.-+$')
+    return symbol[:16] or None
+
+
+def decode_abi_string(result: Optional[str]) -> Optional[str]:
+    """Декодировать string (или bytes32 у старых токенов) из ответа eth_call"""
+    if not result or len(result) < 66:
+        return None
+    try:
+        data = bytes.fromhex(result[2:])
+        if len(data) >= 64 and int.from_bytes(data[:32], 'big') == 32:
+            length = int.from_bytes(data[32:64], 'big')
+            raw = data[64:64 + length]
+        else:
+            raw = data[:32].rstrip(b'\x00')
+        return clean_symbol(raw.decode('utf-8', errors='ignore'))
+    except ValueError:
+        return None
+
+
+class TokenRegistry:
+    """Метаданные токенов (символ, decimals) по ключу (цепь, контракт)"""
+
+    def __init__(self, path: str, maxsize: int):
+        self.path = path
+        self.known = {
+            (chain, contract): meta
+            for chain, tokens in KNOWN_TOKENS.items()
+            for contract, meta in tokens.items()
+        }
+        self.tokens = LRUCache(maxsize=maxsize)
+        self.failed = TTLCache(maxsize=1000, ttl=3600)
+
+    def get(self, chain: str, contract: str) -> Optional[Tuple[str, int]]:
+        key = (chain, contract)
+        return self.known.get(key) or self.tokens.get(key)
+
+    def load(self):
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, 'rb') as f:
+                    for key, (symbol, decimals) in pickle.load(f):
+                        self.tokens[key] = (clean_symbol(symbol) or 'TOKEN', decimals)
+                logger.info(f"Загружено {len(self.tokens)} токенов из кэша")
+        except Exception as e:
+            logger.error(f"Ошибка загрузки кэша токенов: {e}")
+
+    def save(self):
+        try:
+            with timers.stage('persist'), open(self.path, 'wb') as f:
+                pickle.dump(list(self.tokens.items()), f)
+        except Exception as e:
+            logger.error(f"Ошибка сохранения кэша токенов: {e}")
+
+    async def resolve(self, rpc: 'AsyncRPC', contracts) -> None:
+        """Загрузить метаданные неизвестных токенов пачками (JSON-RPC batch)"""
+        chain = rpc.chain
+        missing = [
+            c for c in set(contracts)
+            if self.get(chain, c) is None and (chain, c) not in self.failed
+        ]
+        if not missing:
+            return
+
+        for i in range(0, len(missing), RPC_BATCH_SIZE // 2):
+            chunk = missing[i:i + RPC_BATCH_SIZE // 2]
+            calls = []
+            for contract in chunk:
+                calls.append(("eth_call", [{"to": contract, "data": ERC20_SYMBOL}, "latest"]))
+                calls.append(("eth_call", [{"to": contract, "data": ERC20_DECIMALS}, "latest"]))
+
+            results = await rpc.batch_request(calls)
+            for j, contract in enumerate(chunk):
+                decimals = decode_abi_uint(results[2 * j + 1])
+                if decimals is None or decimals > 36:
+                    self.failed[(chain, contract)] = True
+                    continue
+                symbol = decode_abi_string(results[2 * j]) or 'TOKEN'
+                self.tokens[(chain, contract)] = (symbol, decimals)
+
+        logger.info(f"Загружены метаданные {len(missing)} токенов на {chain}")
+        self.save()
+
+
+token_registry = TokenRegistry(TOKEN_CACHE_FILE, TOKEN_CACHE_SIZE)
+
+# ==================== МОДЕЛЬ ДАННЫХ ====================
+# Цепи хранятся в записях маленьким int, в файле - по имени (индексы не зависят от порядка RPC_CONFIGS)
+CHAIN_IDS = list(RPC_CONFIGS)
+CHAIN_INDEX = {chain: i for i, chain in enumerate(CHAIN_IDS)}
+
+# Битовые флаги кошелька
+NOTIFY_IN = 1
+NOTIFY_OUT = 2
+FLAG_FIELDS = {'notify_incoming': NOTIFY_IN, 'notify_outgoing': NOTIFY_OUT}
+DEFAULT_FLAGS = NOTIFY_IN | NOTIFY_OUT
+
+_MISSING = object()
+
+
+class WalletRecord:
+    """
+    Компактная запись кошелька с dict-подобным API.
+
+    Основные поля лежат в __slots__ (цепь - индекс, уведомления - биты flags),
+    редкие настройки (фильтры, очередь догона) - в extra, который создается
+    только при первой записи.
+
+    Один адрес может отслеживаться в нескольких цепях одной записью: тогда
+    cursors хранит последний проверенный блок по индексу цепи, а chain_id и
+    last_block - первая (основная) цепь для полей 'chain' и 'last_block'.
+    Фильтры и настройки уведомлений общие для всех цепей записи.
+    """
+
+    __slots__ = ('chain_id', 'last_block', 'added_at', 'flags', 'extra', 'cursors')
+
+    def __init__(self, chain: str, last_block: int, added_at: float, flags: int = DEFAULT_FLAGS,
+                 extra: dict = None, cursors: dict = None):
+        self.chain_id = CHAIN_INDEX[chain]
+        self.last_block = last_block
+        self.added_at = added_at
+        self.flags = flags
+        self.extra = extra or None
+        self.cursors = None
+        for other, block in (cursors or {}).items():
+            if other in CHAIN_INDEX:
+                self.add_chain(other, block)
+
+    def chain_ids(self) -> List[int]:
+        return list(self.cursors) if self.cursors else [self.chain_id]
+
+    def chains(self) -> List[str]:
+        return [CHAIN_IDS[chain_id] for chain_id in self.chain_ids()]
+
+    def cursor(self, chain: str) -> int:
+        """Последний проверенный блок цепи"""
+        chain_id = CHAIN_INDEX[chain]
+        return self.cursors[chain_id] if self.cursors else self.last_block
+
+    def set_cursor(self, chain: str, block: int):
+        chain_id = CHAIN_INDEX[chain]
+        if self.cursors:
+            self.cursors[chain_id] = block
+        if chain_id == self.chain_id:
+            self.last_block = block
+
+    def add_chain(self, chain: str, block: int) -> bool:
+        """Добавить цепь к записи; False - уже отслеживается"""
+        chain_id = CHAIN_INDEX[chain]
+        if chain_id in self.chain_ids():
+            return False
+        if self.cursors is None:
+            self.cursors = {self.chain_id: self.last_block}
+        self.cursors[chain_id] = block
+        return True
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'WalletRecord':
+        """Запись из старого формата (dict)"""
+        record = cls(data['chain'], data.get('last_block', 0), data.get('added_at', 0))
+        for key, value in data.items():
+            if key not in ('chain', 'last_block', 'added_at'):
+                record[key] = value
+        return record
+
+    def to_tuple(self) -> tuple:
+        cursors = {CHAIN_IDS[chain_id]: block for chain_id, block in self.cursors.items()} if self.cursors else None
+        return CHAIN_IDS[self.chain_id], self.last_block, self.added_at, self.flags, self.extra, cursors
+
+    def __getitem__(self, key: str):
+        if key == 'chain':
+            return CHAIN_IDS[self.chain_id]
+        if key == 'last_block':
+            return self.cursor(CHAIN_IDS[self.chain_id])
+        if key == 'added_at':
+            return self.added_at
+        bit = FLAG_FIELDS.get(key)
+        if bit is not None:
+            return bool(self.flags & bit)
+        if self.extra and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key: str, value):
+        if key == 'chain':
+            self.chain_id = CHAIN_INDEX[value]
+        elif key == 'last_block':
+            self.set_cursor(CHAIN_IDS[self.chain_id], value)
+        elif key == 'added_at':
+            self.added_at = value
+        elif key in FLAG_FIELDS:
+            self.flags = self.flags | FLAG_FIELDS[key] if value else self.flags & ~FLAG_FIELDS[key]
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __delitem__(self, key: str):
+        if self.extra and key in self.extra:
+            del self.extra[key]
+            if not self.extra:
+                self.extra = None
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key: str) -> bool:
+        try:
+            self[key]
+            return True
+        except KeyError:
+            return False
+
+    def get(self, key: str, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def setdefault(self, key: str, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            self[key] = default
+            return default
+
+    def pop(self, key: str, default=_MISSING):
+        try:
+            value = self[key]
+        except KeyError:
+            if default is _MISSING:
+                raise
+            return default
+        del self[key]
+        return value
+
+
+def address_key(address: str) -> bytes:
+    """EVM адрес -> 20-байтовый ключ (регистр не важен)"""
+    return bytes.fromhex(address[2:])
+
+
+def key_address(key: bytes) -> str:
+    return '0x' + key.hex()
+
+
+class WalletMap:
+    """
+    Кошельки одного чата: dict-подобное отображение адрес -> WalletRecord.
+
+    Внутри ключи - 20 байт адреса, наружу отдаются адреса в нижнем регистре.
+    """
+
+    __slots__ = ('wallets',)
+
+    def __init__(self):
+        self.wallets = {}  # 20-байтовый ключ -> WalletRecord
+
+    def __getitem__(self, address: str) -> WalletRecord:
+        return self.wallets[address_key(address)]
+
+    def __setitem__(self, address: str, record: WalletRecord):
+        self.wallets[address_key(address)] = record
+
+    def __delitem__(self, address: str):
+        del self.wallets[address_key(address)]
+
+    def __contains__(self, address: str) -> bool:
+        return address_key(address) in self.wallets
+
+    def __len__(self) -> int:
+        return len(self.wallets)
+
+    def __iter__(self):
+        return (key_address(key) for key in self.wallets)
+
+    def get(self, address: str, default=None):
+        return self.wallets.get(address_key(address), default)
+
+    def items(self):
+        return [(key_address(key), record) for key, record in self.wallets.items()]
+
+    def values(self):
+        return self.wallets.values()
+
+    def dump(self) -> dict:
+        return {key: record.to_tuple() for key, record in self.wallets.items()}
+
+    @classmethod
+    def restore(cls, dumped: dict) -> 'WalletMap':
+        wallet_map = cls()
+        for key, value in dumped.items():
+            if isinstance(key, str):
+                # Старый формат: {адрес: dict}
+                record = wallet_map[key] = WalletRecord.from_dict(value)
+            else:
+                # Кортеж WalletRecord.to_tuple(); у записей до мультицепочности нет cursors
+                chain, last_block, added_at, flags, extra, *rest = value
+                record = WalletRecord(chain, last_block, added_at, flags, extra, rest[0] if rest else None)
+                wallet_map.wallets[key] = record
+            repair = record.get('repair')
+            if isinstance(repair, list):
+                # Очередь догона была общей на кошелек - теперь по цепям
+                record['repair'] = {record['chain']: repair}
+        return wallet_map
+
+
 # ==================== ХРАНЕНИЕ ДАННЫХ ====================
 user_subs = {}
 
@@ -190,7 +939,7 @@ def load_data():
     try:
         if os.path.exists(DATA_FILE):
             with open(DATA_FILE, 'rb') as f:
-                user_subs = pickle.load(f)
+                user_subs = {chat_id: WalletMap.restore(wallets) for chat_id, wallets in pickle.load(f).items()}
             logger.info(f"Загружено {sum(len(w) for w in user_subs.values())} EVM кошельков")
     except Exception as e:
         logger.error(f"Ошибка загрузки EVM данных: {e}")
@@ -200,12 +949,172 @@ def load_data():
 def save_data():
     """Сохранить EVM данные"""
     try:
-        with open(DATA_FILE, 'wb') as f:
-            pickle.dump(user_subs, f)
+        with timers.stage('persist'), open(DATA_FILE, 'wb') as f:
+            pickle.dump({chat_id: wallets.dump() for chat_id, wallets in user_subs.items()}, f)
     except Exception as e:
         logger.error(f"Ошибка сохранения EVM данных: {e}")
 
 
+# ==================== ИСТОРИЯ ====================
+class TxHistory:
+    """
+    Локальный индекс найденных транзакций (sqlite3) - /history отвечает из него без запросов к сети.
+
+    Таблица без rowid с ключом (chain, address, timestamp, hash, type), поэтому
+    записи кошелька лежат подряд по времени и страница читается одним проходом
+    по индексу. compact() удаляет записи старше HISTORY_RETENTION_DAYS и сверх
+    HISTORY_MAX_PER_WALLET на кошелек, затем возвращает свободные страницы файла.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.db = None
+        self.holds = 0  # идущие выгрузки /export_txs: compact() ждет их окончания
+
+    def open(self):
+        try:
+            self.db = sqlite3.connect(self.path)
+            self.db.execute("PRAGMA auto_vacuum = INCREMENTAL")  # действует только для нового файла
+            self.db.execute("PRAGMA journal_mode = WAL")
+            self.db.execute("PRAGMA synchronous = NORMAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS txs ("
+                " chain TEXT NOT NULL, address TEXT NOT NULL, timestamp INTEGER NOT NULL,"
+                " hash TEXT NOT NULL, type TEXT NOT NULL, block INTEGER, counterparty TEXT,"
+                " value REAL, token TEXT, failed INTEGER NOT NULL DEFAULT 0,"
+                " PRIMARY KEY (chain, address, timestamp, hash, type)) WITHOUT ROWID"
+            )
+            self.db.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка открытия истории {self.path}: {e}")
+            self.db = None
+
+    def add(self, chain: str, address: str, txs: List[dict]):
+        """Сохранить транзакции кошелька; повторы игнорируются"""
+        if not self.db or not txs:
+            return
+        rows = [
+            (chain, address, tx.get('timestamp') or 0, tx['hash'], tx['type'], tx.get('block'),
+             tx['from'] if tx['type'] == 'in' else tx['to'], tx['value'], tx.get('token'),
+             int(bool(tx.get('failed'))))
+            for tx in txs
+        ]
+        try:
+            with timers.stage('persist'):
+                self.db.executemany("INSERT OR IGNORE INTO txs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                self.db.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка записи истории: {e}")
+
+    def page(self, chains: List[str], address: str, offset: int, limit: int) -> Tuple[List[tuple], int]:
+        """(записи всех цепей кошелька от новых к старым, всего записей)"""
+        if not self.db:
+            return [], 0
+        marks = ",".join("?" * len(chains))
+        total = self.db.execute(
+            f"SELECT COUNT(*) FROM txs WHERE chain IN ({marks}) AND address = ?", (*chains, address)
+        ).fetchone()[0]
+        rows = self.db.execute(
+            "SELECT chain, timestamp, hash, type, block, counterparty, value, token, failed FROM txs"
+            f" WHERE chain IN ({marks}) AND address = ? ORDER BY timestamp DESC LIMIT ? OFFSET ?",
+            (*chains, address, limit, offset)
+        ).fetchall()
+        return rows, total
+
+    async def iter_range(self, chain: str, address: str, since_ms: int, until_ms: int):
+        """
+        Async-генератор записей кошелька за период по возрастанию времени.
+
+        Читает порциями по HISTORY_EXPORT_BATCH с курсором по ключу, между
+        порциями отдает управление event loop; память не зависит от числа записей.
+        """
+        if not self.db:
+            return
+        cursor = (since_ms, '', '')
+        first = True
+        while True:
+            rows = self.db.execute(
+                "SELECT timestamp, hash, type, block, counterparty, value, token, failed FROM txs"
+                " WHERE chain = ? AND address = ? AND timestamp <= ?"
+                f" AND (timestamp, hash, type) {'>=' if first else '>'} (?, ?, ?)"
+                " ORDER BY timestamp, hash, type LIMIT ?",
+                (chain, address, until_ms, *cursor, HISTORY_EXPORT_BATCH)
+            ).fetchall()
+            for row in rows:
+                yield row
+            if len(rows) < HISTORY_EXPORT_BATCH:
+                return
+            cursor = (rows[-1][0], rows[-1][1], rows[-1][2])
+            first = False
+            await asyncio.sleep(0)
+
+    def compact(self):
+        if not self.db:
+            return
+        if self.holds:
+            logger.debug("История: идет выгрузка, сжатие отложено до следующего цикла")
+            return
+        try:
+            cutoff = int((time.time() - HISTORY_RETENTION_DAYS * 86400) * 1000)
+            expired = self.db.execute("DELETE FROM txs WHERE timestamp < ?", (cutoff,)).rowcount
+
+            trimmed = 0
+            oversized = self.db.execute(
+                "SELECT chain, address FROM txs GROUP BY chain, address HAVING COUNT(*) > ?",
+                (HISTORY_MAX_PER_WALLET,)
+            ).fetchall()
+            for chain, address in oversized:
+                trimmed += self.db.execute(
+                    "DELETE FROM txs WHERE chain = ? AND address = ? AND timestamp < ("
+                    " SELECT timestamp FROM txs WHERE chain = ? AND address = ?"
+                    " ORDER BY timestamp DESC LIMIT 1 OFFSET ?)",
+                    (chain, address, chain, address, HISTORY_MAX_PER_WALLET - 1)
+                ).rowcount
+            self.db.commit()
+            self.db.execute("PRAGMA incremental_vacuum")
+
+            if expired or trimmed:
+                logger.info(f"История: удалено {expired} устаревших и {trimmed} записей сверх лимита")
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка сжатия истории: {e}")
+
+
+tx_history = TxHistory(HISTORY_FILE)
+
+
+async def compact_history():
+    """Фоновая задача: периодическое сжатие истории"""
+    while True:
+        tx_history.compact()
+        await asyncio.sleep(HISTORY_COMPACT_INTERVAL)
+
+
+def history_view(idx: int, addr: str, chains: List[str], page: int) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    """Страница истории кошелька по всем его цепям: (текст, клавиатура листания)"""
+    rows, total = tx_history.page(chains, addr, page * HISTORY_PAGE_SIZE, HISTORY_PAGE_SIZE)
+    pages = max(1, -(-total // HISTORY_PAGE_SIZE))
+
+    text = f"📜 *История кошелька #{idx + 1}* `{format_addr(addr)}`\n"
+    if not rows:
+        text += "\nЗаписей нет"
+    else:
+        text += f"Страница {page + 1}/{pages}, всего {total}\n\n"
+    for chain, timestamp, tx_hash, tx_type, block, counterparty, value, token, failed in rows:
+        when = datetime.fromtimestamp(timestamp / 1000).strftime('%d.%m %H:%M') if timestamp else "—"
+        icon, direction = ("📥", "от") if tx_type == 'in' else ("📤", "кому")
+        text += (
+            f"{RPC_CONFIGS[chain]['color'] + ' ' if len(chains) > 1 else ''}"
+            f"{when} {icon} {value:.4f} {clean_symbol(token) or ''} {direction} `{format_addr(counterparty or '')}`"
+            f"{' ❌' if failed else ''} [🔗]({RPC_CONFIGS[chain]['explorer']}{tx_hash})\n"
+        )
+
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton(text="◀️", callback_data=f"history_{idx}_{min(page, pages) - 1}"))
+    if page + 1 < pages:
+        buttons.append(InlineKeyboardButton(text="▶️", callback_data=f"history_{idx}_{page + 1}"))
+    return text, InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+
 
 # ==================== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ====================
 def validate_evm(addr: str) -> bool:
@@ -224,15 +1133,52 @@ def format_addr(addr: str) -> str:
     return f"{addr[:6]}...{addr[-4:]}"
 
 
-def get_all_wallets(chat_id: int) -> List[Tuple[str, dict]]:
+def get_all_wallets(chat_id: int) -> List[Tuple[str, WalletRecord]]:
     """Список кошельков: (address, data)"""
-    return list(user_subs.get(chat_id, {}).items())
+    wallets = user_subs.get(chat_id)
+    return wallets.items() if wallets else []
 
 
-def wallet_display(addr: str, data: dict) -> Tuple[str, str]:
+def wallet_display(addr: str, data: WalletRecord) -> Tuple[str, str]:
     """Возвращает (color+name, formatted_addr) для отображения"""
-    config = RPC_CONFIGS[data['chain']]
-    return (f"{config['color']} {config['name']}", format_addr(addr))
+    chains = data.chains()
+    if len(chains) == 1:
+        config = RPC_CONFIGS[chains[0]]
+        return (f"{config['color']} {config['name']}", format_addr(addr))
+    if len(chains) == len(RPC_CONFIGS):
+        return ("🌐 Все цепи", format_addr(addr))
+    return (f"🌐 {', '.join(RPC_CONFIGS[c]['name'] for c in chains)}", format_addr(addr))
+
+
+def parse_chains(value: str) -> Optional[List[str]]:
+    """`all`, `ethereum` или `ethereum,bsc,base` -> список цепей; None - есть неизвестная"""
+    if value.lower() == 'all':
+        return list(RPC_CONFIGS)
+    chains = list(dict.fromkeys(c.strip().lower() for c in value.split(',') if c.strip()))
+    if not chains or any(chain not in RPC_CONFIGS for chain in chains):
+        return None
+    return chains
+
+
+def iter_wallet_chains():
+    """(chat_id, адрес, запись, цепь) для каждой отслеживаемой цепи каждой записи"""
+    for chat_id, wallets in list(user_subs.items()):
+        for address, data in list(wallets.items()):
+            for chain in data.chains():
+                yield chat_id, address, data, chain
+
+
+def wallets_by_chain() -> dict:
+    """цепь -> [(chat_id, адрес, запись)]: индекс сканера, одна запись попадает в каждую свою цепь"""
+    index = {}
+    for chat_id, address, data, chain in iter_wallet_chains():
+        index.setdefault(chain, []).append((chat_id, address, data))
+    return index
+
+
+def make_wallet_data(chain: str, current_block: int) -> WalletRecord:
+    """Начальные настройки нового кошелька"""
+    return WalletRecord(chain, current_block, time.time())
 
 
 def get_inline_keyboard(buttons: List[Tuple[str, str]], row_width: int = 1) -> InlineKeyboardMarkup:
@@ -260,101 +1206,593 @@ class AsyncRPC:
         await self.session.close()
 
     async def request(self, method: str, params: list = None) -> Optional[Any]:
+        """
+        JSON-RPC вызов с объединением одинаковых запросов.
+
+        Если такой же вызов (цепь + метод + параметры) уже выполняется,
+        ждем его результат вместо отправки дубля.
+        """
         if params is None:
             params = []
 
-        best_rpc = rpc_cache.get_best_rpc(self.chain)
-        rpcs_to_try = [best_rpc] + [r for r in self.config['all_rpcs'] if r != best_rpc]
-
-        for rpc_url in rpcs_to_try:
-            try:
-                payload = {
-                    "jsonrpc": "2.0",
-                    "method": method,
-                    "params": params,
-                    "id": int(time.time() * 1000) % 10000
-                }
-                async with self.session.post(rpc_url, json=payload, timeout=self.config['timeout']) as resp:
-                    result = await resp.json()
-                    if "error" not in result:
-                        self.last_success = rpc_url
-                        return result.get("result")
+        key = (self.chain, method, json.dumps(params, sort_keys=True))
+        pending = rpc_cache.inflight.get(key)
+        if pending:
+            return await asyncio.shield(pending)
 
+        future = asyncio.get_running_loop().create_future()
+        rpc_cache.inflight[key] = future
+        try:
+            result = await self._call(method, params)
+            future.set_result(result)
+            return result
+        finally:
+            rpc_cache.inflight.pop(key, None)
+            if not future.done():
+                future.set_result(None)
+
+    async def _call(self, method: str, params: list) -> Optional[Any]:
+        payload = {
+            "jsonrpc": "2.0",
+            "method": method,
+            "params": params,
+            "id": int(time.time() * 1000) % 10000
+        }
+
+        async for rpc_url in self._endpoints():
+            result = await self._send(rpc_url, payload)
+            if isinstance(result, dict) and "error" not in result:
+                self.last_success = rpc_url
+                return result.get("result")
+            if result is not None:
                 rpc_cache.mark_error(rpc_url)
-            except Exception as e:
-                logger.debug(f"RPC ошибка {rpc_url}: {e}")
-                rpc_cache.mark_error(rpc_url)
-                continue
 
         return None
 
+    async def request_on(self, rpc_url: str, method: str, params: list = None) -> Optional[Any]:
+        """
+        Вызов на конкретном RPC, без перебора endpoint'ов.
+
+        Для методов с состоянием на ноде (фильтры): другой RPC о нем не знает.
+        None - ошибка, перегрузка или ответ с error.
+        """
+        if not await rate_limiter.acquire(rpc_url, RATE_LIMIT_QUEUE_TIMEOUT):
+            return None
+        payload = {"jsonrpc": "2.0", "method": method, "params": params or [], "id": 1}
+        result = await self._send(rpc_url, payload)
+        if isinstance(result, dict) and "error" not in result:
+            return result.get("result")
+        if result is not None:
+            rpc_cache.mark_error(rpc_url)
+        return None
+
+    async def batch_request(self, calls: List[Tuple[str, list]],
+                            errors: Optional[List[Optional[dict]]] = None) -> List[Optional[Any]]:
+        """
+        Несколько вызовов одним JSON-RPC batch; результаты в порядке calls.
+
+        В errors (если передан) попадают объекты error ответа в том же порядке.
+        """
+        if not calls:
+            return []
+
+        payload = [
+            {"jsonrpc": "2.0", "method": method, "params": params, "id": i}
+            for i, (method, params) in enumerate(calls)
+        ]
+
+        async for rpc_url in self._endpoints():
+            result = await self._send(rpc_url, payload)
+            if isinstance(result, list):
+                by_id = {item.get('id'): item for item in result if isinstance(item, dict)}
+                self.last_success = rpc_url
+                if errors is not None:
+                    errors.extend(by_id.get(i, {}).get('error') for i in range(len(calls)))
+                return [by_id.get(i, {}).get('result') for i in range(len(calls))]
+            if result is not None:
+                rpc_cache.mark_error(rpc_url)
+
+        # Ни один RPC не принял batch - выполняем вызовы по отдельности
+        return list(await asyncio.gather(*(self.request(method, params) for method, params in calls)))
+
+    async def _send(self, rpc_url: str, payload: Any) -> Optional[Any]:
+        """POST на один RPC; None при сетевой ошибке или 429"""
+        bucket = rate_limiter.bucket(rpc_url)
+        try:
+            with timers.stage('fetch'):
+                async with self.session.post(rpc_url, json=payload, timeout=self.config['timeout']) as resp:
+                    if resp.status == 429:
+                        bucket.on_throttled(parse_retry_after(resp.headers.get('Retry-After')))
+                        logger.warning(f"RPC {rpc_url}: 429, лимит снижен до {bucket.rate:.1f} запр/с")
+                        return None
+                    body = await resp.read()
+            with timers.stage('decode'):
+                result = json.loads(body)
+        except Exception as e:
+            logger.debug(f"RPC ошибка {rpc_url}: {e}")
+            rpc_cache.mark_error(rpc_url)
+            return None
+
+        bucket.on_success()
+        return result
+
+    async def _endpoints(self):
+        """
+        RPC в порядке приоритета, для которых получен токен лимитера.
+
+        Перегруженные endpoint'ы пропускаются; если перегружены все, запрос
+        ждет в очереди ближайшего освободившегося, а не падает.
+        """
+        throttled = []
+        for rpc_url in self._rpc_order():
+            if await rate_limiter.acquire(rpc_url, RATE_LIMIT_MAX_WAIT):
+                yield rpc_url
+            else:
+                throttled.append(rpc_url)
+
+        if throttled:
+            rpc_url = min(throttled, key=rate_limiter.delay)
+            if await rate_limiter.acquire(rpc_url, RATE_LIMIT_QUEUE_TIMEOUT):
+                yield rpc_url
+            else:
+                logger.warning(f"Все RPC {self.chain} перегружены, запрос пропущен")
+
+    def _rpc_order(self) -> List[str]:
+        best_rpc = rpc_cache.get_best_rpc(self.chain)
+        return [best_rpc] + [r for r in self.config['all_rpcs'] if r != best_rpc]
+
     async def get_block_number(self) -> int:
+        """Текущий блок; в пределах времени одного блока отдается из кэша"""
+        cached = rpc_cache.heads.get(self.chain)
+        if cached and time.monotonic() - cached[1] < self.config['block_time']:
+            return cached[0]
+
         result = await self.request("eth_blockNumber")
-        return int(result, 16) if result else 0
+        if not result:
+            return 0
+
+        block = int(result, 16)
+        if cached:
+            block = max(block, cached[0])  # отстающий RPC не должен откатывать head
+        rpc_cache.heads[self.chain] = (block, time.monotonic())
+        return block
 
     async def get_balance(self, address: str) -> float:
         result = await self.request("eth_getBalance", [address, "latest"])
         return int(result, 16) / (10 ** self.config['decimals']) if result else 0
 
     async def get_block(self, block_num: int, full: bool = True) -> Optional[dict]:
+        key = f"{self.chain}_{block_num}"
+        if full:
+            cached = rpc_cache.blocks.get(key)
+            if cached:
+                return cached
+
         result = await self.request("eth_getBlockByNumber", [hex(block_num), full])
+        if full and result and 'transactions' in result:
+            rpc_cache.blocks[key] = result
         return result
 
 
-# ==================== ПОЛУЧЕНИЕ ТРАНЗАКЦИЙ ====================
-async def get_transactions(chain: str, address: str, from_block: int, to_block: int) -> List[dict]:
-    """
-    Получить транзакции для указанного адреса в диапазоне блоков.
+    async def get_block_any(self, block_num: int, start: int = 0) -> Optional[dict]:
+        """
+        Блок с перебором всех RPC цепи, начиная с start-го по кругу.
 
-    Args:
-        chain: Идентификатор сети (ethereum, bsc и т.д.)
-        address: Адрес кошелька для отслеживания
-        from_block: Начальный блок (не включительно)
-        to_block: Конечный блок (включительно)
+        В отличие от get_block, пустой ответ одного RPC (блок еще не дошел
+        до отстающей ноды) не останавливает перебор.
+        """
+        rpcs = self.config['all_rpcs']
+        payload = {"jsonrpc": "2.0", "method": "eth_getBlockByNumber", "params": [hex(block_num), True], "id": 1}
+        for i in range(len(rpcs)):
+            rpc_url = rpcs[(start + i) % len(rpcs)]
+            if not await rate_limiter.acquire(rpc_url, RATE_LIMIT_MAX_WAIT):
+                continue
+            result = await self._send(rpc_url, payload)
+            block = result.get('result') if isinstance(result, dict) else None
+            if isinstance(block, dict) and 'transactions' in block:
+                rpc_cache.blocks[f"{self.chain}_{block_num}"] = block
+                return block
+        return None
 
-    Returns:
-        Список транзакций с полями: hash, from, to, value, block, type
-    """
-    txs = []
-    addr_lower = address.lower()
-    config = RPC_CONFIGS.get(chain, {})
+    async def get_receipt_statuses(self, hashes_by_block: dict) -> dict:
+        """
+        Статусы транзакций по квитанциям: hash -> True (выполнена) / False (отклонена).
+
+        eth_getBlockReceipts запрашивается один раз на блок-кандидат, результат
+        кэшируется для всех кошельков цепи. Поддержка метода проверяется на первом
+        вызове; если RPC цепи его не знает, квитанции совпавших транзакций
+        берутся batch-запросом eth_getTransactionReceipt. Хеши без ответа
+        в результат не попадают.
+        """
+        statuses = {}
+        missing = {}
+        for block_num, hashes in hashes_by_block.items():
+            failed = rpc_cache.receipts.get(f"{self.chain}_{block_num}")
+            if failed is not None:
+                statuses.update({h: h not in failed for h in hashes})
+            else:
+                missing[block_num] = hashes
+
+        if missing and rpc_cache.block_receipts.get(self.chain) is not False:
+            blocks = sorted(missing)
+            errors = []
+            results = await self.batch_request([("eth_getBlockReceipts", [hex(b)]) for b in blocks], errors)
+
+            # "Не поддерживается" запоминается только по явному ответу RPC, не по сбою сети
+            if any(isinstance(r, list) for r in results):
+                supported = True
+            elif any(method_unsupported(error) for error in errors):
+                supported = False
+            else:
+                supported = None
+            if supported is not None and self.chain not in rpc_cache.block_receipts:
+                rpc_cache.block_receipts[self.chain] = supported
+                logger.info(f"{self.chain}: eth_getBlockReceipts {'поддерживается' if supported else 'не поддерживается'}")
+
+            for block_num, receipts in zip(blocks, results):
+                if not isinstance(receipts, list):
+                    continue
+                failed = frozenset(
+                    r.get('transactionHash', '').lower() for r in receipts
+                    if isinstance(r, dict) and not receipt_succeeded(r)
+                )
+                rpc_cache.receipts[f"{self.chain}_{block_num}"] = failed
+                statuses.update({h: h not in failed for h in missing.pop(block_num)})
+
+        pending = [h for hashes in missing.values() for h in hashes]
+        for i in range(0, len(pending), RPC_BATCH_SIZE):
+            chunk = pending[i:i + RPC_BATCH_SIZE]
+            results = await self.batch_request([("eth_getTransactionReceipt", [h]) for h in chunk])
+            for tx_hash, receipt in zip(chunk, results):
+                if isinstance(receipt, dict):
+                    statuses[tx_hash] = receipt_succeeded(receipt)
+
+        return statuses
+
+
+def method_unsupported(error: Optional[dict]) -> bool:
+    """Ошибка JSON-RPC означает, что метода на этом RPC нет"""
+    if not isinstance(error, dict):
+        return False
+    message = str(error.get('message', '')).lower()
+    # "block not found" и подобные - не про метод, поэтому нужно слово method
+    return error.get('code') == -32601 or 'method' in message and any(
+        text in message for text in ('not found', 'not supported', 'unsupported', 'does not exist', 'not available')
+    )
 
-    logger.debug(f"Поиск транзакций для {address[:10]}... на {chain} (блоки {from_block+1}-{to_block})")
 
-    async with AsyncRPC(chain) as rpc:
-        for block_num in range(from_block + 1, to_block + 1):
-            cached = rpc_cache.blocks.get(f"{chain}_{block_num}")
-            block = cached if cached else await rpc.get_block(block_num)
+def receipt_succeeded(receipt: dict) -> bool:
+    """status 0x1 - выполнена; у квитанций до Byzantium поля status нет"""
+    status = receipt.get('status')
+    try:
+        return status is None or int(status, 16) == 1
+    except (ValueError, TypeError):
+        return True
 
-            if not block:
-                logger.debug(f"Блок {block_num} на {chain}: не получен")
-                continue
 
-            if 'transactions' not in block:
-                logger.debug(f"Блок {block_num} на {chain}: нет поля transactions")
-                continue
+# ==================== ФИЛЬТРЫ ====================
+def normalize_counterparty(addr: str) -> Optional[str]:
+    return addr.lower() if validate_evm(addr) else None
 
-            if not cached:
-                rpc_cache.blocks[f"{chain}_{block_num}"] = block
 
-            for tx in block.get('transactions', []):
-                    if not isinstance(tx, dict):
-                        logger.debug(f"Блок {block_num}: транзакция не является dict")
-                        continue
+def token_key(tx: dict) -> str:
+    """Ключ токена для фильтров: контракт ERC-20 или символ нативной монеты (его не подделать)"""
+    if tx.get('token_type') == 'ERC20':
+        return tx['token_address'].lower()
+    return (tx.get('token') or '').upper()
 
-                    tx_hash = tx.get('hash', '')
-                    tx_from = tx.get('from', '')
-                    tx_to = tx.get('to')  # может быть None для contract creation
 
-                    # Нормализуем адреса для сравнения
-                    tx_from_lower = tx_from.lower() if tx_from else ''
-                    tx_to_lower = tx_to.lower() if tx_to else ''
+def resolve_token_keys(value: str) -> List[str]:
+    """
+    Ключи токенов по вводу пользователя: адрес контракта или символ.
 
-                    is_outgoing = tx_from_lower == addr_lower
-                    is_incoming = tx_to_lower == addr_lower
+    Символ ищется только среди нативных монет и KNOWN_TOKENS: symbol()
+    любого контракта задает его автор, и поддельный "USDT" не должен
+    проходить фильтр настоящего.
+    """
+    if validate_evm(value):
+        return [value.lower()]
+    symbol = value.upper()
+    keys = sorted({
+        contract for tokens in KNOWN_TOKENS.values()
+        for contract, (known_symbol, _) in tokens.items() if known_symbol.upper() == symbol
+    })
+    if any(config['symbol'].upper() == symbol for config in RPC_CONFIGS.values()):
+        keys.append(symbol)
+    return keys
+
+
+def token_label(key: str) -> str:
+    """Символ для ключа токена в настройках"""
+    if not validate_evm(key):
+        return key
+    for tokens in KNOWN_TOKENS.values():
+        if key in tokens:
+            return tokens[key][0]
+    return format_addr(key)
+
+
+def compile_tx_filter(data: dict) -> Callable[[dict], bool]:
+    """
+    Собрать предикат из настроек кошелька.
 
-                    if is_outgoing or is_incoming:
-                        tx_type = 'out' if is_outgoing else 'in'
+    Предикат применяется в get_transactions до форматирования и отправки,
+    поэтому отброшенные транзакции не стоят ничего, кроме сравнения.
+    Токены сравниваются по token_key; символы из настроек старого формата
+    разворачиваются через resolve_token_keys.
+    """
+    notify_incoming = data.get('notify_incoming', True)
+    notify_outgoing = data.get('notify_outgoing', True)
+    min_amounts = {
+        key: amount
+        for token, amount in data.get('min_amounts', {}).items()
+        for key in resolve_token_keys(token)
+    }
+    token_allowlist = frozenset(key for token in data.get('token_allowlist', ()) for key in resolve_token_keys(token))
+    allow = frozenset(data.get('counterparty_allow', ()))
+    deny = frozenset(data.get('counterparty_deny', ()))
+
+    def predicate(tx: dict) -> bool:
+        incoming = tx['type'] == 'in'
+        if not (notify_incoming if incoming else notify_outgoing):
+            return False
+
+        token = token_key(tx)
+        if token_allowlist and token not in token_allowlist:
+            return False
+        if min_amounts and tx['value'] < min_amounts.get(token, 0):
+            return False
+
+        if allow or deny:
+            counterparty = tx['from'] if incoming else tx['to']
+            if counterparty in deny:
+                return False
+            if allow and counterparty not in allow:
+                return False
+
+        return True
+
+    return predicate
+
+
+def has_filter_rules(data: dict) -> bool:
+    return any(data.get(key) for key in ('min_amounts', 'token_allowlist', 'counterparty_allow', 'counterparty_deny'))
+
+
+def apply_filter_command(data: dict, action: str, args: List[str]) -> Tuple[bool, str]:
+    """Изменить правила фильтра кошелька; возвращает (успех, сообщение)"""
+    if action == 'min':
+        if len(args) != 2:
+            return False, "Использование: /filter <номер> min <токен> <сумма>"
+        try:
+            amount = float(args[1].replace(',', '.'))
+        except ValueError:
+            return False, "Неверная сумма"
+        keys = resolve_token_keys(args[0])
+        if not keys:
+            return False, f"Неизвестный токен {args[0]}: укажите адрес контракта"
+        token = token_label(keys[0])
+        min_amounts = data.setdefault('min_amounts', {})
+        for key in keys:
+            if amount > 0:
+                min_amounts[key] = amount
+            else:
+                min_amounts.pop(key, None)
+        if amount > 0:
+            return True, f"Минимум для {token}: {amount:g}"
+        return True, f"Минимум для {token} снят"
+
+    if action == 'tokens':
+        if len(args) != 1:
+            return False, "Использование: /filter <номер> tokens <USDT,USDC,0x...|all>"
+        if args[0].lower() == 'all':
+            data['token_allowlist'] = []
+            return True, "Уведомления по всем токенам"
+        keys = set()
+        for value in (t.strip() for t in args[0].split(',') if t.strip()):
+            resolved = resolve_token_keys(value)
+            if not resolved:
+                return False, f"Неизвестный токен {value}: укажите адрес контракта"
+            keys.update(resolved)
+        data['token_allowlist'] = sorted(keys)
+        return True, f"Только токены: {', '.join(dict.fromkeys(token_label(k) for k in data['token_allowlist']))}"
+
+    if action in ('allow', 'deny', 'unlist'):
+        if len(args) != 1:
+            return False, f"Использование: /filter <номер> {action} <адрес>"
+        counterparty = normalize_counterparty(args[0])
+        if not counterparty:
+            return False, "Неверный адрес"
+        allow = data.setdefault('counterparty_allow', [])
+        deny = data.setdefault('counterparty_deny', [])
+        for lst in (allow, deny):
+            if counterparty in lst:
+                lst.remove(counterparty)
+        if action == 'allow':
+            allow.append(counterparty)
+            return True, f"Добавлен в белый список: {format_addr(counterparty)}"
+        if action == 'deny':
+            deny.append(counterparty)
+            return True, f"Добавлен в черный список: {format_addr(counterparty)}"
+        return True, f"Удален из списков: {format_addr(counterparty)}"
+
+    if action == 'reset':
+        for key in ('min_amounts', 'token_allowlist', 'counterparty_allow', 'counterparty_deny'):
+            data.pop(key, None)
+        return True, "Правила фильтра сброшены"
+
+    return False, "Неизвестное действие. Доступно: min, tokens, allow, deny, unlist, reset"
+
+
+def filter_settings_view(idx: int, addr: str, data: dict) -> Tuple[str, InlineKeyboardMarkup]:
+    """Текст и клавиатура настроек уведомлений кошелька"""
+    display_name, addr_short = wallet_display(addr, data)
+
+    in_icon = "✅" if data.get('notify_incoming', True) else "❌"
+    out_icon = "✅" if data.get('notify_outgoing', True) else "❌"
+
+    buttons = [
+        (f"📥 Входящие {in_icon}", f"toggle_in_{idx}"),
+        (f"📤 Исходящие {out_icon}", f"toggle_out_{idx}"),
+    ]
+
+    text = (
+        f"⚙️ *Настройки уведомлений*\n"
+        f"Кошелек #{idx + 1}: {display_name} `{addr_short}`\n\n"
+        f"📥 Входящие транзакции: {in_icon}\n"
+        f"📤 Исходящие транзакции: {out_icon}"
+    )
+
+    if has_filter_rules(data):
+        min_amounts = data.get('min_amounts', {})
+        if min_amounts:
+            labels = dict.fromkeys(f"{amount:g} {token_label(key)}" for key, amount in min_amounts.items())
+            text += "\n💰 Минимум: " + ", ".join(labels)
+        if data.get('token_allowlist'):
+            text += "\n🪙 Токены: " + ", ".join(dict.fromkeys(token_label(k) for k in data['token_allowlist']))
+        if data.get('counterparty_allow'):
+            text += "\n✅ Белый список: " + ", ".join(f"`{format_addr(a)}`" for a in data['counterparty_allow'])
+        if data.get('counterparty_deny'):
+            text += "\n⛔ Черный список: " + ", ".join(f"`{format_addr(a)}`" for a in data['counterparty_deny'])
+        buttons.append(("🧹 Сбросить правила", f"filter_reset_{idx}"))
+
+    text += (
+        f"\n\nПравила: `/filter {idx + 1} min USDT 100`, `tokens USDT,USDC`, "
+        f"`allow <адрес>`, `deny <адрес>`, `unlist <адрес>`, `reset`"
+    )
+
+    builder = InlineKeyboardBuilder()
+    for button_text, callback_data in buttons:
+        builder.add(InlineKeyboardButton(text=button_text, callback_data=callback_data))
+    builder.adjust(2, 1)
+    return text, builder.as_markup()
+
+
+# ==================== ПОЛУЧЕНИЕ ТРАНЗАКЦИЙ ====================
+def decode_token_transfer(tx: dict) -> Optional[Tuple[str, str, int]]:
+    """
+    Разобрать вызов transfer/transferFrom ERC-20 из input транзакции.
+
+    Returns:
+        (from, to, сумма в минимальных единицах) или None
+    """
+    data = tx.get('input') or ''
+    selector = data[:10]
+    try:
+        if selector == ERC20_TRANSFER and len(data) >= 138:
+            return tx.get('from', '').lower(), '0x' + data[34:74].lower(), int(data[74:138], 16)
+        if selector == ERC20_TRANSFER_FROM and len(data) >= 202:
+            return '0x' + data[34:74].lower(), '0x' + data[98:138].lower(), int(data[138:202], 16)
+    except ValueError:
+        pass
+    return None
+
+
+def apply_token_meta(chain: str, tx: dict):
+    """Заполнить символ и сумму токен-транзакции из реестра токенов"""
+    meta = token_registry.get(chain, tx['token_address'])
+    symbol, decimals = meta if meta else ('TOKEN', 18)
+    tx['token'] = symbol
+    tx['value'] = tx['raw_value'] / (10 ** decimals)
+
+
+async def apply_receipt_statuses(rpc: AsyncRPC, txs: List[dict]):
+    """Пометить отклоненные транзакции полем failed"""
+    hashes_by_block = {}
+    for tx in txs:
+        hashes_by_block.setdefault(tx['block'], []).append(tx['hash'].lower())
+
+    statuses = await rpc.get_receipt_statuses(hashes_by_block)
+    for tx in txs:
+        # Без квитанции считаем транзакцию выполненной, чтобы не потерять уведомление
+        tx['failed'] = statuses.get(tx['hash'].lower()) is False
+
+    failed = sum(1 for tx in txs if tx['failed'])
+    if failed:
+        logger.info(f"{rpc.chain}: {failed} из {len(txs)} транзакций отклонены")
+
+
+async def get_transactions(chain: str, address: str, from_block: int, to_block: int,
+                           predicate: Optional[Callable[[dict], bool]] = None,
+                           missing: Optional[List[int]] = None,
+                           rpc: Optional['AsyncRPC'] = None,
+                           dropped: Optional[List[dict]] = None) -> List[dict]:
+    """
+    Получить транзакции для указанного адреса в диапазоне блоков.
+
+    Args:
+        chain: Идентификатор сети (ethereum, bsc и т.д.)
+        address: Адрес кошелька для отслеживания
+        from_block: Начальный блок (не включительно)
+        to_block: Конечный блок (включительно)
+        predicate: Фильтр из compile_tx_filter; отброшенные транзакции не возвращаются
+        missing: Сюда добавляются номера блоков, которые не удалось получить
+        rpc: Открытый клиент цепи; без него открывается свой на время вызова
+        dropped: Сюда попадают совпавшие транзакции, скрытые FAILED_TX_MODE=suppress
+            или фильтром (filtered=True) - чтобы закрыть их pending-уведомления
+
+    Returns:
+        Список транзакций с полями: hash, from, to, value, block, timestamp, type, token, token_type, failed
+    """
+    txs = []
+    addr_lower = address.lower()
+    config = RPC_CONFIGS.get(chain, {})
+
+    logger.debug(f"Поиск транзакций для {address[:10]}... на {chain} (блоки {from_block+1}-{to_block})")
+
+    async with (nullcontext(rpc) if rpc else AsyncRPC(chain)) as rpc:
+        for block_num in range(from_block + 1, to_block + 1):
+            block = await rpc.get_block(block_num)
+
+            if not block or 'transactions' not in block:
+                logger.debug(f"Блок {block_num} на {chain}: не получен")
+                if missing is not None:
+                    missing.append(block_num)
+                continue
+
+            match_started = time.perf_counter()
+            try:
+                block_ts = int(block.get('timestamp', '0x0'), 16) * 1000
+            except (ValueError, TypeError):
+                block_ts = 0
+            for tx in block.get('transactions', []):
+                    if not isinstance(tx, dict):
+                        logger.debug(f"Блок {block_num}: транзакция не является dict")
+                        continue
+
+                    tx_hash = tx.get('hash', '')
+                    tx_from = tx.get('from', '')
+                    tx_to = tx.get('to')  # может быть None для contract creation
+
+                    # Нормализуем адреса для сравнения
+                    tx_from_lower = tx_from.lower() if tx_from else ''
+                    tx_to_lower = tx_to.lower() if tx_to else ''
+
+                    # Перевод ERC-20: получатель и сумма в input, tx.to - контракт токена
+                    transfer = decode_token_transfer(tx) if tx_to_lower else None
+                    if transfer:
+                        token_from, token_to, raw_value = transfer
+                        if token_from == addr_lower or token_to == addr_lower:
+                            txs.append({
+                                'hash': tx_hash,
+                                'from': token_from,
+                                'to': token_to,
+                                'value': 0,
+                                'raw_value': raw_value,
+                                'block': block_num,
+                                'timestamp': block_ts,
+                                'type': 'out' if token_from == addr_lower else 'in',
+                                'token': None,
+                                'token_address': tx_to_lower,
+                                'token_type': 'ERC20'
+                            })
+                            continue
+
+                    is_outgoing = tx_from_lower == addr_lower
+                    is_incoming = tx_to_lower == addr_lower
+
+                    if is_outgoing or is_incoming:
+                        tx_type = 'out' if is_outgoing else 'in'
 
                         try:
                             value_hex = tx.get('value', '0x0')
@@ -375,12 +1813,48 @@ async def get_transactions(chain: str, address: str, from_block: int, to_block:
                             'to': tx_to_lower,
                             'value': value,
                             'block': block_num,
-                            'type': tx_type
+                            'timestamp': block_ts,
+                            'type': tx_type,
+                            'token': config.get('symbol', '?'),
+                            'token_type': 'native'
                         })
+            timers.add('match', time.perf_counter() - match_started)
 
             if block_num % 5 == 0:
                 await asyncio.sleep(0.1)
 
+        # Статусы квитанций одним заходом на все совпавшие транзакции
+        if txs:
+            await apply_receipt_statuses(rpc, txs)
+
+        # Метаданные токенов подгружаются одним batch-запросом до форматирования
+        token_txs = [tx for tx in txs if tx['token_type'] == 'ERC20']
+        if token_txs:
+            await token_registry.resolve(rpc, {tx['token_address'] for tx in token_txs})
+            for tx in token_txs:
+                apply_token_meta(chain, tx)
+
+        if txs and FAILED_TX_MODE == 'suppress':
+            if dropped is not None:
+                dropped.extend(tx for tx in txs if tx['failed'])
+            txs = [tx for tx in txs if not tx['failed']]
+
+    # В историю - все транзакции кошелька, фильтры влияют только на уведомления
+    tx_history.add(chain, addr_lower, txs)
+
+    if predicate and txs:
+        matched = len(txs)
+        kept = []
+        for tx in txs:
+            if predicate(tx):
+                kept.append(tx)
+            elif dropped is not None:
+                tx['filtered'] = True
+                dropped.append(tx)
+        txs = kept
+        if len(txs) != matched:
+            logger.debug(f"После фильтрации: {len(txs)} из {matched} транзакций для {address[:10]}...")
+
     if txs:
         in_count = sum(1 for t in txs if t['type'] == 'in')
         out_count = sum(1 for t in txs if t['type'] == 'out')
@@ -392,6 +1866,212 @@ async def get_transactions(chain: str, address: str, from_block: int, to_block:
     return txs
 
 
+# ==================== ИМПОРТ / ЭКСПОРТ ====================
+def parse_import_document(text: str) -> Tuple[List[Tuple[int, str, str]], List[Tuple[int, str, str]]]:
+    """
+    Разобрать документ со строками `цепь,адрес`.
+
+    Returns:
+        (принятые [(номер строки, цепь, адрес)], отклоненные [(номер строки, строка, причина)])
+    """
+    accepted = []
+    rejected = []
+    seen = set()
+
+    for line_no, raw in enumerate(text.splitlines(), start=1):
+        line = raw.strip()
+        if not line or line.startswith('#'):
+            continue
+
+        parts = [p.strip() for p in line.replace(';', ',').replace('\t', ',').split(',') if p.strip()]
+        if len(parts) == 1 and ' ' in line:
+            parts = line.split()
+
+        if len(parts) < 2:
+            rejected.append((line_no, line, "ожидается `цепь,адрес`"))
+            continue
+
+        # Лишние колонки (файл из /export) игнорируются
+        chain, address = parts[0].lower(), parts[1]
+        if line_no == 1 and chain == 'chain':
+            continue  # заголовок CSV
+        if chain not in RPC_CONFIGS:
+            rejected.append((line_no, line, "неподдерживаемая цепь"))
+            continue
+        if not validate_evm(address):
+            rejected.append((line_no, line, "неверный EVM адрес"))
+            continue
+        # Тот же адрес с другой цепью - допустим, такие строки сливаются в одну запись
+        if (chain, address.lower()) in seen:
+            rejected.append((line_no, line, "повтор в файле"))
+            continue
+
+        seen.add((chain, address.lower()))
+        accepted.append((line_no, chain, address))
+
+    return accepted, rejected
+
+
+async def fetch_heads(chains: List[str]) -> dict:
+    """Текущий блок для каждой цепи (один запрос на цепь)"""
+    async def head(chain: str) -> int:
+        try:
+            async with AsyncRPC(chain) as rpc:
+                return await rpc.get_block_number()
+        except Exception as e:
+            logger.error(f"Ошибка получения блока {chain}: {e}")
+            return 0
+
+    results = await asyncio.gather(*(head(chain) for chain in chains))
+    return dict(zip(chains, results))
+
+
+def export_wallets_csv(chat_id: int) -> bytes:
+    """CSV со всеми подписками чата"""
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(['chain', 'address', 'last_block', 'notify_incoming', 'notify_outgoing'])
+    for addr, data in get_all_wallets(chat_id):
+        for chain in data.chains():
+            writer.writerow([
+                chain, addr, data.cursor(chain),
+                int(data.get('notify_incoming', True)), int(data.get('notify_outgoing', True))
+            ])
+    return buf.getvalue().encode('utf-8')
+
+
+EXPORT_COLUMNS = ['time_utc', 'chain', 'address', 'type', 'counterparty', 'value', 'token', 'hash', 'block', 'failed']
+
+
+async def export_rows(chain: str, address: str, since_ms: int, until_ms: int):
+    """Async-генератор строк CSV из архива транзакций"""
+    async for timestamp, tx_hash, tx_type, block, counterparty, value, token, failed in \
+            tx_history.iter_range(chain, address, since_ms, until_ms):
+        when = datetime.fromtimestamp(timestamp / 1000, timezone.utc).strftime('%Y-%m-%d %H:%M:%S') if timestamp else ''
+        yield [when, chain, address, tx_type, counterparty, repr(value), token, tx_hash, block, failed]
+
+
+async def export_documents(rows, basename: str):
+    """
+    Записать строки в gzip-CSV во временные файлы.
+
+    Async-генератор путей готовых частей: часть закрывается, как только сжатый
+    размер доходит до EXPORT_PART_BYTES, поэтому в памяти - только буферы
+    сжатия, сколько бы ни было строк. Удалять файлы - забота вызывающего.
+    """
+    part = 0
+    raw = text = writer = path = None
+    async for row in rows:
+        if text is None:
+            part += 1
+            fd, path = tempfile.mkstemp(prefix=f"{basename}_{part}_", suffix=".csv.gz")
+            raw = os.fdopen(fd, 'wb')
+            text = io.TextIOWrapper(gzip.GzipFile(fileobj=raw, mode='wb'), encoding='utf-8', newline='')
+            writer = csv.writer(text)
+            writer.writerow(EXPORT_COLUMNS)
+
+        writer.writerow(row)
+        if raw.tell() >= EXPORT_PART_BYTES:
+            text.close()
+            raw.close()
+            text = None
+            yield path
+
+    if text is not None:
+        text.close()
+        raw.close()
+        yield path
+
+
+def parse_export_date(value: str, end_of_day: bool = False) -> int:
+    """YYYY-MM-DD (UTC) -> миллисекунды; для конца периода - последняя миллисекунда дня"""
+    day = datetime.strptime(value, '%Y-%m-%d').replace(tzinfo=timezone.utc)
+    return int(day.timestamp() * 1000) + (86400 * 1000 - 1 if end_of_day else 0)
+
+
+# ==================== БАЛАНСЫ ====================
+ERC20_BALANCE_OF = '0x70a08231'
+
+# (chain, адрес) -> [(символ, сумма)]; повторные нажатия "Обновить" в пределах TTL не идут в сеть
+balance_cache = TTLCache(maxsize=2000, ttl=BALANCE_CACHE_TTL)
+
+
+async def chain_balances(chain: str, address: str) -> Optional[List[Tuple[str, float]]]:
+    """Нативный баланс и балансы известных токенов одной цепи одним batch-запросом; None - нет ответа"""
+    key = (chain, address)
+    cached = balance_cache.get(key)
+    if cached is not None:
+        return cached
+
+    config = RPC_CONFIGS[chain]
+    tokens = list(KNOWN_TOKENS.get(chain, {}).values())
+    contracts = list(KNOWN_TOKENS.get(chain, {}))
+    owner = address[2:].lower().rjust(64, '0')
+    calls = [("eth_getBalance", [address, "latest"])] + [
+        ("eth_call", [{"to": contract, "data": ERC20_BALANCE_OF + owner}, "latest"]) for contract in contracts
+    ]
+
+    async with AsyncRPC(chain) as rpc:
+        results = await rpc.batch_request(calls)
+
+    native = decode_abi_uint(results[0])
+    if native is None:
+        return None
+
+    balances = [(config['symbol'], native / (10 ** config['decimals']))]
+    for (symbol, decimals), result in zip(tokens, results[1:]):
+        amount = decode_abi_uint(result)
+        if amount:
+            balances.append((symbol, amount / (10 ** decimals)))
+
+    balance_cache[key] = balances
+    return balances
+
+
+async def all_balances(address: str) -> dict:
+    """
+    Балансы адреса во всех цепях параллельно.
+
+    У каждой цепи свой срок BALANCE_CHAIN_TIMEOUT; не успевшие цепи
+    возвращаются как None, остальные показываются как есть.
+    """
+    async def fetch(chain: str):
+        try:
+            return chain, await asyncio.wait_for(chain_balances(chain, address), BALANCE_CHAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.debug(f"Баланс {format_addr(address)} на {chain}: таймаут")
+        except Exception as e:
+            logger.error(f"Баланс {format_addr(address)} на {chain}: {e}")
+        return chain, None
+
+    return dict(await asyncio.gather(*(fetch(chain) for chain in RPC_CONFIGS)))
+
+
+async def balance_view(idx: int, addr: str) -> Tuple[str, InlineKeyboardMarkup]:
+    balances = await all_balances(addr)
+
+    text = f"💰 *Балансы кошелька #{idx + 1}* `{format_addr(addr)}`\n\n"
+    empty = []
+    failed = []
+    for chain, items in balances.items():
+        config = RPC_CONFIGS[chain]
+        if items is None:
+            failed.append(config['name'])
+        elif any(amount for _, amount in items):
+            text += f"{config['color']} *{config['name']}*: " + ", ".join(
+                f"{amount:.4f} {symbol}" for symbol, amount in items if amount
+            ) + "\n"
+        else:
+            empty.append(config['name'])
+
+    if empty:
+        text += f"\n▫️ Пусто: {', '.join(empty)}"
+    if failed:
+        text += f"\n⏱ Нет ответа: {', '.join(failed)}"
+
+    return text, get_inline_keyboard([("🔄 Обновить", f"balance_{idx}")])
+
+
 # ==================== ФОРМАТИРОВАНИЕ СООБЩЕНИЙ ====================
 def format_tx_message(chain: str, tx: dict, address: str) -> str:
     config = RPC_CONFIGS[chain]
@@ -399,11 +2079,12 @@ def format_tx_message(chain: str, tx: dict, address: str) -> str:
     addr_short = format_addr(address)
     tx_hash_short = tx['hash'][:10] + '...' if len(tx['hash']) > 10 else tx['hash']
 
+    amount = f"{tx['value']:.4f} {tx.get('token') or config['symbol']}"
     if tx['type'] == 'in':
-        action = f"📥 Получено {tx['value']:.4f} {config['symbol']}"
+        action = f"❌ Не получено {amount} (транзакция отклонена)" if tx.get('failed') else f"📥 Получено {amount}"
         from_to = f"От: `{format_addr(tx['from'])}`"
     else:
-        action = f"📤 Отправлено {tx['value']:.4f} {config['symbol']}"
+        action = f"❌ Не отправлено {amount} (транзакция отклонена)" if tx.get('failed') else f"📤 Отправлено {amount}"
         from_to = f"Кому: `{format_addr(tx['to'])}`"
 
     return (
@@ -413,6 +2094,23 @@ def format_tx_message(chain: str, tx: dict, address: str) -> str:
         f"{from_to}\n"
         f"🔗 [Посмотреть транзакцию]({explorer}{tx['hash']})\n"
         f"⏱ Блок #{tx['block']}"
+        + ("\n🕓 С задержкой: блок был недоступен" if tx.get('delayed') else "")
+    )
+
+
+def format_pending_message(chain: str, tx: dict, address: str, expired: bool = False) -> str:
+    config = RPC_CONFIGS[chain]
+    if expired:
+        header = "⌛ *Не подтверждена*\nЗа час не попала в блок: выпала из mempool или заменена\n"
+    else:
+        header = "⏳ *Ожидает подтверждения*\n"
+    return (
+        header +
+        f"{config['color']} *{config['name']}*\n"
+        f"👤 Кошелек: `{format_addr(address)}`\n"
+        f"📥 Входящий перевод {tx['value']:.4f} {tx.get('token') or config['symbol']}\n"
+        f"От: `{format_addr(tx['from'])}`\n"
+        f"🔗 [Посмотреть транзакцию]({config['explorer']}{tx['hash']})"
     )
 
 
@@ -422,7 +2120,7 @@ def format_tx_message(chain: str, tx: dict, address: str) -> str:
 async def start(message: Message):
     chat_id = message.chat.id
     if chat_id not in user_subs:
-        user_subs[chat_id] = {}
+        user_subs[chat_id] = WalletMap()
         save_data()
 
     text = (
@@ -432,10 +2130,15 @@ async def start(message: Message):
         "• Avalanche, Base, Fantom, Gnosis, Celo, Moonbeam\n"
         "• Hyperliquid\n\n"
         "*Команды:*\n"
-        "/track <цепь> <адрес> - Добавить кошелек\n"
+        "/track <цепь|all> <адрес> - Добавить кошелек (цепи через запятую или все)\n"
         "/list - Показать кошельки\n"
         "/remove <номер> - Удалить кошелек\n"
         "/filter <номер> - Фильтр уведомлений (входящие/исходящие)\n"
+        "/import - Импорт кошельков из файла\n"
+        "/export - Экспорт кошельков в файл\n"
+        "/balance <номер> - Балансы кошелька во всех цепях\n"
+        "/history <номер> - История транзакций кошелька\n"
+        "/export_txs <номер> [с] [по] - Выгрузка транзакций в CSV\n"
         "/chains - Список цепей\n"
         "/help - Показать помощь"
     )
@@ -458,13 +2161,17 @@ async def track(message: Message):
     args = message.text.split()[1:] if len(message.text.split()) > 1 else []
 
     if len(args) < 2:
-        await message.reply("Использование: /track <цепь> <адрес>\nПример: /track ethereum 0x...")
+        await message.reply(
+            "Использование: /track <цепь|цепь1,цепь2|all> <адрес>\n"
+            "Пример: /track ethereum 0x...\n"
+            "Пример: /track all 0x..."
+        )
         return
 
-    chain = args[0].lower()
+    chains = parse_chains(args[0])
     address = args[1]
 
-    if chain not in RPC_CONFIGS:
+    if not chains:
         await message.reply(f"❌ Неподдерживаемая цепь. Используйте /chains для списка.")
         return
 
@@ -476,34 +2183,33 @@ async def track(message: Message):
     chat_id = message.chat.id
 
     if chat_id not in user_subs:
-        user_subs[chat_id] = {}
-
-    if address in user_subs[chat_id]:
-        await message.reply("❌ Кошелек уже отслеживается")
-        return
+        user_subs[chat_id] = WalletMap()
+
+    # Адрес, который уже отслеживается, получает новые цепи в ту же запись
+    data = user_subs[chat_id].get(address)
+    if data:
+        chains = [chain for chain in chains if chain not in data.chains()]
+        if not chains:
+            await message.reply("❌ Кошелек уже отслеживается")
+            return
 
-    try:
-        async with AsyncRPC(chain) as rpc:
-            current_block = await rpc.get_block_number()
-    except Exception as e:
-        logger.error(f"Ошибка получения блока: {e}")
-        current_block = 0
-
-    user_subs[chat_id][address] = {
-        'chain': chain,
-        'last_block': current_block,
-        'added_at': time.time(),
-        'notify_incoming': True,
-        'notify_outgoing': True,
-    }
+    heads = await fetch_heads(chains)
+    if data is None:
+        data = user_subs[chat_id][address] = make_wallet_data(chains[0], heads.get(chains[0], 0))
+    for chain in chains:
+        data.add_chain(chain, heads.get(chain, 0))
     save_data()
 
-    config = RPC_CONFIGS[chain]
+    if len(chains) == 1:
+        config = RPC_CONFIGS[chains[0]]
+        chain_info = f"Цепь: {config['color']} {config['name']}\nОтслеживание с блока #{heads.get(chains[0], 0)}"
+    else:
+        chain_info = "Цепи: " + ", ".join(f"{RPC_CONFIGS[c]['color']} {RPC_CONFIGS[c]['name']}" for c in chains)
+
     await message.reply(
         f"✅ *Кошелек добавлен*\n"
-        f"Цепь: {config['color']} {config['name']}\n"
+        f"{chain_info}\n"
         f"Адрес: `{address}`\n\n"
-        f"Отслеживание с блока #{current_block}\n"
         f"Уведомления: 📥 Входящие ✅ | 📤 Исходящие ✅",
         parse_mode='Markdown'
     )
@@ -566,8 +2272,9 @@ async def filter_wallet(message: Message):
 
     if not args:
         await message.reply(
-            "Использование: /filter <номер>\n"
+            "Использование: /filter <номер> [min|tokens|allow|deny|unlist|reset ...]\n"
             "Пример: /filter 1\n"
+            "Пример: /filter 1 min USDT 100\n"
             "Используйте /list для просмотра номеров кошельков"
         )
         return
@@ -586,27 +2293,239 @@ async def filter_wallet(message: Message):
         return
 
     addr, data = wallets[idx]
-    display_name, addr_short = wallet_display(addr, data)
 
-    notify_incoming = data.get('notify_incoming', True)
-    notify_outgoing = data.get('notify_outgoing', True)
+    if len(args) > 1:
+        ok, result = apply_filter_command(data, args[1].lower(), args[2:])
+        if not ok:
+            await message.reply(f"❌ {result}")
+            return
+        save_data()
+        await message.reply(f"✅ {result}")
 
-    in_icon = "✅" if notify_incoming else "❌"
-    out_icon = "✅" if notify_outgoing else "❌"
+    text, keyboard = filter_settings_view(idx, addr, data)
+    await message.reply(text, parse_mode='Markdown', reply_markup=keyboard)
 
-    keyboard = get_inline_keyboard([
-        (f"📥 Входящие {in_icon}", f"toggle_in_{idx}"),
-        (f"📤 Исходящие {out_icon}", f"toggle_out_{idx}"),
-    ], row_width=2)
 
-    await message.reply(
-        f"⚙️ *Настройки уведомлений*\n"
-        f"Кошелек #{idx + 1}: {display_name} `{addr_short}`\n\n"
-        f"📥 Входящие транзакции: {in_icon}\n"
-        f"📤 Исходящие транзакции: {out_icon}",
-        parse_mode='Markdown',
-        reply_markup=keyboard
+@dp.message(Command("import"))
+async def import_wallets(message: Message):
+    document = message.document
+    if not document and message.reply_to_message:
+        document = message.reply_to_message.document
+
+    if not document:
+        await message.reply(
+            "Использование: отправьте CSV/TXT файл с подписью /import\n"
+            "или ответьте /import на сообщение с файлом.\n\n"
+            "Формат строк: `цепь,адрес`\n"
+            "Пример: `ethereum,0x...`",
+            parse_mode='Markdown'
+        )
+        return
+
+    if document.file_size and document.file_size > IMPORT_MAX_BYTES:
+        await message.reply(f"❌ Файл слишком большой (максимум {IMPORT_MAX_BYTES // 1024} КБ)")
+        return
+
+    try:
+        content = await bot.download(document)
+        text = content.read().decode('utf-8-sig', errors='replace')
+    except Exception as e:
+        logger.error(f"Ошибка загрузки файла импорта: {e}")
+        await message.reply("❌ Не удалось загрузить файл")
+        return
+
+    accepted, rejected = parse_import_document(text)
+    if len(accepted) + len(rejected) > IMPORT_MAX_LINES:
+        await message.reply(f"❌ Слишком много строк (максимум {IMPORT_MAX_LINES})")
+        return
+
+    chat_id = message.chat.id
+    if chat_id not in user_subs:
+        user_subs[chat_id] = WalletMap()
+
+    # Строки с тем же адресом и другой цепью дополняют одну запись
+    new_wallets = []
+    for line_no, chain, address in accepted:
+        data = user_subs[chat_id].get(address)
+        if data and chain in data.chains():
+            rejected.append((line_no, f"{chain},{address}", "уже отслеживается"))
+        else:
+            new_wallets.append((chain, address))
+
+    heads = await fetch_heads(sorted({chain for chain, _ in new_wallets}))
+
+    for chain, address in new_wallets:
+        data = user_subs[chat_id].get(address)
+        if data is None:
+            user_subs[chat_id][address] = make_wallet_data(chain, heads.get(chain, 0))
+        else:
+            data.add_chain(chain, heads.get(chain, 0))
+    if new_wallets:
+        save_data()
+
+    logger.info(f"Импорт в чат {chat_id}: {len(new_wallets)} добавлено, {len(rejected)} отклонено")
+
+    msg = (
+        f"📥 *Импорт завершен*\n"
+        f"✅ Добавлено: {len(new_wallets)}\n"
+        f"❌ Отклонено: {len(rejected)}"
     )
+    if rejected:
+        rejected.sort()
+        msg += "\n\n" + "\n".join(f"Строка {n}: {reason}" for n, _, reason in rejected[:10])
+        if len(rejected) > 10:
+            msg += f"\n... и еще {len(rejected) - 10}"
+    await message.reply(msg, parse_mode='Markdown')
+
+
+@dp.message(Command("export"))
+async def export_wallets(message: Message):
+    chat_id = message.chat.id
+    if not get_all_wallets(chat_id):
+        await message.reply("📭 Нет отслеживаемых кошельков. Используйте /track для добавления.")
+        return
+
+    document = BufferedInputFile(export_wallets_csv(chat_id), filename="wallets.csv")
+    await message.reply_document(document, caption="📤 Экспорт кошельков")
+
+
+@dp.message(Command("history"))
+async def history(message: Message):
+    args = message.text.split()[1:]
+    if not args:
+        await message.reply(
+            "Использование: /history <номер> [страница]\n"
+            "Используйте /list для просмотра номеров кошельков"
+        )
+        return
+
+    try:
+        idx = int(args[0]) - 1
+        page = int(args[1]) - 1 if len(args) > 1 else 0
+    except ValueError:
+        await message.reply("❌ Неверный номер. Используйте /list для просмотра номеров")
+        return
+
+    wallets = get_all_wallets(message.chat.id)
+    if idx < 0 or idx >= len(wallets) or page < 0:
+        await message.reply("❌ Неверный номер")
+        return
+
+    addr, data = wallets[idx]
+    text, keyboard = history_view(idx, addr, data.chains(), page)
+    await message.reply(text, parse_mode='Markdown', reply_markup=keyboard, disable_web_page_preview=True)
+
+
+@dp.message(Command("export_txs"))
+async def export_txs(message: Message):
+    args = message.text.split()[1:]
+    if not args:
+        await message.reply(
+            "Использование: /export_txs <номер> [с YYYY-MM-DD] [по YYYY-MM-DD]\n"
+            "Пример: /export_txs 1 2024-01-01 2024-12-31\n"
+            f"В архиве - транзакции за последние {HISTORY_RETENTION_DAYS} дн., "
+            f"не больше {HISTORY_MAX_PER_WALLET} на кошелек в каждой сети\n"
+            "Используйте /list для просмотра номеров кошельков"
+        )
+        return
+
+    try:
+        idx = int(args[0]) - 1
+        since_ms = parse_export_date(args[1]) if len(args) > 1 else 0
+        until_ms = parse_export_date(args[2], end_of_day=True) if len(args) > 2 else int(time.time() * 1000)
+    except ValueError:
+        await message.reply("❌ Неверный номер или дата (формат YYYY-MM-DD)")
+        return
+
+    wallets = get_all_wallets(message.chat.id)
+    if idx < 0 or idx >= len(wallets):
+        await message.reply("❌ Неверный номер")
+        return
+
+    addr, data = wallets[idx]
+    await message.reply("⏳ Готовлю выгрузку...")
+    sent = 0
+    tx_history.holds += 1
+    try:
+        for chain in data.chains():
+            part = 0
+            rows = export_rows(chain, addr, since_ms, until_ms)
+            async for path in export_documents(rows, f"{chain}_{addr[-8:]}"):
+                sent += 1
+                part += 1
+                try:
+                    await message.reply_document(
+                        FSInputFile(path, filename=f"{chain}_{addr}_{part}.csv.gz"),
+                        caption=f"📤 Транзакции `{format_addr(addr)}` ({RPC_CONFIGS[chain]['name']}), часть {part}",
+                        parse_mode='Markdown'
+                    )
+                except Exception as e:
+                    logger.error(f"Ошибка отправки выгрузки в чат {message.chat.id}: {e}")
+                finally:
+                    os.remove(path)
+    finally:
+        tx_history.holds -= 1
+
+    if not sent:
+        await message.reply("📭 За этот период транзакций в архиве нет")
+    # Архив EVM не дозаполняется из сети: все, что старше срока хранения, уже удалено сжатием
+    if since_ms < int((time.time() - HISTORY_RETENTION_DAYS * 86400) * 1000):
+        await message.reply(
+            f"ℹ️ Архив хранит транзакции за последние {HISTORY_RETENTION_DAYS} дн. и не больше "
+            f"{HISTORY_MAX_PER_WALLET} на кошелек в каждой сети: более ранние в выгрузку не попали."
+        )
+
+
+@dp.message(Command("balance"))
+async def balance(message: Message):
+    args = message.text.split()[1:]
+    if not args:
+        await message.reply(
+            "Использование: /balance <номер>\n"
+            "Используйте /list для просмотра номеров кошельков"
+        )
+        return
+
+    try:
+        idx = int(args[0]) - 1
+    except ValueError:
+        await message.reply("❌ Неверный номер. Используйте /list для просмотра номеров")
+        return
+
+    wallets = get_all_wallets(message.chat.id)
+    if idx < 0 or idx >= len(wallets):
+        await message.reply("❌ Неверный номер")
+        return
+
+    addr, _ = wallets[idx]
+    text, keyboard = await balance_view(idx, addr)
+    await message.reply(text, parse_mode='Markdown', reply_markup=keyboard)
+
+
+@dp.message(Command("profile"))
+async def profile(message: Message):
+    """Профилировать живой процесс N секунд (только для ADMIN_IDS)"""
+    if not message.from_user or message.from_user.id not in ADMIN_IDS:
+        return
+
+    parts = message.text.split()
+    try:
+        seconds = int(parts[1]) if len(parts) > 1 else 30
+    except ValueError:
+        await message.reply("❌ Использование: /profile [секунды]")
+        return
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+
+    if profile_lock.locked():
+        await message.reply("⏳ Профилирование уже идет")
+        return
+
+    async with profile_lock:
+        await message.reply(f"⏱ Профилирование {seconds}с...")
+        summary, report = await profile_process(seconds)
+
+    await message.reply(summary, parse_mode='Markdown')
+    await message.reply_document(BufferedInputFile(report.encode(), filename="profile.txt"))
 
 
 @dp.callback_query()
@@ -655,7 +2574,6 @@ async def button_handler(callback: CallbackQuery):
 
         if idx < len(wallets):
             addr, data = wallets[idx]
-            display_name, addr_short = wallet_display(addr, data)
 
             if direction == 'in':
                 data['notify_incoming'] = not data.get('notify_incoming', True)
@@ -664,125 +2582,718 @@ async def button_handler(callback: CallbackQuery):
 
             save_data()
 
-            notify_incoming = data.get('notify_incoming', True)
-            notify_outgoing = data.get('notify_outgoing', True)
-            in_icon = "✅" if notify_incoming else "❌"
-            out_icon = "✅" if notify_outgoing else "❌"
+            text, keyboard = filter_settings_view(idx, addr, data)
+            await callback.message.edit_text(text, parse_mode='Markdown', reply_markup=keyboard)
+
+    elif callback.data.startswith("filter_reset_"):
+        idx = int(callback.data.split("_")[2])
+        chat_id = callback.message.chat.id
+        wallets = get_all_wallets(chat_id)
 
-            keyboard = get_inline_keyboard([
-                (f"📥 Входящие {in_icon}", f"toggle_in_{idx}"),
-                (f"📤 Исходящие {out_icon}", f"toggle_out_{idx}"),
-            ], row_width=2)
+        if idx < len(wallets):
+            addr, data = wallets[idx]
+            apply_filter_command(data, 'reset', [])
+            save_data()
 
+            text, keyboard = filter_settings_view(idx, addr, data)
+            await callback.message.edit_text(text, parse_mode='Markdown', reply_markup=keyboard)
+
+    elif callback.data.startswith("balance_"):
+        idx = int(callback.data.split("_")[1])
+        wallets = get_all_wallets(callback.message.chat.id)
+
+        if idx < len(wallets):
+            addr, _ = wallets[idx]
+            text, keyboard = await balance_view(idx, addr)
+            try:
+                await callback.message.edit_text(text, parse_mode='Markdown', reply_markup=keyboard)
+            except Exception as e:
+                logger.debug(f"Баланс не изменился: {e}")
+
+    elif callback.data.startswith("history_"):
+        _, idx, page = callback.data.split("_")
+        idx, page = int(idx), int(page)
+        wallets = get_all_wallets(callback.message.chat.id)
+
+        if idx < len(wallets):
+            addr, data = wallets[idx]
+            text, keyboard = history_view(idx, addr, data.chains(), page)
             await callback.message.edit_text(
-                f"⚙️ *Настройки уведомлений*\n"
-                f"Кошелек #{idx + 1}: {display_name} `{addr_short}`\n\n"
-                f"📥 Входящие транзакции: {in_icon}\n"
-                f"📤 Исходящие транзакции: {out_icon}",
-                parse_mode='Markdown',
-                reply_markup=keyboard
+                text, parse_mode='Markdown', reply_markup=keyboard, disable_web_page_preview=True
             )
 
 
-# ==================== ФОНОВАЯ ЗАДАЧА ====================
-async def check_transactions():
-    """Фоновая задача для проверки транзакций"""
+# ==================== MEMPOOL ====================
+class MempoolWatcher:
+    """
+    Ожидающие транзакции одной цепи -> уведомления "pending" о входящих переводах.
+
+    Источник - eth_subscribe('newPendingTransactions') по WebSocket (с полными
+    транзакциями, если нода умеет, иначе хеши), без WebSocket - опрос фильтра
+    eth_newPendingTransactionFilter. Все, что сверх MEMPOOL_MAX_TPS транзакций
+    в секунду, отбрасывается до сопоставления: мемпул - ускорение, а не
+    источник истины, транзакция все равно придет из блока.
+    """
+
+    def __init__(self, chain: str, ws_url: Optional[str]):
+        self.chain = chain
+        self.ws_url = ws_url
+        self.throttle = TokenBucket(MEMPOOL_MAX_TPS)
+        self.index = {}  # 20-байтовый ключ адреса -> [(chat_id, адрес, запись)]
+        self.index_built = 0.0
+        self.seen = TTLCache(maxsize=50000, ttl=600)
+        self.dropped = 0
+
+    def watch_index(self) -> dict:
+        """Отслеживаемые адреса цепи; пересобирается не чаще MEMPOOL_INDEX_TTL"""
+        if time.monotonic() - self.index_built > MEMPOOL_INDEX_TTL:
+            chain_id = CHAIN_INDEX[self.chain]
+            index = {}
+            for chat_id, wallets in list(user_subs.items()):
+                for key, record in list(wallets.wallets.items()):
+                    if chain_id in record.chain_ids():
+                        index.setdefault(key, []).append((chat_id, key_address(key), record))
+            self.index = index
+            self.index_built = time.monotonic()
+        return self.index
+
+    def admit(self, tx_hash: str) -> bool:
+        """Новая транзакция в пределах лимита цепи"""
+        if tx_hash in self.seen:
+            return False
+        if not self.throttle.try_acquire():
+            self.dropped += 1
+            return False
+        self.seen[tx_hash] = True
+        return True
+
+    async def feed_txs(self, txs: List[dict], rpc: AsyncRPC):
+        """Полные транзакции из подписки"""
+        await self.match(
+            [tx for tx in txs if isinstance(tx, dict) and self.admit((tx.get('hash') or '').lower())], rpc
+        )
+
+    async def feed_hashes(self, hashes: List[str], rpc: AsyncRPC):
+        """Хеши без тел: тела запрашиваются batch-ом, только для прошедших лимит"""
+        admitted = [h for h in hashes if isinstance(h, str) and self.admit(h.lower())]
+        for i in range(0, len(admitted), RPC_BATCH_SIZE):
+            chunk = admitted[i:i + RPC_BATCH_SIZE]
+            txs = await rpc.batch_request([("eth_getTransactionByHash", [h]) for h in chunk])
+            await self.match([tx for tx in txs if isinstance(tx, dict)], rpc)
+
+    async def match(self, txs: List[dict], rpc: AsyncRPC):
+        """
+        Сопоставить транзакции с индексом и разослать pending-уведомления.
+
+        rpc - сессия источника (одна на подключение), а не новая на каждую пачку.
+        """
+        index = self.watch_index()
+        if not index or not txs:
+            return
+
+        matches = []
+        for tx in txs:
+            record = pending_transfer(self.chain, tx)
+            if not record:
+                continue
+            try:
+                subs = index.get(address_key(record['to']))
+            except ValueError:
+                continue
+            if subs:
+                matches.append((record, subs))
+
+        if not matches:
+            return
+
+        token_txs = [record for record, _ in matches if record['token_type'] == 'ERC20']
+        if token_txs:
+            await token_registry.resolve(rpc, {record['token_address'] for record in token_txs})
+            for record in token_txs:
+                apply_token_meta(self.chain, record)
+
+        for record, subs in matches:
+            for chat_id, address, data in subs:
+                if compile_tx_filter(data)(record):
+                    await send_pending_alert(chat_id, self.chain, record, address)
+
+    async def run(self):
+        logger.info(f"Mempool {self.chain}: {'WebSocket' if self.ws_url else 'фильтр'}, лимит {MEMPOOL_MAX_TPS} tx/с")
+        while True:
+            try:
+                if self.ws_url:
+                    await self.run_ws()
+                else:
+                    await self.run_filter()
+            except Exception as e:
+                logger.error(f"Mempool {self.chain}: {e}")
+            await asyncio.sleep(MEMPOOL_RECONNECT_DELAY)
+
+    async def run_ws(self):
+        async with aiohttp.ClientSession() as session, AsyncRPC(self.chain) as rpc:
+            async with session.ws_connect(self.ws_url, heartbeat=30) as ws:
+                # Сначала просим полные транзакции (geth и совместимые), иначе - только хеши
+                for params in (["newPendingTransactions", True], ["newPendingTransactions"]):
+                    await ws.send_json({"jsonrpc": "2.0", "id": 1, "method": "eth_subscribe", "params": params})
+                    ack = await ws.receive_json(timeout=10)
+                    if 'result' in ack:
+                        break
+                else:
+                    logger.warning(f"Mempool {self.chain}: подписка отклонена: {ack.get('error')}")
+                    return
+
+                hashes = []
+                flushed = time.monotonic()
+                async for msg in ws:
+                    if msg.type != aiohttp.WSMsgType.TEXT:
+                        break
+                    result = json.loads(msg.data).get('params', {}).get('result')
+                    if isinstance(result, dict):
+                        await self.feed_txs([result], rpc)
+                    elif isinstance(result, str):
+                        hashes.append(result)
+                        if time.monotonic() - flushed >= 1 or len(hashes) >= RPC_BATCH_SIZE:
+                            await self.feed_hashes(hashes, rpc)
+                            hashes = []
+                            flushed = time.monotonic()
+                    self.log_dropped()
+
+    async def run_filter(self):
+        """
+        Опрос фильтра ожидающих транзакций.
+
+        Фильтр живет на ноде, которая его создала, поэтому eth_getFilterChanges
+        идет только на этот RPC (request_on), а не по ротации endpoint'ов.
+        """
+        async with AsyncRPC(self.chain) as rpc:
+            filter_id = await rpc.request("eth_newPendingTransactionFilter")
+            if not filter_id:
+                logger.warning(f"Mempool {self.chain}: eth_newPendingTransactionFilter не поддерживается")
+                await asyncio.sleep(MEMPOOL_UNSUPPORTED_RETRY)
+                return
+            filter_rpc = rpc.last_success
+
+            while True:
+                await asyncio.sleep(MEMPOOL_POLL_INTERVAL)
+                hashes = await rpc.request_on(filter_rpc, "eth_getFilterChanges", [filter_id])
+                if hashes is None:
+                    return  # фильтр потерян (нода недоступна или он истек) - создаем заново
+                await self.feed_hashes(hashes, rpc)
+                self.log_dropped()
+
+    def log_dropped(self):
+        if self.dropped >= MEMPOOL_MAX_TPS * 60:
+            logger.warning(f"Mempool {self.chain}: отброшено {self.dropped} tx сверх лимита")
+            self.dropped = 0
+
+
+def pending_transfer(chain: str, tx: dict) -> Optional[dict]:
+    """Ожидающая транзакция -> запись входящего перевода (как в get_transactions) или None"""
+    tx_to = (tx.get('to') or '').lower()
+    if not tx_to:
+        return None
+
+    record = {'hash': tx.get('hash', ''), 'block': None, 'type': 'in'}
+    transfer = decode_token_transfer(tx)
+    if transfer:
+        token_from, token_to, raw_value = transfer
+        record.update({
+            'from': token_from, 'to': token_to, 'value': 0, 'raw_value': raw_value,
+            'token': None, 'token_address': tx_to, 'token_type': 'ERC20'
+        })
+        return record
+
+    config = RPC_CONFIGS[chain]
+    try:
+        value = int(tx.get('value', '0x0'), 16) / (10 ** config['decimals'])
+    except (ValueError, TypeError):
+        return None
+    if not value:
+        return None
+    record.update({
+        'from': (tx.get('from') or '').lower(), 'to': tx_to, 'value': value,
+        'token': config['symbol'], 'token_type': 'native'
+    })
+    return record
+
+
+# (chain, hash, chat_id) -> (message_id, срок, tx, адрес) pending-уведомления; оно правится при
+# включении транзакции в блок, а по истечении срока - помечается неподтвержденным
+pending_alerts = {}
+
+
+async def send_pending_alert(chat_id: int, chain: str, tx: dict, address: str):
+    key = (chain, tx['hash'].lower(), chat_id)
+    if key in pending_alerts:
+        return
+    if len(pending_alerts) >= PENDING_ALERTS_MAX:
+        logger.warning(f"Mempool {chain}: {PENDING_ALERTS_MAX} pending-уведомлений без ответа, новые не отправляются")
+        return
+    try:
+        with timers.stage('deliver'):
+            message = await bot.send_message(
+                chat_id=chat_id, text=format_pending_message(chain, tx, address), parse_mode='Markdown'
+            )
+        pending_alerts[key] = (message.message_id, time.monotonic() + PENDING_ALERT_TTL, tx, address)
+    except Exception as e:
+        logger.error(f"Ошибка отправки pending-уведомления в чат {chat_id}: {e}")
+
+
+async def settle_pending_alert(chat_id: int, chain: str, tx: dict, address: str):
+    """Закрыть pending-уведомление транзакции, о которой отдельного сообщения не будет"""
+    pending = pending_alerts.pop((chain, tx['hash'].lower(), chat_id), None)
+    if pending:
+        text = format_tx_message(chain, tx, address)
+        if tx.get('filtered'):
+            text += "\n🔕 Скрыто фильтром кошелька"
+        await edit_pending_alert(chat_id, pending[0], text)
+
+
+async def expire_pending_alerts():
+    """Фоновая задача: pending-уведомления, не дождавшиеся блока за PENDING_ALERT_TTL, помечаются неподтвержденными"""
     while True:
+        now = time.monotonic()
+        for key, (message_id, expires_at, tx, address) in list(pending_alerts.items()):
+            if expires_at <= now and pending_alerts.pop(key, None):
+                chain, _, chat_id = key
+                await edit_pending_alert(chat_id, message_id, format_pending_message(chain, tx, address, expired=True))
+        await asyncio.sleep(PENDING_SWEEP_INTERVAL)
+
+
+# ==================== ПРОПУЩЕННЫЕ БЛОКИ ====================
+class BlockGaps:
+    """
+    Блоки, которые не удалось получить ни с одного RPC, по цепям.
+
+    Для каждого блока хранятся кошельки, чей диапазон его включал, и число
+    попыток. repair_gaps повторяет блоки с экспоненциальной задержкой и
+    перебором endpoint'ов; очередь сохраняется на диск и переживает перезапуск.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.gaps = {}  # chain -> {блок: [попытки, время следующей попытки, {(chat_id, адрес)}]}
+        self.dirty = False
+
+    def add(self, chain: str, blocks: List[int], chat_id: int, address: str):
+        chain_gaps = self.gaps.setdefault(chain, {})
+        for block_num in blocks:
+            entry = chain_gaps.setdefault(block_num, [0, 0.0, set()])
+            entry[2].add((chat_id, address))
+        self.dirty = True
+        gauges['gap_backlog'] = self.backlog()
+        logger.warning(f"{chain}: блоки {blocks[:5]}{'...' if len(blocks) > 5 else ''} недоступны, отложены в очередь пропусков")
+
+    def due(self, now: float) -> List[Tuple[str, int, int]]:
+        """(цепь, блок, номер попытки) для блоков, которым пора повторить"""
+        return [
+            (chain, block_num, entry[0])
+            for chain, chain_gaps in self.gaps.items()
+            for block_num, entry in sorted(chain_gaps.items())
+            if entry[1] <= now
+        ]
+
+    def waiting(self, chain: str, block_num: int) -> set:
+        """Кошельки, для которых блок еще не проверен"""
+        entry = self.gaps.get(chain, {}).get(block_num)
+        return set(entry[2]) if entry else set()
+
+    def resolve(self, chain: str, block_num: int, wallets: set) -> bool:
+        """Блок проверен для wallets; True - проверен для всех и убран из очереди"""
+        entry = self.gaps.get(chain, {}).get(block_num)
+        if entry:
+            entry[2] -= wallets
+            if entry[2]:
+                return False
+            del self.gaps[chain][block_num]
+            self.dirty = True
+            gauges['gap_backlog'] = self.backlog()
+        return True
+
+    def retry_later(self, chain: str, block_num: int):
+        entry = self.gaps.get(chain, {}).get(block_num)
+        if not entry:
+            return
+        entry[0] += 1
+        if entry[0] >= GAP_MAX_ATTEMPTS:
+            del self.gaps[chain][block_num]
+            gauges['gap_backlog'] = self.backlog()
+            logger.error(f"{chain}: блок {block_num} не получен за {GAP_MAX_ATTEMPTS} попыток, пропущен")
+        else:
+            entry[1] = time.monotonic() + min(GAP_RETRY_MAX, GAP_RETRY_BASE * 2 ** entry[0])
+        self.dirty = True
+
+    def backlog(self) -> int:
+        return sum(len(chain_gaps) for chain_gaps in self.gaps.values())
+
+    def load(self):
         try:
-            total_wallets = sum(len(w) for w in user_subs.values())
-            logger.info(f"🔍 Проверка {total_wallets} кошельков...")
+            if os.path.exists(self.path):
+                with open(self.path, 'rb') as f:
+                    for chain, blocks in pickle.load(f).items():
+                        self.gaps[chain] = {b: [attempts, 0.0, set(subs)] for b, (attempts, subs) in blocks.items()}
+                gauges['gap_backlog'] = self.backlog()
+                logger.info(f"Загружено {self.backlog()} пропущенных блоков")
+        except Exception as e:
+            logger.error(f"Ошибка загрузки очереди пропусков: {e}")
 
-            for chat_id, wallets in list(user_subs.items()):
-                for address, data in list(wallets.items()):
-                    chain = data['chain']
-                    last_block = data['last_block']
-
-                    try:
-                        async with AsyncRPC(chain) as rpc:
-                            current_block = await rpc.get_block_number()
-
-                        if current_block <= last_block:
-                            logger.debug(
-                                f"Кошелек {format_addr(address)} на {chain}: "
-                                f"нет новых блоков (текущий={current_block}, последний={last_block})"
-                            )
-                            continue
+    def save(self):
+        if not self.dirty:
+            return
+        try:
+            with timers.stage('persist'), open(self.path, 'wb') as f:
+                pickle.dump({
+                    chain: {b: (entry[0], entry[2]) for b, entry in blocks.items()}
+                    for chain, blocks in self.gaps.items() if blocks
+                }, f)
+            self.dirty = False
+        except Exception as e:
+            logger.error(f"Ошибка сохранения очереди пропусков: {e}")
 
-                        blocks_to_check = current_block - last_block
-                        logger.debug(
-                            f"Кошелек {format_addr(address)} на {chain}: "
-                            f"проверяем {blocks_to_check} блоков ({last_block+1}-{current_block})"
-                        )
 
-                        txs = await get_transactions(chain, address, last_block, current_block)
+block_gaps = BlockGaps(GAP_FILE)
 
-                        # Обновляем last_block и сохраняем
-                        data['last_block'] = current_block
-                        save_data()
 
-                        if not txs:
+async def repair_gaps():
+    """Фоновая задача: повторно получить пропущенные блоки и отправить найденное с пометкой о задержке"""
+    while True:
+        try:
+            for chain, block_num, attempt in block_gaps.due(time.monotonic()):
+                # Кошелек снимается с блока, только если блок для него действительно проверен
+                done = set()
+                async with AsyncRPC(chain) as rpc:
+                    block = await rpc.get_block_any(block_num, start=attempt)
+
+                    for chat_id, address in block_gaps.waiting(chain, block_num) if block else ():
+                        data = user_subs.get(chat_id, {}).get(address)
+                        if not data or chain not in data.chains():
+                            done.add((chat_id, address))
                             continue
-
-                        # Подсчитываем типы транзакций до фильтрации
-                        in_count = sum(1 for tx in txs if tx['type'] == 'in')
-                        out_count = sum(1 for tx in txs if tx['type'] == 'out')
-                        logger.info(
-                            f"Найдено {len(txs)} транзакций для {format_addr(address)} на {chain}: "
-                            f"{in_count} входящих, {out_count} исходящих"
+                        # Блок обычно еще в кэше rpc_cache.blocks; если нет - запрашивается заново
+                        missing = []
+                        dropped = []
+                        txs = await get_transactions(
+                            chain, address, block_num - 1, block_num, compile_tx_filter(data), missing, rpc, dropped
                         )
+                        if missing:
+                            continue
+                        done.add((chat_id, address))
+                        if txs or dropped:
+                            for tx in txs:
+                                tx['delayed'] = True
+                            await notify_chat(chat_id, chain, address, txs, dropped)
+
+                if not block_gaps.resolve(chain, block_num, done):
+                    block_gaps.retry_later(chain, block_num)
+                    continue
+
+                logger.info(f"{chain}: пропущенный блок {block_num} получен с попытки {attempt + 1}")
+
+            block_gaps.save()
+        except Exception as e:
+            logger.error(f"Ошибка восстановления пропущенных блоков: {e}")
+
+        await asyncio.sleep(GAP_REPAIR_INTERVAL)
+
+
+# ==================== ФОНОВАЯ ЗАДАЧА ====================
+async def notify_chat(chat_id: int, chain: str, address: str, txs: List[dict], dropped: List[dict] = ()):
+    """
+    Отправить уведомления (максимум 5 последних).
+
+    Pending-уведомления закрываются для всех транзакций: и не попавших в
+    последние 5, и скрытых (dropped из get_transactions).
+    """
+    for tx in txs[:-5] + list(dropped):
+        await settle_pending_alert(chat_id, chain, tx, address)
+
+    for tx in txs[-5:]:
+        msg = format_tx_message(chain, tx, address)
+        try:
+            pending = pending_alerts.pop((chain, tx['hash'].lower(), chat_id), None)
+            with timers.stage('deliver'):
+                if not pending or not await edit_pending_alert(chat_id, pending[0], msg):
+                    await bot.send_message(chat_id=chat_id, text=msg, parse_mode='Markdown')
+            logger.debug(
+                f"Отправлено уведомление о {tx['type']} транзакции "
+                f"на {tx['value']:.6f} в чат {chat_id}"
+            )
+            await asyncio.sleep(0.5)
+        except Exception as e:
+            logger.error(f"Ошибка отправки сообщения в чат {chat_id}: {e}")
+
+
+async def edit_pending_alert(chat_id: int, message_id: int, text: str) -> bool:
+    """Заменить pending-уведомление итоговым; False - сообщение уже не отредактировать"""
+    try:
+        await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text, parse_mode='Markdown')
+        return True
+    except Exception as e:
+        logger.debug(f"Не удалось обновить pending-уведомление в чате {chat_id}: {e}")
+        return False
+
+
+async def notify_text(chat_id: int, text: str):
+    try:
+        await bot.send_message(chat_id=chat_id, text=text, parse_mode='Markdown')
+    except Exception as e:
+        logger.error(f"Ошибка отправки сообщения в чат {chat_id}: {e}")
+
+
+def chat_lagging(chat_id: int, chain: str) -> bool:
+    """
+    Идет ли эпизод отставания цепи в чате.
+
+    Эпизод - пока очередь догона цепи не пуста хотя бы у одного кошелька
+    чата: предупреждение и сообщение о восстановлении отправляются одно на
+    (чат, цепь), а не на каждый кошелек.
+    """
+    return any((data.get('repair') or {}).get(chain) for data in user_subs.get(chat_id, {}).values())
+
+
+def format_wallet_list(addresses: List[str], limit: int = 3) -> str:
+    shown = ", ".join(f"`{format_addr(address)}`" for address in addresses[:limit])
+    return shown + (f" и еще {len(addresses) - limit}" if len(addresses) > limit else "")
+
+
+def defer_to_repair(address: str, data: dict, chain: str, from_block: int, to_block: int):
+    """Отложить блоки (from_block, to_block] цепи chain в очередь догона кошелька"""
+    repairs = data.setdefault('repair', {})
+    repair = repairs.setdefault(chain, [])
+    if repair and repair[-1][1] >= from_block:
+        repair[-1][1] = max(repair[-1][1], to_block)
+    else:
+        repair.append([from_block, to_block])
+
+    logger.warning(
+        f"{format_addr(address)} на {chain}: отставание {to_block - from_block} блоков "
+        f"больше SLO, блоки {from_block + 1}-{to_block} отложены в догон"
+    )
+
+
+async def notify_lag(chat_id: int, chain: str, addresses: List[str], live_from: int):
+    """Одно предупреждение на начало эпизода отставания цепи в чате"""
+    await notify_text(
+        chat_id,
+        f"⚠️ *{RPC_CONFIGS[chain]['name']}*: RPC не успевают за сетью.\n"
+        f"Кошельки {format_wallet_list(addresses)}: новые транзакции отслеживаются в реальном времени, "
+        f"блоки до {live_from} будут проверены позже - уведомления о них придут с задержкой."
+    )
+
+
+async def run_repairs(degraded: set):
+    """
+    Очередь догона: отложенные диапазоны проверяются от старых к новым,
+    не больше REPAIR_BLOCKS_PER_CYCLE блоков на цепь за цикл.
+
+    Цепи, которые в этом цикле не уложились в SLO, пропускаются - сначала
+    живые уведомления, догон продолжится, когда появится запас. Прогресс
+    очередей сохраняется один раз в конце прохода.
+    """
+    budgets = {}
+    dirty = False
+    finished = {}  # (чат, цепь) -> кошельки, у которых очередь цепи опустела
+    for chat_id, address, data, chain in iter_wallet_chains():
+        repairs = data.get('repair') or {}
+        repair = repairs.get(chain)
+        if not repair or chain in degraded:
+            continue
+
+        budget = budgets.setdefault(chain, REPAIR_BLOCKS_PER_CYCLE)
+        if budget <= 0:
+            continue
+
+        from_block, to_block = repair[0]
+        chunk_end = min(to_block, from_block + budget)
+        try:
+            missing = []
+            dropped = []
+            txs = await get_transactions(
+                chain, address, from_block, chunk_end, compile_tx_filter(data), missing, dropped=dropped
+            )
+            if missing:
+                block_gaps.add(chain, missing, chat_id, address)
+        except Exception as e:
+            logger.error(f"Ошибка догона {format_addr(address)} на {chain}: {e}")
+            continue
+
+        budgets[chain] = budget - (chunk_end - from_block)
+        if chunk_end >= to_block:
+            repair.pop(0)
+        else:
+            repair[0][0] = chunk_end
+
+        if not repair:
+            del repairs[chain]
+        if not repairs:
+            del data['repair']
+        dirty = True
+
+        if txs or dropped:
+            await notify_chat(chat_id, chain, address, txs, dropped)
+
+        if chain not in repairs:
+            finished.setdefault((chat_id, chain), []).append(address)
+
+    if dirty:
+        save_data()
+
+    for (chat_id, chain), addresses in finished.items():
+        if not chat_lagging(chat_id, chain):
+            await notify_text(
+                chat_id,
+                f"✅ *{RPC_CONFIGS[chain]['name']}*: пропущенные блоки проверены "
+                f"({format_wallet_list(addresses)}), покрытие восстановлено."
+            )
+
+
+async def check_transactions():
+    """Фоновая задача для проверки транзакций"""
+    while True:
+        try:
+            total_wallets = sum(len(w) for w in user_subs.values())
+            logger.info(f"🔍 Проверка {total_wallets} кошельков...")
+            degraded = set()
+
+            # Head и сессия - одни на цепь за цикл, сколько бы кошельков в ней ни было;
+            # курсоры сохраняются одним save_data() на цепь, а не на каждый кошелек
+            for chain, subs in wallets_by_chain().items():
+                config = RPC_CONFIGS[chain]
+                dirty = False
+                # Чаты, где эпизод отставания цепи уже идет, повторно не предупреждаются
+                lagging = {chat_id for chat_id, _, data in subs if (data.get('repair') or {}).get(chain)}
+                deferred = {}
+                try:
+                    async with AsyncRPC(chain) as rpc:
+                        current_block = await rpc.get_block_number()
+
+                        for chat_id, address, data in subs:
+                            last_block = data.cursor(chain)
+                            if current_block <= last_block:
+                                logger.debug(
+                                    f"Кошелек {format_addr(address)} на {chain}: "
+                                    f"нет новых блоков (текущий={current_block}, последний={last_block})"
+                                )
+                                continue
 
-                        # Применяем фильтры уведомлений
-                        notify_incoming = data.get('notify_incoming', True)
-                        notify_outgoing = data.get('notify_outgoing', True)
-
-                        filtered_txs = [
-                            tx for tx in txs
-                            if (tx['type'] == 'in' and notify_incoming) or
-                               (tx['type'] == 'out' and notify_outgoing)
-                        ]
-
-                        if len(filtered_txs) != len(txs):
-                            logger.debug(
-                                f"После фильтрации: {len(filtered_txs)} из {len(txs)} транзакций "
-                                f"(notify_incoming={notify_incoming}, notify_outgoing={notify_outgoing})"
-                            )
-
-                        # Отправляем уведомления (максимум 5 последних)
-                        for tx in filtered_txs[-5:]:
-                            msg = format_tx_message(chain, tx, address)
                             try:
-                                await bot.send_message(chat_id=chat_id, text=msg, parse_mode='Markdown')
+                                # Отставание больше SLO: живой скан только по свежим блокам, остальное - в догон
+                                from_block = last_block
+                                if current_block - last_block > config['lag_slo_blocks']:
+                                    degraded.add(chain)
+                                    from_block = max(last_block, current_block - config['live_window_blocks'])
+                                    if from_block > last_block:
+                                        defer_to_repair(address, data, chain, last_block, from_block)
+                                        deferred.setdefault(chat_id, ([], from_block))[0].append(address)
+
                                 logger.debug(
-                                    f"Отправлено уведомление о {tx['type']} транзакции "
-                                    f"на {tx['value']:.6f} в чат {chat_id}"
+                                    f"Кошелек {format_addr(address)} на {chain}: "
+                                    f"проверяем {current_block - from_block} блоков ({from_block+1}-{current_block})"
                                 )
-                                await asyncio.sleep(0.5)
+
+                                missing = []
+                                dropped = []
+                                txs = await get_transactions(
+                                    chain, address, from_block, current_block, compile_tx_filter(data),
+                                    missing, rpc, dropped
+                                )
+                                if missing:
+                                    block_gaps.add(chain, missing, chat_id, address)
+
+                                # Обновляем курсор цепи; сохранение - после прохода по цепи
+                                data.set_cursor(chain, current_block)
+                                dirty = True
+
+                                if txs or dropped:
+                                    await notify_chat(chat_id, chain, address, txs, dropped)
+
                             except Exception as e:
-                                logger.error(f"Ошибка отправки сообщения в чат {chat_id}: {e}")
+                                logger.error(f"Ошибка проверки {format_addr(address)} на {chain}: {e}")
+
+                except Exception as e:
+                    logger.error(f"Ошибка проверки цепи {chain}: {e}")
 
-                    except Exception as e:
-                        logger.error(f"Ошибка проверки {format_addr(address)} на {chain}: {e}")
+                if dirty:
+                    save_data()
+                for chat_id, (addresses, live_from) in deferred.items():
+                    if chat_id not in lagging:
+                        await notify_lag(chat_id, chain, addresses, live_from)
+                await asyncio.sleep(1)
 
-                    await asyncio.sleep(1)
+            await run_repairs(degraded)
+            block_gaps.save()
 
         except Exception as e:
             logger.error(f"Ошибка в фоновой задаче: {e}")
 
+        log_cycle_stats()
         await asyncio.sleep(30)
 
 
+# ==================== ВЕБХУК ====================
+def build_webhook_app() -> web.Application:
+    """
+    aiohttp-приложение с обработчиком вебхука на WEBHOOK_PATH.
+
+    Запросы без верного секрета получают 401. Для локальной проверки достаточно
+    поднять приложение и отправить POST с JSON апдейта и заголовком секрета.
+    """
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+async def run_webhook():
+    """Поднять сервер вебхука и, если задан WEBHOOK_BASE_URL, зарегистрировать его в Telegram"""
+    if not WEBHOOK_SECRET:
+        raise RuntimeError("Для BOT_MODE=webhook нужен WEBHOOK_SECRET")
+
+    runner = web.AppRunner(build_webhook_app())
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    logger.info(f"Вебхук слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+    if WEBHOOK_BASE_URL:
+        await bot.set_webhook(f"{WEBHOOK_BASE_URL}{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET)
+        logger.info(f"Вебхук зарегистрирован: {WEBHOOK_BASE_URL}{WEBHOOK_PATH}")
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
 # ==================== ЗАПУСК ====================
 async def main():
     load_data()
+    token_registry.load()
+    tx_history.open()
+    block_gaps.load()
 
     asyncio.create_task(check_transactions())
+    asyncio.create_task(compact_history())
+    asyncio.create_task(repair_gaps())
+    if MEMPOOL_CHAINS:
+        asyncio.create_task(expire_pending_alerts())
+    for chain in MEMPOOL_CHAINS:
+        if chain in RPC_CONFIGS:
+            asyncio.create_task(MempoolWatcher(chain, MEMPOOL_WS_URLS.get(chain)).run())
+        else:
+            logger.warning(f"MEMPOOL_CHAINS: неизвестная цепь {chain}")
+    if PROFILING:
+        asyncio.create_task(loop_lag.run())
 
     logger.info(f"🤖 Бот запущен! {len(RPC_CONFIGS)} цепей")
     for chain, config in RPC_CONFIGS.items():
         logger.info(f"  • {chain}: {len(config['all_rpcs'])} RPC endpoints")
 
-    # Запускаем поллинг
-    await dp.start_polling(bot)
+    if BOT_MODE == 'webhook':
+        await run_webhook()
+    else:
+        # Запускаем поллинг; вебхук, оставшийся от другого режима, мешает getUpdates
+        await bot.delete_webhook()
+        await dp.start_polling(bot)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,41 @@
+import os
+import sys
+
+os.environ.setdefault("TELEGRAM_BOT_TOKEN_MAIN", "123456:test")
+os.environ.setdefault("TELEGRAM_BOT_TOKEN_TRON", "123456:test")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+import tron  # noqa: E402
+
+EVM_ADDRESS = "0x" + "ab" * 20
+TRON_ADDRESS = "TR7NHqjeKQxGTCi8q8ZY4pL8otSzgjLj6t"
+
+
+def test_main_export_feeds_import(monkeypatch):
+    wallets = main.WalletMap()
+    wallets[EVM_ADDRESS] = main.make_wallet_data('ethereum', 100)
+    monkeypatch.setitem(main.user_subs, 1, wallets)
+
+    accepted, rejected = main.parse_import_document(main.export_wallets_csv(1).decode('utf-8'))
+
+    assert rejected == []
+    assert [(chain, address) for _, chain, address in accepted] == [('ethereum', EVM_ADDRESS)]
+
+
+def test_tron_export_feeds_import(monkeypatch):
+    monkeypatch.setitem(tron.user_subs, 1, {TRON_ADDRESS: tron.make_wallet_data(TRON_ADDRESS, 0)})
+
+    accepted, rejected = tron.parse_import_document(tron.export_wallets_csv(1).decode('utf-8'))
+
+    assert rejected == []
+    assert [address for _, address in accepted] == [TRON_ADDRESS]
+
+
+def test_main_import_keeps_same_address_on_other_chains():
+    text = f"ethereum,{EVM_ADDRESS}\nbsc,{EVM_ADDRESS.upper().replace('0X', '0x')}\nethereum,{EVM_ADDRESS}\n"
+
+    accepted, rejected = main.parse_import_document(text)
+
+    assert [chain for _, chain, _ in accepted] == ['ethereum', 'bsc']
+    assert [line_no for line_no, _, _ in rejected] == [3]
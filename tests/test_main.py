@@ -0,0 +1,272 @@
+import asyncio
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+os.environ.setdefault("TELEGRAM_BOT_TOKEN_MAIN", "123456:test")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+ADDRESS = "0x" + "ab" * 20
+SENDER = "0x" + "cd" * 20
+
+
+def make_tx(n: int, **fields) -> dict:
+    tx = {
+        'hash': f"0x{n:064x}", 'from': SENDER, 'to': ADDRESS, 'value': 1.0, 'block': 100 + n,
+        'timestamp': 0, 'type': 'in', 'token': 'ETH', 'token_type': 'native',
+    }
+    tx.update(fields)
+    return tx
+
+
+@pytest.fixture
+def telegram(monkeypatch):
+    """Вызовы Bot API без сети: ('send'|'edit', chat_id, message_id, text)"""
+    calls = []
+
+    async def send_message(chat_id, text, **kwargs):
+        calls.append(('send', chat_id, None, text))
+        return SimpleNamespace(message_id=len(calls))
+
+    async def edit_message_text(chat_id, message_id, text, **kwargs):
+        calls.append(('edit', chat_id, message_id, text))
+
+    async def no_sleep(delay):
+        pass
+
+    monkeypatch.setattr(main.bot, 'send_message', send_message)
+    monkeypatch.setattr(main.bot, 'edit_message_text', edit_message_text)
+    monkeypatch.setattr(main.asyncio, 'sleep', no_sleep)
+    monkeypatch.setattr(main, 'pending_alerts', {})
+    return calls
+
+
+def test_pending_alerts_settled_for_every_mined_hash(telegram):
+    txs = [make_tx(n) for n in range(7)]
+    hidden = [make_tx(7, filtered=True), make_tx(8, failed=True)]
+
+    async def scenario():
+        for tx in txs + hidden:
+            await main.send_pending_alert(1, 'ethereum', tx, ADDRESS)
+        telegram.clear()
+        await main.notify_chat(1, 'ethereum', ADDRESS, txs, hidden)
+
+    asyncio.run(scenario())
+
+    assert main.pending_alerts == {}
+    assert [call[0] for call in telegram] == ['edit'] * 9
+    assert "Скрыто фильтром" in telegram[2][3]
+    assert "транзакция отклонена" in telegram[3][3]
+
+
+def test_unconfirmed_pending_alert_expires(telegram, monkeypatch):
+    async def stop(delay):
+        raise asyncio.CancelledError
+
+    async def scenario():
+        await main.send_pending_alert(1, 'ethereum', make_tx(1), ADDRESS)
+        key = next(iter(main.pending_alerts))
+        message_id, _, tx, address = main.pending_alerts[key]
+        main.pending_alerts[key] = (message_id, 0, tx, address)
+        monkeypatch.setattr(main.asyncio, 'sleep', stop)
+        with pytest.raises(asyncio.CancelledError):
+            await main.expire_pending_alerts()
+
+    asyncio.run(scenario())
+
+    assert main.pending_alerts == {}
+    assert telegram[-1][0] == 'edit' and "Не подтверждена" in telegram[-1][3]
+
+
+def test_token_filter_matches_contract_not_symbol():
+    data = main.make_wallet_data('ethereum', 0)
+    assert main.apply_filter_command(data, 'tokens', ['USDT'])[0]
+    assert main.apply_filter_command(data, 'min', ['USDT', '100'])[0]
+    predicate = main.compile_tx_filter(data)
+
+    real = make_tx(1, token='USDT', token_type='ERC20', value=500.0,
+                   token_address='0xdac17f958d2ee523a2206206994597c13d831ec7')
+    fake = make_tx(2, token='USDT', token_type='ERC20', value=500.0, token_address='0x' + '11' * 20)
+
+    assert predicate(real)
+    assert not predicate(fake)
+    assert not predicate(dict(real, value=50.0))
+    assert not main.apply_filter_command(data, 'tokens', ['SPAM'])[0]
+
+
+def test_legacy_symbol_filter_resolves_through_known_tokens():
+    data = main.make_wallet_data('ethereum', 0)
+    data['token_allowlist'] = ['USDT', 'ETH']
+    predicate = main.compile_tx_filter(data)
+
+    assert predicate(make_tx(1))
+    assert not predicate(make_tx(2, token='USDT', token_type='ERC20', token_address='0x' + '11' * 20))
+
+
+def test_run_repairs_saves_and_reports_once_per_pass(telegram, monkeypatch):
+    saves = []
+
+    async def no_transactions(chain, address, from_block, to_block, predicate=None, missing=None, rpc=None,
+                              dropped=None):
+        return []
+
+    wallets = main.WalletMap()
+    for n in range(3):
+        data = main.make_wallet_data('ethereum', 100)
+        data['repair'] = {'ethereum': [[10, 20]]}
+        wallets[f"0x{n:040x}"] = data
+    monkeypatch.setattr(main, 'user_subs', {1: wallets})
+    monkeypatch.setattr(main, 'get_transactions', no_transactions)
+    monkeypatch.setattr(main, 'save_data', lambda: saves.append(1))
+
+    asyncio.run(main.run_repairs(set()))
+
+    assert len(saves) == 1
+    assert all('repair' not in data for data in wallets.values())
+    # Одно сообщение о восстановлении на (чат, цепь), а не на каждый кошелек
+    assert [call[0] for call in telegram] == ['send']
+    assert "покрытие восстановлено" in telegram[0][3] and "и еще" not in telegram[0][3]
+
+
+def test_restore_notice_waits_for_every_wallet_of_chat(telegram, monkeypatch):
+    async def no_transactions(chain, address, from_block, to_block, predicate=None, missing=None, rpc=None,
+                              dropped=None):
+        return []
+
+    wallets = main.WalletMap()
+    done = main.make_wallet_data('ethereum', 100)
+    done['repair'] = {'ethereum': [[10, 20]]}
+    wallets[ADDRESS] = done
+    behind = main.make_wallet_data('ethereum', 100)
+    behind['repair'] = {'ethereum': [[10, 10 + main.REPAIR_BLOCKS_PER_CYCLE * 2]]}
+    wallets[SENDER] = behind
+    monkeypatch.setattr(main, 'user_subs', {1: wallets})
+    monkeypatch.setattr(main, 'get_transactions', no_transactions)
+    monkeypatch.setattr(main, 'save_data', lambda: None)
+
+    asyncio.run(main.run_repairs(set()))
+
+    assert 'repair' not in done and main.chat_lagging(1, 'ethereum')
+    assert telegram == []
+
+
+def test_wallet_map_dump_restore_roundtrip():
+    wallets = main.WalletMap()
+    record = main.make_wallet_data('ethereum', 100)
+    record.add_chain('bsc', 7)
+    record['notify_outgoing'] = False
+    record['token_allowlist'] = ['ETH']
+    wallets[ADDRESS.upper().replace('0X', '0x')] = record
+
+    restored = main.WalletMap.restore(wallets.dump())
+
+    assert list(restored) == [ADDRESS]
+    data = restored[ADDRESS]
+    assert data.chains() == ['ethereum', 'bsc']
+    assert (data.cursor('ethereum'), data.cursor('bsc')) == (100, 7)
+    assert data['notify_incoming'] and not data['notify_outgoing']
+    assert data['token_allowlist'] == ['ETH'] and 'repair' not in data
+
+
+def test_wallet_map_restores_legacy_dict_and_repair_queue():
+    legacy = {ADDRESS: {'chain': 'polygon', 'last_block': 5, 'added_at': 1.0, 'notify_incoming': False,
+                        'repair': [[1, 5]]}}
+
+    data = main.WalletMap.restore(legacy)[ADDRESS]
+
+    assert (data['chain'], data['last_block'], data['notify_incoming']) == ('polygon', 5, False)
+    assert data['repair'] == {'polygon': [[1, 5]]}
+
+
+def test_token_bucket_throttles_and_recovers(monkeypatch):
+    clock = [0.0]
+    monkeypatch.setattr(main.time, 'monotonic', lambda: clock[0])
+    bucket = main.TokenBucket(2)
+
+    assert bucket.try_acquire() and bucket.try_acquire()
+    assert not bucket.try_acquire()
+    assert bucket.delay() == pytest.approx(0.5)
+
+    bucket.on_throttled(retry_after=3)
+    assert bucket.rate == 1 and bucket.delay() == pytest.approx(3)
+    clock[0] += 2.9
+    assert not bucket.try_acquire()
+    clock[0] += 0.1
+    assert bucket.try_acquire()
+
+    for _ in range(30):
+        bucket.on_success()
+    assert bucket.rate == 2
+
+
+@pytest.mark.parametrize('error, expected', [
+    ({'code': -32601, 'message': 'whatever'}, True),
+    ({'code': -32000, 'message': 'the method eth_getBlockReceipts does not exist/is not available'}, True),
+    ({'code': -32000, 'message': 'Method not supported'}, True),
+    ({'code': -32000, 'message': 'block not found'}, False),
+    ({'code': -32000, 'message': 'header not found'}, False),
+    (None, False),
+    ('method not found', False),
+])
+def test_method_unsupported(error, expected):
+    assert main.method_unsupported(error) is expected
+
+
+def test_block_gaps_retry_resolve_and_persist(tmp_path, monkeypatch):
+    monkeypatch.setattr(main.time, 'monotonic', lambda: 1000.0)
+    gaps = main.BlockGaps(str(tmp_path / 'gaps.pkl'))
+    gaps.add('ethereum', [10, 11], 1, ADDRESS)
+    gaps.add('ethereum', [10], 2, SENDER)
+
+    assert gaps.due(0) == [('ethereum', 10, 0), ('ethereum', 11, 0)]
+    assert gaps.waiting('ethereum', 10) == {(1, ADDRESS), (2, SENDER)}
+
+    assert not gaps.resolve('ethereum', 10, {(1, ADDRESS)})
+    gaps.retry_later('ethereum', 10)
+    assert gaps.due(1000) == [('ethereum', 11, 0)]
+    assert gaps.due(1000 + main.GAP_RETRY_BASE * 2) == [('ethereum', 10, 1), ('ethereum', 11, 0)]
+
+    assert gaps.resolve('ethereum', 11, {(1, ADDRESS)})
+    gaps.save()
+    reloaded = main.BlockGaps(gaps.path)
+    reloaded.load()
+    # После перезапуска блок повторяется сразу, счетчик попыток сохранен
+    assert reloaded.due(0) == [('ethereum', 10, 1)]
+    assert reloaded.waiting('ethereum', 10) == {(2, SENDER)}
+
+    for _ in range(main.GAP_MAX_ATTEMPTS):
+        reloaded.retry_later('ethereum', 10)
+    assert reloaded.backlog() == 0
+
+
+def test_mempool_filter_polled_on_the_node_that_created_it(monkeypatch):
+    calls = []
+    orders = iter([['https://a', 'https://b'], ['https://b', 'https://a']] * 10)
+
+    async def send(self, rpc_url, payload):
+        calls.append((rpc_url, payload['method']))
+        if payload['method'] == 'eth_newPendingTransactionFilter':
+            return {'result': '0x1'}
+        if len(calls) > 3:
+            return {'error': {'code': -32000, 'message': 'filter not found'}}
+        return {'result': []}
+
+    async def acquire(rpc_url, max_wait):
+        return True
+
+    async def no_sleep(delay):
+        pass
+
+    monkeypatch.setattr(main.AsyncRPC, '_send', send)
+    monkeypatch.setattr(main.AsyncRPC, '_rpc_order', lambda self: next(orders))
+    monkeypatch.setattr(main.rate_limiter, 'acquire', acquire)
+    monkeypatch.setattr(main.asyncio, 'sleep', no_sleep)
+
+    asyncio.run(main.MempoolWatcher('ethereum', None).run_filter())
+
+    assert calls[0] == ('https://a', 'eth_newPendingTransactionFilter')
+    assert calls[1:] == [('https://a', 'eth_getFilterChanges')] * 3
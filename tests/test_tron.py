@@ -0,0 +1,203 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+os.environ.setdefault("TELEGRAM_BOT_TOKEN_TRON", "123456:test")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tron  # noqa: E402
+
+ADDRESS = "TR7NHqjeKQxGTCi8q8ZY4pL8otSzgjLj6t"
+
+
+@pytest.fixture
+def scheduler(monkeypatch):
+    fresh = tron.PollScheduler(10, 80, 2)
+    monkeypatch.setattr(tron, 'scheduler', fresh)
+    monkeypatch.setattr(tron, 'scan_state', {})
+    monkeypatch.setattr(tron, 'save_state', lambda: None)
+    return fresh
+
+
+def test_failed_fetch_does_not_grow_interval(monkeypatch, scheduler):
+    async def unavailable(self, endpoint, params=None):
+        return None
+
+    monkeypatch.setattr(tron.TronAPI, '_get', unavailable)
+    subscribers = {ADDRESS: [(1, tron.make_wallet_data(ADDRESS, 0))]}
+
+    for _ in range(3):
+        asyncio.run(tron.poll_accounts(subscribers))
+        scheduler.heap.clear()
+        scheduler._schedule(ADDRESS, 0)
+
+    assert scheduler.intervals[ADDRESS] == 10
+    assert tron.scan_state['address_cursors'][ADDRESS] == {}
+
+
+def test_cursor_not_committed_when_dispatch_fails(monkeypatch, scheduler):
+    async def fetched(api, address, cursors, default_since, predicate=None, include_trc20=True):
+        cursors['trx'] = (500, None)
+        return [{'hash': 'aa', 'timestamp': 499}]
+
+    async def failing_dispatch(found, subscribers, advance_cursor=True):
+        raise RuntimeError("telegram down")
+
+    monkeypatch.setattr(tron, 'get_new_transactions', fetched)
+    monkeypatch.setattr(tron, 'dispatch_matches', failing_dispatch)
+    subscribers = {ADDRESS: [(1, tron.make_wallet_data(ADDRESS, 0))]}
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(tron.poll_accounts(subscribers))
+
+    assert tron.scan_state['address_cursors'][ADDRESS] == {}
+    assert ADDRESS in scheduler.due
+
+
+def test_token_filter_matches_contract_not_symbol():
+    data = tron.make_wallet_data(ADDRESS, 0)
+    assert tron.apply_filter_command(data, 'tokens', ['USDT'])[0]
+    predicate = tron.compile_tx_filter(data)
+
+    base = {'hash': 'aa', 'from': ADDRESS, 'to': ADDRESS, 'value': 1.0, 'type': 'in', 'token': 'USDT',
+            'token_type': 'TRC20'}
+    assert predicate(dict(base, token_address='TR7NHqjeKQxGTCi8q8ZY4pL8otSzgjLj6t'))
+    assert not predicate(dict(base, token_address='TEkxiTehnzSmSe2XqrBj4w32RUN966rdz8'))
+
+
+def test_backfill_pages_newest_first_and_reports_truncation(monkeypatch):
+    history = tron.TxHistory(":memory:")
+    history.open()
+    monkeypatch.setattr(tron, 'tx_history', history)
+    orders = []
+
+    async def endless(self, endpoint, params=None):
+        orders.append(params['order_by'])
+        return {'data': [], 'meta': {'fingerprint': 'next'}}
+
+    monkeypatch.setattr(tron.TronAPI, '_get', endless)
+    assert asyncio.run(tron.backfill_history(ADDRESS, 0, 1000)) == (0, True)
+    assert set(orders) == {'block_timestamp,desc'}
+    assert len(orders) == 2 * tron.EXPORT_BACKFILL_PAGES
+
+    async def last_page(self, endpoint, params=None):
+        return {'data': [], 'meta': {}}
+
+    monkeypatch.setattr(tron.TronAPI, '_get', last_page)
+    assert asyncio.run(tron.backfill_history(ADDRESS, 0, 1000)) == (0, False)
+
+
+def test_demoted_endpoint_recovers_over_time(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(tron.time, 'monotonic', lambda: clock[0])
+    health = tron.EndpointHealth(['https://a', 'https://b'], half_life=60)
+
+    health.failure('https://a')
+    health.failure('https://a')
+    assert health.ordered() == ['https://b', 'https://a']
+    assert health.score('https://a') == pytest.approx(0.25)
+
+    clock[0] += 60
+    assert health.score('https://a') == pytest.approx(0.625)
+    clock[0] += 600
+    assert health.score('https://a') > 0.99
+
+    health.failure('https://b')
+    assert health.ordered() == ['https://a', 'https://b']
+
+
+COUNTERPARTY = "TEkxiTehnzSmSe2XqrBj4w32RUN966rdz8"
+
+
+def test_scheduler_backs_off_when_idle_and_resets_on_activity():
+    scheduler = tron.PollScheduler(10, 80, 2)
+    scheduler.sync({ADDRESS}, now=0)
+    assert scheduler.pop_due(0) == [ADDRESS]
+
+    for expected in (20, 40, 80, 80):
+        scheduler.record(ADDRESS, active=False, now=0)
+        assert scheduler.intervals[ADDRESS] == expected
+    assert scheduler.stats() == (0, 1)
+
+    scheduler.retry(ADDRESS, now=100)
+    assert scheduler.intervals[ADDRESS] == 80 and scheduler.due[ADDRESS] == 180
+    scheduler.wake(ADDRESS, now=100)
+    assert scheduler.pop_due(100) == [ADDRESS]
+    # Устаревшая запись кучи на 180 пропускается
+    assert scheduler.pop_due(200) == []
+
+    scheduler.record(ADDRESS, active=True, now=100)
+    assert scheduler.intervals[ADDRESS] == 10
+    scheduler.sync(set(), now=100)
+    assert scheduler.due == {} and scheduler.pop_due(1000) == []
+
+
+def test_dedup_ring_evicts_oldest_per_address():
+    cache = tron.TronCache(os.devnull, per_address=2)
+    hashes = [f"{n:064x}" for n in range(3)]
+    for tx_hash in hashes:
+        cache.mark_tx_processed(ADDRESS, tx_hash)
+    cache.mark_tx_processed(COUNTERPARTY, hashes[0])
+
+    assert not cache.is_tx_processed(ADDRESS, hashes[0])
+    assert cache.is_tx_processed(ADDRESS, hashes[1]) and cache.is_tx_processed(ADDRESS, hashes[2])
+    assert cache.is_tx_processed(COUNTERPARTY, hashes[0])
+    # Повторная отметка не сдвигает кольцо
+    cache.mark_tx_processed(ADDRESS, hashes[1])
+    assert cache.is_tx_processed(ADDRESS, hashes[2])
+
+
+def test_trx_transfer_matches_hex_and_returns_base58_counterparty():
+    watch_hex = tron.address_to_hex(ADDRESS)
+    assert tron.hex_to_address(watch_hex) == ADDRESS
+
+    raw = {
+        'txID': 'aa', 'blockNumber': 5, 'block_timestamp': 1000,
+        'raw_data': {'contract': [{'type': 'TransferContract', 'parameter': {'value': {
+            'owner_address': tron.address_to_hex(COUNTERPARTY).upper(), 'to_address': watch_hex, 'amount': 2_500_000,
+        }}}]},
+    }
+    tx = tron.process_trx_transaction(raw, ADDRESS, watch_hex)
+    assert (tx['type'], tx['from'], tx['to'], tx['value']) == ('in', COUNTERPARTY, ADDRESS, 2.5)
+
+    other = tron.address_to_hex(COUNTERPARTY)
+    assert tron.process_trx_transaction(raw, COUNTERPARTY, other)['type'] == 'out'
+    assert tron.process_trx_transaction(raw, ADDRESS, '41' + '00' * 20) is None
+
+
+def test_stream_resumes_from_fingerprint_after_page_budget(monkeypatch):
+    requests = []
+
+    async def paged(self, endpoint, params=None):
+        requests.append(params.get('fingerprint'))
+        page = len(requests)
+        more = page < tron.ACCOUNT_PAGE_BUDGET + 1
+        return {'data': [{'block_timestamp': 100 + page}], 'meta': {'fingerprint': f"fp{page}"} if more else {}}
+
+    monkeypatch.setattr(tron.TronAPI, '_get', paged)
+    cursors = {}
+
+    asyncio.run(tron.read_account_stream(tron.TronAPI(), ADDRESS, 'trx', cursors, 50))
+    budget = tron.ACCOUNT_PAGE_BUDGET
+    assert cursors['trx'] == (50, f"fp{budget}")
+
+    asyncio.run(tron.read_account_stream(tron.TronAPI(), ADDRESS, 'trx', cursors, 50))
+    assert requests[budget] == f"fp{budget}"
+    assert cursors['trx'] == (100 + budget + 2, None)
+
+
+def test_compaction_waits_for_running_export():
+    history = tron.TxHistory(":memory:")
+    history.open()
+    old = {'hash': 'aa', 'type': 'in', 'from': COUNTERPARTY, 'to': ADDRESS, 'value': 1.0, 'timestamp': 1}
+    history.add('tron', ADDRESS, [old])
+
+    history.holds = 1
+    history.compact()
+    assert history.page('tron', ADDRESS, 0, 10)[1] == 1
+
+    history.holds = 0
+    history.compact()
+    assert history.page('tron', ADDRESS, 0, 10)[1] == 0
@@ -0,0 +1,53 @@
+import asyncio
+import os
+import sys
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+os.environ.setdefault("TELEGRAM_BOT_TOKEN_MAIN", "123456:test")
+os.environ.setdefault("TELEGRAM_BOT_TOKEN_TRON", "123456:test")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+import tron  # noqa: E402
+
+SECRET = "webhook-secret"
+UPDATE = {
+    'update_id': 1,
+    'message': {
+        'message_id': 1, 'date': 0, 'text': '/start',
+        'chat': {'id': 1, 'type': 'private'}, 'from': {'id': 1, 'is_bot': False, 'first_name': 'Test'},
+    },
+}
+
+
+@pytest.mark.parametrize('bot_module', [main, tron], ids=['main', 'tron'])
+def test_webhook_checks_secret_and_dispatches(bot_module, monkeypatch):
+    fed = []
+
+    async def feed_raw_update(bot, update, **kwargs):
+        fed.append(update)
+
+    monkeypatch.setattr(bot_module, 'WEBHOOK_SECRET', SECRET)
+    monkeypatch.setattr(bot_module.dp, 'feed_raw_update', feed_raw_update)
+
+    async def scenario():
+        async with TestClient(TestServer(bot_module.build_webhook_app())) as client:
+            path = bot_module.WEBHOOK_PATH
+            missing = await client.post(path, json=UPDATE)
+            wrong = await client.post(path, json=UPDATE, headers={'X-Telegram-Bot-Api-Secret-Token': 'nope'})
+            assert (missing.status, wrong.status) == (401, 401)
+            assert fed == []
+
+            ok = await client.post(path, json=UPDATE, headers={'X-Telegram-Bot-Api-Secret-Token': SECRET})
+            assert ok.status == 200
+            # Апдейт разбирается в фоне после ответа Telegram
+            for _ in range(10):
+                if fed:
+                    break
+                await asyncio.sleep(0.01)
+
+    asyncio.run(scenario())
+
+    assert fed == [UPDATE]
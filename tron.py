@@ -3,16 +3,33 @@ import logging
 import asyncio
 import time
 import pickle
-from typing import List, Optional, Tuple
-from datetime import datetime
+import sqlite3
+import io
+import csv
+import gzip
+import tempfile
+import json
+import heapq
+import cProfile
+import pstats
+import tracemalloc
+from contextlib import contextmanager
+from collections import deque
+from functools import lru_cache
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+from typing import List, Optional, Tuple, Callable
+from datetime import datetime, timezone
 from dotenv import load_dotenv
 from aiogram import Bot, Dispatcher
 from aiogram.filters import Command
-from aiogram.types import Message, CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup
+from aiogram.types import Message, CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup, BufferedInputFile, FSInputFile
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from cachetools import TTLCache
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from cachetools import TTLCache, LRUCache
 import aiohttp
+from aiohttp import web
 from aiohttp import ClientTimeout
 import base58
 
@@ -20,13 +37,88 @@ import base58
 load_dotenv()
 BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN_TRON")
 DATA_FILE = "tron_data.pkl"
+STATE_FILE = "tron_state.pkl"
+DEDUP_FILE = "tron_dedup.pkl"
+DEDUP_PER_ADDRESS = 512
 REQUEST_TIMEOUT = 30
 RETRY_DELAY = 2
 MAX_RETRIES = 3
 CHECK_INTERVAL = 15
 
 TRON_API_URL = "https://api.trongrid.io"
+# Дополнительные совместимые HTTP API (TronGrid-совместимые ноды) через запятую
+TRON_API_ENDPOINTS = [TRON_API_URL] + [
+    url.strip().rstrip('/') for url in os.getenv("TRON_API_ENDPOINTS", "").split(',')
+    if url.strip() and url.strip().rstrip('/') != TRON_API_URL
+]
+# Пул TRON-PRO-API-KEY через запятую; у каждого ключа свой лимит запросов
+TRON_API_KEYS = [key.strip() for key in os.getenv("TRON_API_KEYS", "").split(',') if key.strip()]
+TRON_KEY_RATE_LIMIT = float(os.getenv("TRON_KEY_RATE_LIMIT", "15"))
+KEY_REJECT_COOLDOWN = 300
+ENDPOINT_RECOVERY_HALF_LIFE = 120  # секунд: штраф endpoint'а за ошибки уменьшается вдвое
 MAX_TRANSACTIONS_PER_CHECK = 50
+ACCOUNT_PAGE_BUDGET = 5  # страниц на поток кошелька за цикл
+# Одновременно опрашиваемых кошельков; 0 - по бюджету запросов API (api_rate_budget)
+TRON_POLL_CONCURRENCY = int(os.getenv("TRON_POLL_CONCURRENCY", "0"))
+# Адаптивный опрос: активные адреса - каждый CHECK_INTERVAL, спящие - реже, вплоть до потолка
+POLL_MAX_INTERVAL = int(os.getenv("TRON_POLL_MAX_INTERVAL", "600"))
+POLL_BACKOFF = 2
+
+# Режим сканирования: 'account' - опрос каждого кошелька, 'block' - чтение всех блоков сети
+TRON_SCAN_MODE = os.getenv("TRON_SCAN_MODE", "account")
+TRON_CONFIRMATIONS = 19
+BLOCK_BATCH_SIZE = 20
+MAX_BLOCKS_PER_CYCLE = 200
+
+# Режим TRC-20 в режиме 'account': 'account' - /transactions/trc20 по каждому кошельку,
+# 'events' - события Transfer выбранных контрактов (один запрос на контракт)
+TRON_TRC20_MODE = os.getenv("TRON_TRC20_MODE", "account")
+TRC20_EVENT_CONTRACTS = [
+    c.strip() for c in os.getenv(
+        "TRC20_EVENT_CONTRACTS", "TR7NHqjeKQxGTCi8q8ZY4pL8otSzgjLj6t,TEkxiTehnzSmSe2XqrBj4w32RUN966rdz8"
+    ).split(',') if c.strip()
+]
+EVENTS_PAGE_SIZE = 200
+MAX_EVENT_PAGES = 10
+IMPORT_MAX_BYTES = 1024 * 1024
+IMPORT_MAX_LINES = 5000
+TOKEN_CACHE_FILE = "tron_token_cache.pkl"
+TOKEN_CACHE_SIZE = 5000
+HISTORY_FILE = "tron_history.db"
+HISTORY_RETENTION_DAYS = int(os.getenv("HISTORY_RETENTION_DAYS", "30"))
+HISTORY_MAX_PER_WALLET = 1000
+HISTORY_COMPACT_INTERVAL = 3600
+HISTORY_PAGE_SIZE = 10
+HISTORY_EXPORT_BATCH = 1000
+EXPORT_PART_BYTES = 45 * 1024 * 1024  # лимит документа Bot API - 50 МБ
+EXPORT_BACKFILL_PAGES = 20  # страниц TronGrid на поток при дозаполнении архива
+
+# Лимиты запросов в секунду по хостам (переопределяются через TRON_RATE_LIMITS="host=rps,...")
+TRON_RATE_LIMITS = {
+    'api.trongrid.io': 3,
+}
+TRON_DEFAULT_RATE_LIMIT = float(os.getenv("TRON_DEFAULT_RATE_LIMIT", "5"))
+RATE_LIMIT_MAX_WAIT = 2
+RATE_LIMIT_QUEUE_TIMEOUT = 15
+
+# Профилирование: PROFILING=1 включает таймеры этапов и монитор event loop;
+# /profile доступна пользователям из ADMIN_IDS (id через запятую)
+PROFILING = os.getenv("PROFILING", "0") == "1"
+ADMIN_IDS = {int(uid) for uid in os.getenv("ADMIN_IDS", "").split(',') if uid.strip().isdigit()}
+LOOP_LAG_INTERVAL = 0.5
+LOOP_LAG_WARNING = 0.5
+PROFILE_MAX_SECONDS = 120
+PROFILE_TOP = 25
+
+# Режим получения апдейтов: 'polling' (по умолчанию) или 'webhook' - встроенный aiohttp-сервер.
+# WEBHOOK_BASE_URL - публичный https-адрес, по нему бот сам вызывает setWebhook;
+# WEBHOOK_SECRET обязателен и сверяется с заголовком X-Telegram-Bot-Api-Secret-Token
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "").rstrip('/')
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT_TRON", "8081"))
+WEBHOOK_PATH = "/webhook/tron"
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -42,17 +134,560 @@ dp = Dispatcher(storage=storage)
 
 # ==================== КЭШ ====================
 class TronCache:
-    def __init__(self):
-        self.tx_cache = TTLCache(maxsize=1000, ttl=3600)
+    """
+    Дедупликация отправленных транзакций.
+
+    Для каждого адреса хранится кольцо последних DEDUP_PER_ADDRESS хешей
+    (deque + set, O(1) на проверку), поэтому память ограничена числом
+    кошельков, а вытеснение у одного активного кошелька не затрагивает остальные.
+    Внутри окна проверка точная (без ложноотрицательных); окно сохраняется
+    на диск и переживает перезапуск.
+    """
+
+    def __init__(self, path: str, per_address: int):
+        self.path = path
+        self.per_address = per_address
+        self.rings = {}  # address -> (deque хешей, set хешей)
+        self.dirty = False
+
+    @staticmethod
+    def _key(tx_hash: str):
+        try:
+            return bytes.fromhex(tx_hash)  # 32 байта вместо 64-символьной строки
+        except ValueError:
+            return tx_hash
+
+    def is_tx_processed(self, address: str, tx_hash: str) -> bool:
+        ring = self.rings.get(address)
+        return ring is not None and self._key(tx_hash) in ring[1]
+
+    def mark_tx_processed(self, address: str, tx_hash: str):
+        ring = self.rings.get(address)
+        if ring is None:
+            ring = self.rings[address] = (deque(maxlen=self.per_address), set())
+        order, seen = ring
+
+        key = self._key(tx_hash)
+        if key in seen:
+            return
+        if len(order) == order.maxlen:
+            seen.discard(order[0])
+        order.append(key)
+        seen.add(key)
+        self.dirty = True
+
+    def load(self):
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, 'rb') as f:
+                    for address, hashes in pickle.load(f).items():
+                        order = deque(hashes, maxlen=self.per_address)
+                        self.rings[address] = (order, set(order))
+                logger.info(f"Загружено {sum(len(r[0]) for r in self.rings.values())} хешей дедупликации")
+        except Exception as e:
+            logger.error(f"Ошибка загрузки кэша дедупликации: {e}")
+
+    def save(self, watched: set):
+        """Сохранить окна; адреса, которые больше не отслеживаются, удаляются"""
+        for address in list(self.rings):
+            if address not in watched:
+                del self.rings[address]
+                self.dirty = True
+        if not self.dirty:
+            return
+
+        try:
+            with timers.stage('persist'), open(self.path, 'wb') as f:
+                pickle.dump({address: list(ring[0]) for address, ring in self.rings.items()}, f)
+            self.dirty = False
+        except Exception as e:
+            logger.error(f"Ошибка сохранения кэша дедупликации: {e}")
+
+
+cache = TronCache(DEDUP_FILE, DEDUP_PER_ADDRESS)
+
+
+# ==================== ПЛАНИРОВЩИК ====================
+class PollScheduler:
+    """
+    Очередь опроса адресов с приоритетом по времени следующей проверки (heapq).
+
+    После пустого опроса интервал адреса растет в backoff раз до max_interval,
+    после любой активности сбрасывается до min_interval. Курсоры потоков
+    сохраняются, поэтому у спящего адреса транзакции не теряются, а только
+    приходят с задержкой не больше текущего интервала.
+    """
+
+    def __init__(self, min_interval: float, max_interval: float, backoff: float):
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.backoff = backoff
+        self.heap = []  # (время проверки, адрес); устаревшие записи пропускаются
+        self.due = {}  # address -> время проверки
+        self.intervals = {}  # address -> текущий интервал
+
+    def _schedule(self, address: str, when: float):
+        self.due[address] = when
+        heapq.heappush(self.heap, (when, address))
+
+    def sync(self, addresses: set, now: float):
+        """Новые адреса - в очередь сразу, удаленные - забыть"""
+        for address in addresses:
+            if address not in self.due:
+                self.intervals[address] = self.min_interval
+                self._schedule(address, now)
+        for address in [a for a in self.due if a not in addresses]:
+            del self.due[address]
+            del self.intervals[address]
+
+    def pop_due(self, now: float) -> List[str]:
+        """Адреса, которым пора на опрос"""
+        ready = []
+        while self.heap and self.heap[0][0] <= now:
+            when, address = heapq.heappop(self.heap)
+            if self.due.get(address) == when:
+                ready.append(address)
+        return ready
+
+    def record(self, address: str, active: bool, now: float):
+        """Запланировать следующий опрос после результата текущего"""
+        if address not in self.intervals:
+            return
+        if active:
+            interval = self.min_interval
+        else:
+            interval = min(self.intervals[address] * self.backoff, self.max_interval)
+        self.intervals[address] = interval
+        self._schedule(address, now + interval)
+
+    def retry(self, address: str, now: float):
+        """Опрос не удался - повторить через текущий интервал, не наращивая его"""
+        if address in self.intervals:
+            self._schedule(address, now + self.intervals[address])
+
+    def wake(self, address: str, now: float):
+        """Активность замечена другим путем (события контрактов) - опросить в ближайшем цикле"""
+        if address in self.intervals:
+            self.intervals[address] = self.min_interval
+            if self.due[address] > now:
+                self._schedule(address, now)
+
+    def stats(self) -> Tuple[int, int]:
+        """(активных адресов, спящих на максимальном интервале)"""
+        hot = sum(1 for i in self.intervals.values() if i == self.min_interval)
+        cold = sum(1 for i in self.intervals.values() if i >= self.max_interval)
+        return hot, cold
+
+
+scheduler = PollScheduler(CHECK_INTERVAL, POLL_MAX_INTERVAL, POLL_BACKOFF)
+
+# ==================== ПРОФИЛИРОВАНИЕ ====================
+class StageTimers:
+    """
+    Суммарное время этапов цикла (fetch, decode, match, persist, deliver).
+
+    Меряется время по часам, включая ожидание в await; параллельные этапы
+    суммируются. Выключенные таймеры почти ничего не стоят.
+    """
+
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self.totals = {}  # этап -> [секунды, вызовы]
+
+    def add(self, stage: str, seconds: float):
+        if self.enabled:
+            total = self.totals.setdefault(stage, [0.0, 0])
+            total[0] += seconds
+            total[1] += 1
+
+    @contextmanager
+    def stage(self, name: str):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def report(self) -> str:
+        return ", ".join(
+            f"{stage} {seconds:.2f}с/{count}"
+            for stage, (seconds, count) in sorted(self.totals.items(), key=lambda item: -item[1][0])
+        ) or "нет данных"
+
+    def reset(self):
+        self.totals.clear()
+
+
+class LoopLagMonitor:
+    """Задержка event loop: насколько позже срабатывает sleep(interval)"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.max_lag = 0.0
+        self.total_lag = 0.0
+        self.samples = 0
+
+    async def run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = time.perf_counter() - start - self.interval
+            self.max_lag = max(self.max_lag, lag)
+            self.total_lag += lag
+            self.samples += 1
+            if lag > LOOP_LAG_WARNING:
+                logger.warning(f"Event loop заблокирован на {lag:.2f}с")
+
+    def report(self) -> str:
+        avg = self.total_lag / self.samples if self.samples else 0
+        return f"лаг event loop: сред {avg * 1000:.1f}мс, макс {self.max_lag * 1000:.1f}мс"
+
+    def reset(self):
+        self.max_lag = self.total_lag = 0.0
+        self.samples = 0
+
+
+timers = StageTimers(PROFILING)
+loop_lag = LoopLagMonitor(LOOP_LAG_INTERVAL)
+profile_lock = asyncio.Lock()
+
+
+def log_cycle_stats():
+    """Итоги цикла в лог (только при PROFILING)"""
+    if not timers.enabled:
+        return
+    logger.info(f"⏱ Этапы цикла: {timers.report()}; {loop_lag.report()}")
+    timers.reset()
+    loop_lag.reset()
+
+
+async def profile_process(seconds: int) -> Tuple[str, str]:
+    """
+    Профилировать живой процесс seconds секунд.
+
+    cProfile включается в потоке event loop, поэтому видит все корутины бота;
+    tracemalloc сравнивает снимки памяти до и после.
+
+    Returns:
+        (краткая сводка, полный отчет)
+    """
+    started_tracemalloc = not tracemalloc.is_tracing()
+    if started_tracemalloc:
+        tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.disable()
+
+    after = tracemalloc.take_snapshot()
+    if started_tracemalloc:
+        tracemalloc.stop()
+
+    out = io.StringIO()
+    stats = pstats.Stats(profiler, stream=out)
+    out.write(f"=== cProfile, {seconds}с, по собственному времени ===\n")
+    stats.sort_stats('tottime').print_stats(PROFILE_TOP)
+    out.write("=== cProfile, по суммарному времени ===\n")
+    stats.sort_stats('cumulative').print_stats(PROFILE_TOP)
+
+    allocations = after.compare_to(before, 'lineno')[:PROFILE_TOP]
+    out.write("=== tracemalloc, прирост памяти ===\n")
+    for stat in allocations:
+        out.write(f"{stat}\n")
+
+    top_functions = sorted(stats.stats.items(), key=lambda item: -item[1][2])[:5]
+    summary = ["*Топ функций (собственное время):*"]
+    for (filename, line, name), (_, _, tottime, cumtime, _) in top_functions:
+        summary.append(f"`{name}` `{os.path.basename(filename)}:{line}` - {tottime:.3f}с / {cumtime:.3f}с")
+    summary.append("*Топ аллокаций:*")
+    for stat in allocations[:5]:
+        frame = stat.traceback[0]
+        summary.append(f"`{os.path.basename(frame.filename)}:{frame.lineno}` {stat.size_diff / 1024:+.1f} КБ")
+    if timers.enabled:
+        summary.append(f"*Этапы:* {timers.report()}")
+    if loop_lag.samples:
+        summary.append(loop_lag.report())
+    return "\n".join(summary), out.getvalue()
+
+# ==================== ЛИМИТЫ ЗАПРОСОВ ====================
+def parse_rate_limits(value: str) -> dict:
+    """Разобрать строку вида `host=rps,host=rps`"""
+    limits = {}
+    for item in value.split(','):
+        host, _, rate = item.partition('=')
+        try:
+            limits[host.strip()] = float(rate)
+        except ValueError:
+            continue
+    return limits
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Retry-After: число секунд или HTTP-дата"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """
+    Token bucket одного endpoint'а.
+
+    Скорость адаптивная: каждый 429 вдвое снижает rate (не ниже 10% от базовой)
+    и блокирует bucket на Retry-After, успешные ответы постепенно возвращают
+    скорость к базовой.
+    """
+
+    def __init__(self, rate: float):
+        self.base_rate = rate
+        self.rate = rate
+        self.capacity = max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def delay(self) -> float:
+        """Сколько секунд ждать следующего токена"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        wait = max(0.0, self.blocked_until - now)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    async def acquire(self, max_wait: float) -> bool:
+        """Взять токен, подождав не дольше max_wait; False - endpoint перегружен"""
+        while True:
+            wait = self.delay()
+            if wait <= 0:
+                self.tokens -= 1
+                return True
+            if wait > max_wait:
+                return False
+            await asyncio.sleep(wait)
+            max_wait -= wait
+
+    def on_throttled(self, retry_after: Optional[float] = None):
+        self.rate = max(self.base_rate * 0.1, self.rate / 2)
+        self.tokens = 0
+        self.blocked_until = time.monotonic() + (retry_after if retry_after is not None else 1 / self.rate)
+
+    def on_success(self):
+        if self.rate < self.base_rate:
+            self.rate = min(self.base_rate, self.rate + self.base_rate * 0.05)
+
+
+class RateLimiter:
+    """Общие для всех вызывающих token bucket'ы, по одному на хост"""
+
+    def __init__(self, limits: dict, default_rate: float):
+        self.limits = limits
+        self.default_rate = default_rate
+        self.buckets = {}
+
+    def bucket(self, url: str) -> TokenBucket:
+        host = urlparse(url).netloc or url
+        if host not in self.buckets:
+            self.buckets[host] = TokenBucket(self.limits.get(host, self.default_rate))
+        return self.buckets[host]
+
+    def delay(self, url: str) -> float:
+        return self.bucket(url).delay()
+
+    async def acquire(self, url: str, max_wait: float) -> bool:
+        return await self.bucket(url).acquire(max_wait)
+
+
+rate_limiter = RateLimiter(
+    {**TRON_RATE_LIMITS, **parse_rate_limits(os.getenv("TRON_RATE_LIMITS", ""))},
+    TRON_DEFAULT_RATE_LIMIT
+)
+
+
+class TronKeyPool:
+    """
+    Пул API-ключей TronGrid.
+
+    У каждого ключа собственный token bucket, поэтому суммарная скорость
+    растет с числом ключей; запрос берет ключ, который освободится раньше.
+    """
+
+    def __init__(self, keys: List[str], rate: float):
+        self.keys = keys
+        self.buckets = {key: TokenBucket(rate) for key in keys}
+        self.next_index = 0
+
+    def __bool__(self) -> bool:
+        return bool(self.keys)
+
+    async def acquire(self, max_wait: float) -> Optional[str]:
+        # Ротация: при равной готовности ключи выбираются по кругу
+        order = self.keys[self.next_index:] + self.keys[:self.next_index]
+        self.next_index = (self.next_index + 1) % len(self.keys)
+        key = min(order, key=lambda k: self.buckets[k].delay())
+        return key if await self.buckets[key].acquire(max_wait) else None
 
-    def is_tx_processed(self, tx_hash: str) -> bool:
-        return tx_hash in self.tx_cache
+    def rate(self) -> float:
+        return sum(bucket.rate for bucket in self.buckets.values())
 
-    def mark_tx_processed(self, tx_hash: str):
-        self.tx_cache[tx_hash] = time.time()
 
+class EndpointHealth:
+    """
+    Оценка здоровья endpoint'ов: успехи повышают score, ошибки снижают.
 
-cache = TronCache()
+    Пониженный endpoint почти не получает запросов и не может заработать
+    score успехами, поэтому штраф (1 - score) со временем затухает с
+    периодом полураспада ENDPOINT_RECOVERY_HALF_LIFE - после сбоя endpoint
+    возвращается в ротацию сам.
+    """
+
+    def __init__(self, endpoints: List[str], half_life: float = ENDPOINT_RECOVERY_HALF_LIFE):
+        self.endpoints = endpoints
+        self.half_life = half_life
+        self.scores = {url: 1.0 for url in endpoints}
+        self.updated = {url: time.monotonic() for url in endpoints}
+
+    def score(self, url: str) -> float:
+        elapsed = time.monotonic() - self.updated[url]
+        return 1.0 - (1.0 - self.scores[url]) * 0.5 ** (elapsed / self.half_life)
+
+    def _set(self, url: str, score: float):
+        self.scores[url] = score
+        self.updated[url] = time.monotonic()
+
+    def ordered(self) -> List[str]:
+        return sorted(self.endpoints, key=lambda url: -self.score(url))
+
+    def success(self, url: str):
+        self._set(url, self.score(url) * 0.9 + 0.1)
+
+    def failure(self, url: str):
+        self._set(url, self.score(url) * 0.5)
+        logger.warning(f"Endpoint {url}: ошибка, score {self.scores[url]:.2f}")
+
+
+key_pool = TronKeyPool(TRON_API_KEYS, TRON_KEY_RATE_LIMIT)
+endpoint_health = EndpointHealth(TRON_API_ENDPOINTS)
+
+
+def uses_api_keys(base_url: str) -> bool:
+    return bool(key_pool) and urlparse(base_url).netloc.endswith('trongrid.io')
+
+
+def api_rate_budget() -> float:
+    """Суммарный бюджет запросов в секунду по всем endpoint'ам и ключам"""
+    total = 0.0
+    for url in TRON_API_ENDPOINTS:
+        total += key_pool.rate() if uses_api_keys(url) else rate_limiter.bucket(url).rate
+    return total
+
+# ==================== ТОКЕНЫ ====================
+# Популярные TRC-20 токены: контракт -> (символ, decimals)
+KNOWN_TRC20 = {
+    'TR7NHqjeKQxGTCi8q8ZY4pL8otSzgjLj6t': ('USDT', 6),
+    'TEkxiTehnzSmSe2XqrBj4w32RUN966rdz8': ('USDC', 6),
+    'TNUC9Qb1rRpS5CbWLmNMxXBjyFoydXjWFR': ('WTRX', 6),
+    'TPYmHEhy5n8TCEfYGqW2rPxsghSfzghPDn': ('USDD', 18),
+    'TCFLL5dx5ZJdKnWuesXxi1VPwjLVmWZZy9': ('JST', 18),
+    'TAFjULxiVgT4qWk6UZwjqwZXTSaGaqnVp4': ('BTT', 18),
+}
+
+
+def clean_symbol(symbol) -> Optional[str]:
+    """
+    Символ токена в безопасном для Markdown виде.
+
+    symbol() задает автор контракта: '_', '*', '`' или '[' в спам-токене
+    сломали бы разметку, и Telegram отклонил бы уведомление целиком.
+    """
+    symbol = ''.join(c for c in str(symbol or '') if c.isalnum() or c in '.-+$')
+    return symbol[:16] or None
+
+
+class TokenRegistry:
+    """Метаданные TRC-20 токенов (символ, decimals) по ключу (цепь, контракт)"""
+
+    def __init__(self, path: str, maxsize: int):
+        self.path = path
+        self.known = {('tron', contract): meta for contract, meta in KNOWN_TRC20.items()}
+        self.tokens = LRUCache(maxsize=maxsize)
+        self.failed = TTLCache(maxsize=1000, ttl=3600)
+        self.dirty = False
+
+    def get(self, contract: str) -> Optional[Tuple[str, int]]:
+        key = ('tron', contract)
+        return self.known.get(key) or self.tokens.get(key)
+
+    def remember(self, contract: str, symbol: str, decimals: int):
+        """Запомнить метаданные, пришедшие вместе с транзакцией (token_info)"""
+        key = ('tron', contract)
+        symbol = clean_symbol(symbol) or 'TOKEN'
+        if key in self.known or self.tokens.get(key) == (symbol, decimals):
+            return
+        self.tokens[key] = (symbol, decimals)
+        self.dirty = True
+
+    def load(self):
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, 'rb') as f:
+                    for key, (symbol, decimals) in pickle.load(f):
+                        self.tokens[key] = (clean_symbol(symbol) or 'TOKEN', decimals)
+                logger.info(f"Загружено {len(self.tokens)} токенов из кэша")
+        except Exception as e:
+            logger.error(f"Ошибка загрузки кэша токенов: {e}")
+
+    def save(self):
+        if not self.dirty:
+            return
+        try:
+            with timers.stage('persist'), open(self.path, 'wb') as f:
+                pickle.dump(list(self.tokens.items()), f)
+            self.dirty = False
+        except Exception as e:
+            logger.error(f"Ошибка сохранения кэша токенов: {e}")
+
+    async def resolve(self, api: 'TronAPI', contracts) -> None:
+        """Загрузить метаданные неизвестных токенов одним запросом на пачку контрактов"""
+        missing = [c for c in set(contracts) if c and self.get(c) is None and c not in self.failed]
+        if not missing:
+            return
+
+        for i in range(0, len(missing), 20):
+            chunk = missing[i:i + 20]
+            result = await api._get("/v1/trc20/info", {'contract_list': ','.join(chunk)})
+            resolved = set()
+            for item in (result or {}).get('data', []):
+                try:
+                    contract = item['contract_address']
+                    self.remember(contract, item.get('symbol') or 'TOKEN', int(item['decimals']))
+                    resolved.add(contract)
+                except (KeyError, TypeError, ValueError):
+                    continue
+            for contract in chunk:
+                if contract not in resolved:
+                    self.failed[contract] = True
+
+        self.save()
+
+
+token_registry = TokenRegistry(TOKEN_CACHE_FILE, TOKEN_CACHE_SIZE)
 
 
 # ==================== ХРАНЕНИЕ ДАННЫХ ====================
@@ -66,6 +701,11 @@ def load_data():
         if os.path.exists(DATA_FILE):
             with open(DATA_FILE, 'rb') as f:
                 user_subs = pickle.load(f)
+            # hex-форма адреса считается один раз, а не на каждой транзакции
+            for wallets in user_subs.values():
+                for address, data in wallets.items():
+                    if 'hex' not in data:
+                        data['hex'] = address_to_hex(address)
             logger.info(f"Загружено {sum(len(w) for w in user_subs.values())} TRON кошельков")
     except Exception as e:
         logger.error(f"Ошибка загрузки TRON данных: {e}")
@@ -75,12 +715,196 @@ def load_data():
 def save_data():
     """Сохранить TRON данные"""
     try:
-        with open(DATA_FILE, 'wb') as f:
+        with timers.stage('persist'), open(DATA_FILE, 'wb') as f:
             pickle.dump(user_subs, f)
     except Exception as e:
         logger.error(f"Ошибка сохранения TRON данных: {e}")
 
 
+# Состояние сканера (курсоры), не привязанное к подпискам
+scan_state = {}
+
+
+def load_state():
+    """Загрузить состояние сканера"""
+    global scan_state
+    try:
+        if os.path.exists(STATE_FILE):
+            with open(STATE_FILE, 'rb') as f:
+                scan_state = pickle.load(f)
+    except Exception as e:
+        logger.error(f"Ошибка загрузки состояния сканера: {e}")
+        scan_state = {}
+
+
+def save_state():
+    """Сохранить состояние сканера"""
+    try:
+        with timers.stage('persist'), open(STATE_FILE, 'wb') as f:
+            pickle.dump(scan_state, f)
+    except Exception as e:
+        logger.error(f"Ошибка сохранения состояния сканера: {e}")
+
+
+# ==================== ИСТОРИЯ ====================
+class TxHistory:
+    """
+    Локальный индекс найденных транзакций (sqlite3) - /history отвечает из него без запросов к сети.
+
+    Таблица без rowid с ключом (chain, address, timestamp, hash, type), поэтому
+    записи кошелька лежат подряд по времени и страница читается одним проходом
+    по индексу. compact() удаляет записи старше HISTORY_RETENTION_DAYS и сверх
+    HISTORY_MAX_PER_WALLET на кошелек, затем возвращает свободные страницы файла.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.db = None
+        self.holds = 0  # идущие выгрузки /export_txs: compact() ждет их окончания
+
+    def open(self):
+        try:
+            self.db = sqlite3.connect(self.path)
+            self.db.execute("PRAGMA auto_vacuum = INCREMENTAL")  # действует только для нового файла
+            self.db.execute("PRAGMA journal_mode = WAL")
+            self.db.execute("PRAGMA synchronous = NORMAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS txs ("
+                " chain TEXT NOT NULL, address TEXT NOT NULL, timestamp INTEGER NOT NULL,"
+                " hash TEXT NOT NULL, type TEXT NOT NULL, block INTEGER, counterparty TEXT,"
+                " value REAL, token TEXT, failed INTEGER NOT NULL DEFAULT 0,"
+                " PRIMARY KEY (chain, address, timestamp, hash, type)) WITHOUT ROWID"
+            )
+            self.db.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка открытия истории {self.path}: {e}")
+            self.db = None
+
+    def add(self, chain: str, address: str, txs: List[dict]):
+        """Сохранить транзакции кошелька; повторы игнорируются"""
+        if not self.db or not txs:
+            return
+        rows = [
+            (chain, address, tx.get('timestamp') or 0, tx['hash'], tx['type'], tx.get('block'),
+             tx['from'] if tx['type'] == 'in' else tx['to'], tx['value'], tx.get('token'),
+             int(bool(tx.get('failed'))))
+            for tx in txs
+        ]
+        try:
+            with timers.stage('persist'):
+                self.db.executemany("INSERT OR IGNORE INTO txs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                self.db.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка записи истории: {e}")
+
+    def page(self, chain: str, address: str, offset: int, limit: int) -> Tuple[List[tuple], int]:
+        """(записи от новых к старым, всего записей кошелька)"""
+        if not self.db:
+            return [], 0
+        total = self.db.execute(
+            "SELECT COUNT(*) FROM txs WHERE chain = ? AND address = ?", (chain, address)
+        ).fetchone()[0]
+        rows = self.db.execute(
+            "SELECT timestamp, hash, type, block, counterparty, value, token, failed FROM txs"
+            " WHERE chain = ? AND address = ? ORDER BY timestamp DESC LIMIT ? OFFSET ?",
+            (chain, address, limit, offset)
+        ).fetchall()
+        return rows, total
+
+    async def iter_range(self, chain: str, address: str, since_ms: int, until_ms: int):
+        """
+        Async-генератор записей кошелька за период по возрастанию времени.
+
+        Читает порциями по HISTORY_EXPORT_BATCH с курсором по ключу, между
+        порциями отдает управление event loop; память не зависит от числа записей.
+        """
+        if not self.db:
+            return
+        cursor = (since_ms, '', '')
+        first = True
+        while True:
+            rows = self.db.execute(
+                "SELECT timestamp, hash, type, block, counterparty, value, token, failed FROM txs"
+                " WHERE chain = ? AND address = ? AND timestamp <= ?"
+                f" AND (timestamp, hash, type) {'>=' if first else '>'} (?, ?, ?)"
+                " ORDER BY timestamp, hash, type LIMIT ?",
+                (chain, address, until_ms, *cursor, HISTORY_EXPORT_BATCH)
+            ).fetchall()
+            for row in rows:
+                yield row
+            if len(rows) < HISTORY_EXPORT_BATCH:
+                return
+            cursor = (rows[-1][0], rows[-1][1], rows[-1][2])
+            first = False
+            await asyncio.sleep(0)
+
+    def compact(self):
+        if not self.db:
+            return
+        if self.holds:
+            logger.debug("История: идет выгрузка, сжатие отложено до следующего цикла")
+            return
+        try:
+            cutoff = int((time.time() - HISTORY_RETENTION_DAYS * 86400) * 1000)
+            expired = self.db.execute("DELETE FROM txs WHERE timestamp < ?", (cutoff,)).rowcount
+
+            trimmed = 0
+            oversized = self.db.execute(
+                "SELECT chain, address FROM txs GROUP BY chain, address HAVING COUNT(*) > ?",
+                (HISTORY_MAX_PER_WALLET,)
+            ).fetchall()
+            for chain, address in oversized:
+                trimmed += self.db.execute(
+                    "DELETE FROM txs WHERE chain = ? AND address = ? AND timestamp < ("
+                    " SELECT timestamp FROM txs WHERE chain = ? AND address = ?"
+                    " ORDER BY timestamp DESC LIMIT 1 OFFSET ?)",
+                    (chain, address, chain, address, HISTORY_MAX_PER_WALLET - 1)
+                ).rowcount
+            self.db.commit()
+            self.db.execute("PRAGMA incremental_vacuum")
+
+            if expired or trimmed:
+                logger.info(f"История: удалено {expired} устаревших и {trimmed} записей сверх лимита")
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка сжатия истории: {e}")
+
+
+tx_history = TxHistory(HISTORY_FILE)
+
+
+async def compact_history():
+    """Фоновая задача: периодическое сжатие истории"""
+    while True:
+        tx_history.compact()
+        await asyncio.sleep(HISTORY_COMPACT_INTERVAL)
+
+
+def history_view(idx: int, addr: str, page: int) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    """Страница истории кошелька: (текст, клавиатура листания)"""
+    rows, total = tx_history.page('tron', addr, page * HISTORY_PAGE_SIZE, HISTORY_PAGE_SIZE)
+    pages = max(1, -(-total // HISTORY_PAGE_SIZE))
+
+    text = f"📜 *История кошелька #{idx + 1}* `{format_address(addr)}`\n"
+    if not rows:
+        text += "\nЗаписей нет"
+    else:
+        text += f"Страница {page + 1}/{pages}, всего {total}\n\n"
+    for timestamp, tx_hash, tx_type, block, counterparty, value, token, failed in rows:
+        when = datetime.fromtimestamp(timestamp / 1000).strftime('%d.%m %H:%M') if timestamp else "—"
+        icon, direction = ("📥", "от") if tx_type == 'in' else ("📤", "кому")
+        text += (
+            f"{when} {icon} {value:.4f} {clean_symbol(token) or ''} {direction} `{format_address(counterparty or '')}`"
+            f"{' ❌' if failed else ''} [🔗](https://tronscan.org/#/transaction/{tx_hash})\n"
+        )
+
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton(text="◀️", callback_data=f"history_{idx}_{min(page, pages) - 1}"))
+    if page + 1 < pages:
+        buttons.append(InlineKeyboardButton(text="▶️", callback_data=f"history_{idx}_{page + 1}"))
+    return text, InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+
+
 # ==================== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ====================
 def validate_tron_address(addr: str) -> Tuple[bool, str]:
     """Проверить валидность TRON адреса"""
@@ -97,11 +921,34 @@ def validate_tron_address(addr: str) -> Tuple[bool, str]:
         return False, "Неверный формат TRON адреса"
 
 
+@lru_cache(maxsize=100_000)
+def address_to_hex(addr: str) -> str:
+    """Base58 адрес -> 21-байтовый hex вида 41..."""
+    return base58.b58decode_check(addr).hex()
+
+
+@lru_cache(maxsize=100_000)
+def hex_to_address(addr_hex: str) -> str:
+    """21-байтовый hex вида 41... -> base58 адрес"""
+    return base58.b58encode_check(bytes.fromhex(addr_hex)).decode()
+
+
 def get_all_wallets(chat_id: int) -> List[Tuple[str, dict]]:
     """Список кошельков: (address, data)"""
     return list(user_subs.get(chat_id, {}).items())
 
 
+def make_wallet_data(address: str, current_timestamp: int) -> dict:
+    """Начальные настройки нового кошелька"""
+    return {
+        'hex': address_to_hex(address),
+        'last_timestamp': current_timestamp,
+        'added_at': time.time(),
+        'notify_incoming': True,
+        'notify_outgoing': True,
+    }
+
+
 def get_inline_keyboard(buttons: List[Tuple[str, str]], row_width: int = 1) -> InlineKeyboardMarkup:
     """Helper function to create inline keyboard"""
     builder = InlineKeyboardBuilder()
@@ -112,9 +959,12 @@ def get_inline_keyboard(buttons: List[Tuple[str, str]], row_width: int = 1) -> I
 
 
 # ==================== TRON API КЛИЕНТ ====================
+class TronAPIError(Exception):
+    """Запрос не удался ни на одном endpoint'е"""
+
+
 class TronAPI:
     def __init__(self):
-        self.base_url = TRON_API_URL
         self.session = None
 
     async def __aenter__(self):
@@ -126,73 +976,333 @@ class TronAPI:
         await self.session.close()
 
     async def _get(self, endpoint: str, params: dict = None) -> Optional[dict]:
-        url = f"{self.base_url}{endpoint}"
-        headers = {'Accept': 'application/json'}
+        return await self._request('GET', endpoint, params=params)
 
-        for attempt in range(MAX_RETRIES):
-            try:
-                async with self.session.get(url, params=params, headers=headers) as resp:
-                    if resp.status == 200:
-                        return await resp.json()
-                    elif resp.status == 429:
-                        logger.warning(f"Rate limit, попытка {attempt + 1}/{MAX_RETRIES}")
-                        await asyncio.sleep(RETRY_DELAY * (attempt + 1))
-                    else:
-                        logger.error(f"API ошибка {resp.status}: {await resp.text()}")
-                        return None
-            except Exception as e:
-                logger.error(f"Ошибка запроса: {e}")
-                if attempt < MAX_RETRIES - 1:
-                    await asyncio.sleep(RETRY_DELAY)
+    async def _post(self, endpoint: str, data: dict = None) -> Optional[dict]:
+        return await self._request('POST', endpoint, json=data)
 
-        return None
+    async def _acquire(self, base_url: str, max_wait: float) -> Tuple[Optional[str], Optional[TokenBucket]]:
+        """Токен лимитера для endpoint'а: (API-ключ или None, bucket) или (None, None)"""
+        if uses_api_keys(base_url):
+            key = await key_pool.acquire(max_wait)
+            return (key, key_pool.buckets[key]) if key else (None, None)
 
-    async def _post(self, endpoint: str, data: dict = None) -> Optional[dict]:
-        url = f"{self.base_url}{endpoint}"
-        headers = {'Content-Type': 'application/json', 'Accept': 'application/json'}
+        bucket = rate_limiter.bucket(base_url)
+        return (None, bucket) if await bucket.acquire(max_wait) else (None, None)
+
+    async def _request(self, method: str, endpoint: str, **kwargs) -> Optional[dict]:
+        headers = {'Accept': 'application/json'}
+        if method == 'POST':
+            headers['Content-Type'] = 'application/json'
 
         for attempt in range(MAX_RETRIES):
-            try:
-                async with self.session.post(url, json=data, headers=headers) as resp:
-                    if resp.status == 200:
-                        return await resp.json()
-                    elif resp.status == 429:
-                        logger.warning(f"Rate limit, попытка {attempt + 1}/{MAX_RETRIES}")
-                        await asyncio.sleep(RETRY_DELAY * (attempt + 1))
-                    else:
-                        logger.error(f"API ошибка {resp.status}: {await resp.text()}")
-                        return None
-            except Exception as e:
-                logger.error(f"Ошибка запроса: {e}")
-                if attempt < MAX_RETRIES - 1:
-                    await asyncio.sleep(RETRY_DELAY)
+            endpoints = endpoint_health.ordered()
+            client_errors = 0
+            for i, base_url in enumerate(endpoints):
+                # Перегруженный endpoint пропускаем, на последнем ждем в очереди лимитера
+                max_wait = RATE_LIMIT_QUEUE_TIMEOUT if i == len(endpoints) - 1 else RATE_LIMIT_MAX_WAIT
+                key, bucket = await self._acquire(base_url, max_wait)
+                if not bucket:
+                    continue
+
+                request_headers = dict(headers, **{'TRON-PRO-API-KEY': key}) if key else headers
+
+                body = None
+                try:
+                    with timers.stage('fetch'):
+                        async with self.session.request(
+                                method, f"{base_url}{endpoint}", headers=request_headers, **kwargs) as resp:
+                            if resp.status == 200:
+                                bucket.on_success()
+                                endpoint_health.success(base_url)
+                                body = await resp.read()
+                            elif resp.status == 429:
+                                bucket.on_throttled(parse_retry_after(resp.headers.get('Retry-After')))
+                                logger.warning(
+                                    f"Rate limit {base_url}, попытка {attempt + 1}/{MAX_RETRIES}, "
+                                    f"лимит снижен до {bucket.rate:.1f} запр/с"
+                                )
+                            elif resp.status in (401, 403) and key:
+                                logger.error(f"API-ключ ...{key[-4:]} отклонен ({resp.status})")
+                                bucket.on_throttled(KEY_REJECT_COOLDOWN)
+                            elif resp.status >= 500:
+                                endpoint_health.failure(base_url)
+                            else:
+                                # Другой 4xx (например, 404 у альтернативного endpoint на /v1/...) - пробуем следующий
+                                logger.warning(f"API ошибка {base_url} {resp.status}: {await resp.text()}")
+                                endpoint_health.failure(base_url)
+                                client_errors += 1
+                    if body is not None:
+                        with timers.stage('decode'):
+                            return json.loads(body)
+                except Exception as e:
+                    logger.error(f"Ошибка запроса {base_url}: {e}")
+                    endpoint_health.failure(base_url)
+
+            # 4xx от всех endpoint'ов - ошибка самого запроса, повтор не поможет
+            if client_errors == len(endpoints):
+                logger.error(f"API ошибка на всех endpoint'ах: {method} {endpoint}")
+                return None
+
+            if attempt < MAX_RETRIES - 1:
+                await asyncio.sleep(RETRY_DELAY)
 
         return None
 
-    async def get_account_transactions(self, address: str, limit: int = 50, min_timestamp: int = None) -> List[dict]:
+    async def iter_pages(self, endpoint: str, params: dict, fingerprint: str = None, max_pages: int = 1,
+                         strict: bool = False):
+        """
+        Async-генератор страниц TronGrid по курсору meta.fingerprint.
+
+        Отдает (data, fingerprint следующей страницы или None). При ошибке запроса
+        генератор завершается; последний отданный fingerprint остается валидным
+        курсором для продолжения. strict=True - вместо тихого завершения
+        TronAPIError, чтобы сбой API не выглядел как отсутствие транзакций.
+        """
+        for _ in range(max_pages):
+            page_params = dict(params, fingerprint=fingerprint) if fingerprint else params
+            result = await self._get(endpoint, page_params)
+            if result is None:
+                if strict:
+                    raise TronAPIError(endpoint)
+                return
+
+            fingerprint = result.get('meta', {}).get('fingerprint')
+            yield result.get('data', []), fingerprint
+            if not fingerprint:
+                return
+
+    def iter_account_transactions(self, address: str, min_timestamp: int, fingerprint: str = None,
+                                  max_pages: int = 1, trc20: bool = False, max_timestamp: int = None,
+                                  strict: bool = False, newest_first: bool = False):
+        """Страницы TRX (или TRC-20) транзакций кошелька по возрастанию времени (newest_first - по убыванию)"""
         params = {
-            'limit': limit,
+            'limit': MAX_TRANSACTIONS_PER_CHECK,
             'only_confirmed': 'true',
-            'order_by': 'block_timestamp,desc'
+            'order_by': 'block_timestamp,desc' if newest_first else 'block_timestamp,asc',
+            'min_timestamp': min_timestamp
         }
-        if min_timestamp:
-            params['min_timestamp'] = min_timestamp
-
-        result = await self._get(f"/v1/accounts/{address}/transactions", params)
-        return result.get('data', []) if result else []
-
-    async def get_account_trc20_transactions(self, address: str, limit: int = 50,
-                                             min_timestamp: int = None) -> List[dict]:
+        if max_timestamp is not None:
+            params['max_timestamp'] = max_timestamp
+        endpoint = f"/v1/accounts/{address}/transactions" + ("/trc20" if trc20 else "")
+        return self.iter_pages(endpoint, params, fingerprint, max_pages, strict)
+
+    def iter_contract_events(self, contract: str, min_timestamp: int, fingerprint: str = None,
+                             max_pages: int = 1):
+        """Страницы событий Transfer контракта по возрастанию времени"""
         params = {
-            'limit': limit,
+            'event_name': 'Transfer',
             'only_confirmed': 'true',
-            'order_by': 'block_timestamp,desc'
+            'order_by': 'block_timestamp,asc',
+            'min_block_timestamp': min_timestamp,
+            'limit': EVENTS_PAGE_SIZE
         }
-        if min_timestamp:
-            params['min_timestamp'] = min_timestamp
+        return self.iter_pages(f"/v1/contracts/{contract}/events", params, fingerprint, max_pages)
+
+    async def get_now_block_number(self) -> int:
+        result = await self._post("/wallet/getnowblock")
+        try:
+            return result['block_header']['raw_data']['number']
+        except (KeyError, TypeError):
+            return 0
+
+    async def get_blocks(self, start: int, end: int) -> Optional[List[dict]]:
+        """Блоки [start, end); None при ошибке"""
+        result = await self._post("/wallet/getblockbylimitnext", {'startNum': start, 'endNum': end})
+        if result is None:
+            return None
+        return result.get('block', [])
+
+
+# ==================== ФИЛЬТРЫ ====================
+def normalize_counterparty(addr: str) -> Optional[str]:
+    valid, _ = validate_tron_address(addr)
+    return addr if valid else None
 
-        result = await self._get(f"/v1/accounts/{address}/transactions/trc20", params)
-        return result.get('data', []) if result else []
+
+def token_key(tx: dict) -> str:
+    """Ключ токена для фильтров: контракт TRC-20 (base58) или TRX"""
+    if tx.get('token_type') == 'TRC20':
+        return tx['token_address']
+    return 'TRX'
+
+
+def resolve_token_keys(value: str) -> List[str]:
+    """
+    Ключи токенов по вводу пользователя: адрес контракта или символ.
+
+    Символ ищется только среди TRX и KNOWN_TRC20: symbol() любого контракта
+    задает его автор, и поддельный "USDT" не должен проходить фильтр настоящего.
+    """
+    if validate_tron_address(value)[0]:
+        return [value]
+    symbol = value.upper()
+    if symbol == 'TRX':
+        return ['TRX']
+    return sorted(contract for contract, (known_symbol, _) in KNOWN_TRC20.items() if known_symbol.upper() == symbol)
+
+
+def token_label(key: str) -> str:
+    """Символ для ключа токена в настройках"""
+    if key in KNOWN_TRC20:
+        return KNOWN_TRC20[key][0]
+    return format_address(key) if key != 'TRX' else key
+
+
+def compile_tx_filter(data: dict) -> Callable[[dict], bool]:
+    """
+    Собрать предикат из настроек кошелька.
+
+    Предикат применяется в get_new_transactions до форматирования и отправки,
+    поэтому отброшенные транзакции не стоят ничего, кроме сравнения.
+    Токены сравниваются по token_key; символы из настроек старого формата
+    разворачиваются через resolve_token_keys.
+    """
+    notify_incoming = data.get('notify_incoming', True)
+    notify_outgoing = data.get('notify_outgoing', True)
+    min_amounts = {
+        key: amount
+        for token, amount in data.get('min_amounts', {}).items()
+        for key in resolve_token_keys(token)
+    }
+    token_allowlist = frozenset(key for token in data.get('token_allowlist', ()) for key in resolve_token_keys(token))
+    allow = frozenset(data.get('counterparty_allow', ()))
+    deny = frozenset(data.get('counterparty_deny', ()))
+
+    def predicate(tx: dict) -> bool:
+        incoming = tx['type'] == 'in'
+        if not (notify_incoming if incoming else notify_outgoing):
+            return False
+
+        token = token_key(tx)
+        if token_allowlist and token not in token_allowlist:
+            return False
+        if min_amounts and tx['value'] < min_amounts.get(token, 0):
+            return False
+
+        if allow or deny:
+            counterparty = tx['from'] if incoming else tx['to']
+            if counterparty in deny:
+                return False
+            if allow and counterparty not in allow:
+                return False
+
+        return True
+
+    return predicate
+
+
+def has_filter_rules(data: dict) -> bool:
+    return any(data.get(key) for key in ('min_amounts', 'token_allowlist', 'counterparty_allow', 'counterparty_deny'))
+
+
+def apply_filter_command(data: dict, action: str, args: List[str]) -> Tuple[bool, str]:
+    """Изменить правила фильтра кошелька; возвращает (успех, сообщение)"""
+    if action == 'min':
+        if len(args) != 2:
+            return False, "Использование: /filter <номер> min <токен> <сумма>"
+        try:
+            amount = float(args[1].replace(',', '.'))
+        except ValueError:
+            return False, "Неверная сумма"
+        keys = resolve_token_keys(args[0])
+        if not keys:
+            return False, f"Неизвестный токен {args[0]}: укажите адрес контракта"
+        token = token_label(keys[0])
+        min_amounts = data.setdefault('min_amounts', {})
+        for key in keys:
+            if amount > 0:
+                min_amounts[key] = amount
+            else:
+                min_amounts.pop(key, None)
+        if amount > 0:
+            return True, f"Минимум для {token}: {amount:g}"
+        return True, f"Минимум для {token} снят"
+
+    if action == 'tokens':
+        if len(args) != 1:
+            return False, "Использование: /filter <номер> tokens <USDT,USDC,T...|all>"
+        if args[0].lower() == 'all':
+            data['token_allowlist'] = []
+            return True, "Уведомления по всем токенам"
+        keys = set()
+        for value in (t.strip() for t in args[0].split(',') if t.strip()):
+            resolved = resolve_token_keys(value)
+            if not resolved:
+                return False, f"Неизвестный токен {value}: укажите адрес контракта"
+            keys.update(resolved)
+        data['token_allowlist'] = sorted(keys)
+        return True, f"Только токены: {', '.join(dict.fromkeys(token_label(k) for k in data['token_allowlist']))}"
+
+    if action in ('allow', 'deny', 'unlist'):
+        if len(args) != 1:
+            return False, f"Использование: /filter <номер> {action} <адрес>"
+        counterparty = normalize_counterparty(args[0])
+        if not counterparty:
+            return False, "Неверный адрес"
+        allow = data.setdefault('counterparty_allow', [])
+        deny = data.setdefault('counterparty_deny', [])
+        for lst in (allow, deny):
+            if counterparty in lst:
+                lst.remove(counterparty)
+        if action == 'allow':
+            allow.append(counterparty)
+            return True, f"Добавлен в белый список: {format_address(counterparty)}"
+        if action == 'deny':
+            deny.append(counterparty)
+            return True, f"Добавлен в черный список: {format_address(counterparty)}"
+        return True, f"Удален из списков: {format_address(counterparty)}"
+
+    if action == 'reset':
+        for key in ('min_amounts', 'token_allowlist', 'counterparty_allow', 'counterparty_deny'):
+            data.pop(key, None)
+        return True, "Правила фильтра сброшены"
+
+    return False, "Неизвестное действие. Доступно: min, tokens, allow, deny, unlist, reset"
+
+
+def filter_settings_view(idx: int, addr: str, data: dict) -> Tuple[str, InlineKeyboardMarkup]:
+    """Текст и клавиатура настроек уведомлений кошелька"""
+    addr_short = format_address(addr)
+
+    in_icon = "✅" if data.get('notify_incoming', True) else "❌"
+    out_icon = "✅" if data.get('notify_outgoing', True) else "❌"
+
+    buttons = [
+        (f"📥 Входящие {in_icon}", f"toggle_in_{idx}"),
+        (f"📤 Исходящие {out_icon}", f"toggle_out_{idx}"),
+    ]
+
+    text = (
+        f"⚙️ *Настройки уведомлений*\n"
+        f"Кошелек #{idx + 1}: 🔴 TRON `{addr_short}`\n\n"
+        f"📥 Входящие транзакции: {in_icon}\n"
+        f"📤 Исходящие транзакции: {out_icon}"
+    )
+
+    if has_filter_rules(data):
+        min_amounts = data.get('min_amounts', {})
+        if min_amounts:
+            labels = dict.fromkeys(f"{amount:g} {token_label(key)}" for key, amount in min_amounts.items())
+            text += "\n💰 Минимум: " + ", ".join(labels)
+        if data.get('token_allowlist'):
+            text += "\n🪙 Токены: " + ", ".join(dict.fromkeys(token_label(k) for k in data['token_allowlist']))
+        if data.get('counterparty_allow'):
+            text += "\n✅ Белый список: " + ", ".join(f"`{format_address(a)}`" for a in data['counterparty_allow'])
+        if data.get('counterparty_deny'):
+            text += "\n⛔ Черный список: " + ", ".join(f"`{format_address(a)}`" for a in data['counterparty_deny'])
+        buttons.append(("🧹 Сбросить правила", f"filter_reset_{idx}"))
+
+    text += (
+        f"\n\nПравила: `/filter {idx + 1} min USDT 100`, `tokens USDT,USDC`, "
+        f"`allow <адрес>`, `deny <адрес>`, `unlist <адрес>`, `reset`"
+    )
+
+    builder = InlineKeyboardBuilder()
+    for button_text, callback_data in buttons:
+        builder.add(InlineKeyboardButton(text=button_text, callback_data=callback_data))
+    builder.adjust(2, 1)
+    return text, builder.as_markup()
 
 
 # ==================== ОБРАБОТКА ТРАНЗАКЦИЙ ====================
@@ -202,7 +1312,13 @@ def format_address(addr: str) -> str:
     return f"{addr[:4]}...{addr[-4:]}"
 
 
-def process_trx_transaction(tx: dict, watch_address: str) -> Optional[dict]:
+def process_trx_transaction(tx: dict, watch_address: str, watch_hex: str) -> Optional[dict]:
+    """
+    TRX перевод из транзакции кошелька.
+
+    Сравнение идет в hex (watch_hex = address_to_hex(watch_address)), base58
+    считается только для контрагента совпавшего перевода через LRU-кэш.
+    """
     try:
         if 'raw_data' not in tx or 'contract' not in tx['raw_data']:
             return None
@@ -217,23 +1333,18 @@ def process_trx_transaction(tx: dict, watch_address: str) -> Optional[dict]:
 
             params = contract.get('parameter', {}).get('value', {})
 
-            owner_hex = params.get('owner_address', '')
-            to_hex = params.get('to_address', '')
+            owner_hex = params.get('owner_address', '').lower()
+            to_hex = params.get('to_address', '').lower()
 
-            owner_addr = base58.b58encode_check(bytes.fromhex(owner_hex)).decode() if owner_hex else ''
-            to_addr = base58.b58encode_check(bytes.fromhex(to_hex)).decode() if to_hex else ''
-
-            amount = params.get('amount', 0) / 1_000_000
-
-            is_outgoing = owner_addr == watch_address
-            is_incoming = to_addr == watch_address
+            is_outgoing = owner_hex == watch_hex
+            is_incoming = to_hex == watch_hex
 
             if is_outgoing or is_incoming:
                 return {
                     'hash': tx_id,
-                    'from': owner_addr,
-                    'to': to_addr,
-                    'value': amount,
+                    'from': watch_address if is_outgoing else hex_to_address(owner_hex),
+                    'to': watch_address if is_incoming else (hex_to_address(to_hex) if to_hex else ''),
+                    'value': params.get('amount', 0) / 1_000_000,
                     'block': block,
                     'timestamp': timestamp,
                     'type': 'out' if is_outgoing else 'in',
@@ -246,74 +1357,514 @@ def process_trx_transaction(tx: dict, watch_address: str) -> Optional[dict]:
     return None
 
 
-def process_trc20_transaction(tx: dict, watch_address: str) -> Optional[dict]:
+def process_trc20_transaction(tx: dict, watch_address: str, watch_hex: str) -> Optional[dict]:
+    """TRC-20 перевод; адреса TronGrid уже в base58, hex (41...) сравнивается с watch_hex"""
     try:
         tx_id = tx.get('transaction_id', '')
         timestamp = tx.get('block_timestamp', 0)
 
         token_info = tx.get('token_info', {})
+        contract = token_info.get('address', '')
         from_addr = tx.get('from', '')
         to_addr = tx.get('to', '')
 
         if not from_addr or not to_addr:
             return None
 
-        if from_addr.startswith('41'):
-            from_addr = base58.b58encode_check(bytes.fromhex(from_addr)).decode()
-        if to_addr.startswith('41'):
-            to_addr = base58.b58encode_check(bytes.fromhex(to_addr)).decode()
-
-        value = float(tx.get('value', 0)) / (10 ** token_info.get('decimals', 6))
-        token_symbol = token_info.get('symbol', 'TOKEN')
-
-        is_outgoing = from_addr == watch_address
-        is_incoming = to_addr == watch_address
-
-        if is_outgoing or is_incoming:
-            return {
-                'hash': tx_id,
-                'from': from_addr,
-                'to': to_addr,
-                'value': value,
-                'block': 0,
-                'timestamp': timestamp,
-                'type': 'out' if is_outgoing else 'in',
-                'token': token_symbol,
-                'token_type': 'TRC20'
-            }
+        from_is_hex = from_addr.startswith('41')
+        to_is_hex = to_addr.startswith('41')
+        is_outgoing = (from_addr.lower() == watch_hex) if from_is_hex else (from_addr == watch_address)
+        is_incoming = (to_addr.lower() == watch_hex) if to_is_hex else (to_addr == watch_address)
+
+        if not (is_outgoing or is_incoming):
+            return None
+
+        if from_is_hex:
+            from_addr = watch_address if is_outgoing else hex_to_address(from_addr.lower())
+        if to_is_hex:
+            to_addr = watch_address if is_incoming else hex_to_address(to_addr.lower())
+
+        if contract and 'decimals' in token_info and token_info.get('symbol'):
+            token_registry.remember(contract, token_info['symbol'], int(token_info['decimals']))
+
+        raw_value = int(tx.get('value', 0))
+        meta = token_registry.get(contract)
+        token_symbol, decimals = meta if meta else ('TOKEN', 6)
+
+        return {
+            'hash': tx_id,
+            'from': from_addr,
+            'to': to_addr,
+            'value': raw_value / (10 ** decimals),
+            'block': 0,
+            'timestamp': timestamp,
+            'type': 'out' if is_outgoing else 'in',
+            'token': token_symbol,
+            'token_type': 'TRC20',
+            'token_address': contract,
+            'raw_value': raw_value,
+            'token_resolved': meta is not None
+        }
     except Exception as e:
         logger.error(f"Ошибка обработки TRC-20 транзакции: {e}")
 
     return None
 
 
-async def get_new_transactions(address: str, last_timestamp: int) -> List[dict]:
+def apply_token_meta(tx: dict):
+    """Пересчитать символ и сумму TRC-20 транзакции по реестру токенов"""
+    meta = token_registry.get(tx['token_address'])
+    if meta:
+        tx['token'], decimals = meta
+        tx['value'] = tx['raw_value'] / (10 ** decimals)
+        tx['token_resolved'] = True
+
+
+async def read_account_stream(api: TronAPI, address: str, stream: str, cursors: dict,
+                              default_since: int) -> List[dict]:
+    """
+    Прочитать поток 'trx' или 'trc20' кошелька, страницы обрабатываются по мере прихода.
+
+    Курсор потока - (min_timestamp, fingerprint). Если страницы не уместились
+    в ACCOUNT_PAGE_BUDGET, сохраняется fingerprint и чтение продолжается
+    в следующем цикле с того же места вместо потери транзакций.
+
+    Raises:
+        TronAPIError: страница не получена; курсор потока не меняется
+    """
+    since, fingerprint = cursors.get(stream, (default_since, None))
+    process = process_trc20_transaction if stream == 'trc20' else process_trx_transaction
+    watch_hex = address_to_hex(address)
+    latest = since - 1
     txs = []
 
-    async with TronAPI() as api:
-        trx_txs = await api.get_account_transactions(address, MAX_TRANSACTIONS_PER_CHECK, last_timestamp)
-        for tx in trx_txs:
-            processed = process_trx_transaction(tx, address)
-            if processed and processed['timestamp'] > last_timestamp:
-                if not cache.is_tx_processed(processed['hash']):
+    pages = api.iter_account_transactions(
+        address, since, fingerprint, ACCOUNT_PAGE_BUDGET, trc20=stream == 'trc20', strict=True
+    )
+    async for page, fingerprint in pages:
+        with timers.stage('match'):
+            for tx in page:
+                latest = max(latest, tx.get('block_timestamp', 0))
+                processed = process(tx, address, watch_hex)
+                if processed:
                     txs.append(processed)
-                    cache.mark_tx_processed(processed['hash'])
 
-        trc20_txs = await api.get_account_trc20_transactions(address, MAX_TRANSACTIONS_PER_CHECK, last_timestamp)
-        for tx in trc20_txs:
-            processed = process_trc20_transaction(tx, address)
-            if processed and processed['timestamp'] > last_timestamp:
-                if not cache.is_tx_processed(processed['hash']):
-                    txs.append(processed)
-                    cache.mark_tx_processed(processed['hash'])
+    if fingerprint:
+        logger.info(f"{format_address(address)}: {stream} не уместился в бюджет страниц, продолжим в следующем цикле")
+    # Без fingerprint все транзакции до latest прочитаны - следующий запрос после них
+    cursors[stream] = (since, fingerprint) if fingerprint else (latest + 1, None)
+    return txs
+
+
+async def get_new_transactions(api: TronAPI, address: str, cursors: dict, default_since: int,
+                               predicate: Optional[Callable[[dict], bool]] = None,
+                               include_trc20: bool = True) -> List[dict]:
+    """
+    Новые TRX и TRC-20 транзакции кошелька; оба потока запрашиваются параллельно.
+
+    cursors - курсоры потоков кошелька, обновляются на месте; default_since -
+    начальный min_timestamp для потока без курсора.
+    predicate (из compile_tx_filter) применяется до форматирования сообщений.
+    include_trc20=False - TRC-20 приходят из событий контрактов (TRON_TRC20_MODE=events).
+    """
+    streams = ['trx', 'trc20'] if include_trc20 else ['trx']
+    results = await asyncio.gather(
+        *(read_account_stream(api, address, stream, cursors, default_since) for stream in streams)
+    )
+    txs = [tx for stream_txs in results for tx in stream_txs]
+
+    # Неизвестные токены подгружаются пачкой до форматирования сообщений
+    unresolved = [tx for tx in txs if tx['token_type'] == 'TRC20' and not tx['token_resolved']]
+    if unresolved:
+        await token_registry.resolve(api, {tx['token_address'] for tx in unresolved})
+        for tx in unresolved:
+            apply_token_meta(tx)
 
+    token_registry.save()
     txs.sort(key=lambda x: x['timestamp'])
+
+    if predicate and txs:
+        matched = len(txs)
+        txs = [tx for tx in txs if predicate(tx)]
+        if len(txs) != matched:
+            logger.debug(f"После фильтрации: {len(txs)} из {matched} транзакций для {format_address(address)}")
+
     if txs:
         logger.info(f"Найдено {len(txs)} новых транзакций для {format_address(address)}")
 
     return txs
 
 
+# ==================== СКАНИРОВАНИЕ БЛОКОВ ====================
+TRC20_TRANSFER = 'a9059cbb'
+TRC20_TRANSFER_FROM = '23b872dd'
+
+
+def build_watch_index() -> dict:
+    """Индекс отслеживаемых адресов: hex (41...) -> base58"""
+    index = {}
+    for wallets in user_subs.values():
+        for address, data in wallets.items():
+            index[data.get('hex') or address_to_hex(address)] = address
+    return index
+
+
+def decode_block_transfers(block: dict):
+    """Генератор переводов TRX и TRC-20 из блока: (tx_id, from_hex, to_hex, raw_value, contract_hex)"""
+    for tx in block.get('transactions', []):
+        ret = tx.get('ret') or [{}]
+        if ret[0].get('contractRet', 'SUCCESS') != 'SUCCESS':
+            continue
+
+        for contract in tx.get('raw_data', {}).get('contract', []):
+            contract_type = contract.get('type')
+            value = contract.get('parameter', {}).get('value', {})
+
+            if contract_type == 'TransferContract':
+                yield tx.get('txID', ''), value.get('owner_address', ''), value.get('to_address', ''), \
+                    value.get('amount', 0), None
+
+            elif contract_type == 'TriggerSmartContract':
+                data = value.get('data', '')
+                try:
+                    if data.startswith(TRC20_TRANSFER) and len(data) >= 136:
+                        yield tx.get('txID', ''), value.get('owner_address', ''), '41' + data[32:72], \
+                            int(data[72:136], 16), value.get('contract_address', '')
+                    elif data.startswith(TRC20_TRANSFER_FROM) and len(data) >= 200:
+                        yield tx.get('txID', ''), '41' + data[32:72], '41' + data[96:136], \
+                            int(data[136:200], 16), value.get('contract_address', '')
+                except ValueError:
+                    continue
+
+
+def match_block(block: dict, index: dict) -> List[Tuple[str, dict]]:
+    """Переводы блока, затрагивающие отслеживаемые адреса: [(адрес, транзакция)]"""
+    header = block.get('block_header', {}).get('raw_data', {})
+    block_num = header.get('number', 0)
+    timestamp = header.get('timestamp', 0)
+
+    matches = []
+    for tx_id, from_hex, to_hex, raw_value, contract_hex in decode_block_transfers(block):
+        from_hex, to_hex = from_hex.lower(), to_hex.lower()
+        if from_hex not in index and to_hex not in index:
+            continue
+
+        # base58 считается только для совпавших переводов
+        from_addr = hex_to_address(from_hex) if from_hex else ''
+        to_addr = hex_to_address(to_hex) if to_hex else ''
+
+        if contract_hex:
+            contract = hex_to_address(contract_hex)
+            meta = token_registry.get(contract)
+            symbol, decimals = meta if meta else ('TOKEN', 6)
+            tx = {
+                'hash': tx_id, 'from': from_addr, 'to': to_addr,
+                'value': raw_value / (10 ** decimals), 'block': block_num, 'timestamp': timestamp,
+                'token': symbol, 'token_type': 'TRC20', 'token_address': contract,
+                'raw_value': raw_value, 'token_resolved': meta is not None
+            }
+        else:
+            tx = {
+                'hash': tx_id, 'from': from_addr, 'to': to_addr,
+                'value': raw_value / 1_000_000, 'block': block_num, 'timestamp': timestamp,
+                'token': 'TRX', 'token_type': 'TRX'
+            }
+
+        for side, addr_hex in (('out', from_hex), ('in', to_hex)):
+            if addr_hex in index:
+                matches.append((index[addr_hex], dict(tx, type=side)))
+
+    return matches
+
+
+async def scan_blocks() -> dict:
+    """
+    Прочитать новые подтвержденные блоки и сопоставить переводы со всеми кошельками.
+
+    Стоимость зависит от числа блоков, а не от числа кошельков.
+
+    Returns:
+        {адрес: [транзакции]}
+    """
+    index = build_watch_index()
+    if not index:
+        return {}
+
+    found = {}
+    async with TronAPI() as api:
+        head = await api.get_now_block_number()
+        if not head:
+            return {}
+        head -= TRON_CONFIRMATIONS
+
+        cursor = scan_state.get('block_cursor') or head
+        end = min(head, cursor + MAX_BLOCKS_PER_CYCLE)
+
+        for start in range(cursor + 1, end + 1, BLOCK_BATCH_SIZE):
+            stop = min(start + BLOCK_BATCH_SIZE, end + 1)
+            blocks = await api.get_blocks(start, stop)
+            if not blocks:
+                break
+
+            with timers.stage('match'):
+                for block in blocks:
+                    for address, tx in match_block(block, index):
+                        found.setdefault(address, []).append(tx)
+
+            cursor = max(b.get('block_header', {}).get('raw_data', {}).get('number', 0) for b in blocks)
+            if cursor < stop - 1:
+                break  # нода отдала не все блоки, продолжим со следующего цикла
+
+        unresolved = [
+            tx for txs in found.values() for tx in txs
+            if tx['token_type'] == 'TRC20' and not tx['token_resolved']
+        ]
+        if unresolved:
+            await token_registry.resolve(api, {tx['token_address'] for tx in unresolved})
+            for tx in unresolved:
+                apply_token_meta(tx)
+
+    if scan_state.get('block_cursor') != cursor:
+        scan_state['block_cursor'] = cursor
+        save_state()
+
+    logger.info(f"Блоки TRON до #{cursor}: совпадений для {len(found)} кошельков (head #{head})")
+    return found
+
+
+# ==================== СОБЫТИЯ TRC-20 ====================
+def event_address_to_hex(addr: str) -> str:
+    """Адрес из результата события (0x..., 41... или base58) -> hex 41..."""
+    if addr.startswith('0x'):
+        return '41' + addr[2:].lower()
+    if addr.startswith('41') and len(addr) == 42:
+        return addr.lower()
+    return address_to_hex(addr)
+
+
+def process_trc20_event(event: dict, contract: str, index: dict) -> List[Tuple[str, dict]]:
+    """Событие Transfer -> записи в формате process_trc20_transaction для отслеживаемых адресов"""
+    try:
+        result = event.get('result', {})
+        from_hex = event_address_to_hex(result.get('from', ''))
+        to_hex = event_address_to_hex(result.get('to', ''))
+        if from_hex not in index and to_hex not in index:
+            return []
+
+        raw_value = int(result.get('value', 0))
+        meta = token_registry.get(contract)
+        symbol, decimals = meta if meta else ('TOKEN', 6)
+        tx = {
+            'hash': event.get('transaction_id', ''),
+            'from': hex_to_address(from_hex),
+            'to': hex_to_address(to_hex),
+            'value': raw_value / (10 ** decimals),
+            'block': event.get('block_number', 0),
+            'timestamp': event.get('block_timestamp', 0),
+            'token': symbol,
+            'token_type': 'TRC20',
+            'token_address': contract,
+            'raw_value': raw_value,
+            'token_resolved': meta is not None
+        }
+    except Exception as e:
+        logger.error(f"Ошибка обработки события TRC-20: {e}")
+        return []
+
+    return [
+        (index[addr_hex], dict(tx, type=side))
+        for side, addr_hex in (('out', from_hex), ('in', to_hex))
+        if addr_hex in index
+    ]
+
+
+async def scan_trc20_events() -> dict:
+    """
+    Прочитать новые события Transfer whitelisted контрактов и сопоставить с кошельками.
+
+    Курсор на контракт: (min_block_timestamp, fingerprint). Если страниц больше
+    MAX_EVENT_PAGES, fingerprint сохраняется и чтение продолжается в следующем цикле.
+
+    Returns:
+        {адрес: [транзакции]}
+    """
+    index = build_watch_index()
+    if not index:
+        return {}
+
+    found = {}
+    cursors = scan_state.setdefault('event_cursors', {})
+    now_ms = int(time.time() * 1000)
+
+    async with TronAPI() as api:
+        for contract in TRC20_EVENT_CONTRACTS:
+            since, fingerprint = cursors.get(contract, (now_ms, None))
+            latest = since - 1
+
+            async for page, fingerprint in api.iter_contract_events(contract, since, fingerprint, MAX_EVENT_PAGES):
+                with timers.stage('match'):
+                    for event in page:
+                        latest = max(latest, event.get('block_timestamp', 0))
+                        for address, tx in process_trc20_event(event, contract, index):
+                            found.setdefault(address, []).append(tx)
+
+            # Без fingerprint все события до latest прочитаны - следующий запрос после них
+            cursors[contract] = (since, fingerprint) if fingerprint else (latest + 1, None)
+
+        unresolved = [tx for txs in found.values() for tx in txs if not tx['token_resolved']]
+        if unresolved:
+            await token_registry.resolve(api, {tx['token_address'] for tx in unresolved})
+            for tx in unresolved:
+                apply_token_meta(tx)
+
+    save_state()
+    return found
+
+
+# ==================== ИМПОРТ / ЭКСПОРТ ====================
+def parse_import_document(text: str) -> Tuple[List[Tuple[int, str]], List[Tuple[int, str, str]]]:
+    """
+    Разобрать документ со строками `адрес` или `tron,адрес`.
+
+    Returns:
+        (принятые [(номер строки, адрес)], отклоненные [(номер строки, строка, причина)])
+    """
+    accepted = []
+    rejected = []
+    seen = set()
+
+    for line_no, raw in enumerate(text.splitlines(), start=1):
+        line = raw.strip()
+        if not line or line.startswith('#'):
+            continue
+
+        parts = [p.strip() for p in line.replace(';', ',').replace('\t', ',').split(',') if p.strip()]
+        if len(parts) == 1 and ' ' in line:
+            parts = line.split()
+
+        # Лишние колонки (файл из /export) игнорируются
+        if len(parts) >= 2:
+            if line_no == 1 and parts[0].lower() == 'chain':
+                continue  # заголовок CSV
+            if parts[0].lower() not in ('tron', 'trx'):
+                rejected.append((line_no, line, "неподдерживаемая цепь"))
+                continue
+            address = parts[1]
+        elif len(parts) == 1:
+            if line_no == 1 and parts[0].lower() == 'address':
+                continue
+            address = parts[0]
+        else:
+            rejected.append((line_no, line, "ожидается `tron,адрес`"))
+            continue
+
+        valid, err = validate_tron_address(address)
+        if not valid:
+            rejected.append((line_no, line, err))
+            continue
+        if address in seen:
+            rejected.append((line_no, line, "повтор в файле"))
+            continue
+
+        seen.add(address)
+        accepted.append((line_no, address))
+
+    return accepted, rejected
+
+
+def export_wallets_csv(chat_id: int) -> bytes:
+    """CSV со всеми подписками чата"""
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(['chain', 'address', 'last_timestamp', 'notify_incoming', 'notify_outgoing'])
+    for addr, data in get_all_wallets(chat_id):
+        writer.writerow([
+            'tron', addr, data.get('last_timestamp', 0),
+            int(data.get('notify_incoming', True)), int(data.get('notify_outgoing', True))
+        ])
+    return buf.getvalue().encode('utf-8')
+
+
+EXPORT_COLUMNS = ['time_utc', 'chain', 'address', 'type', 'counterparty', 'value', 'token', 'hash', 'block', 'failed']
+
+
+async def export_rows(chain: str, address: str, since_ms: int, until_ms: int):
+    """Async-генератор строк CSV из архива транзакций"""
+    async for timestamp, tx_hash, tx_type, block, counterparty, value, token, failed in \
+            tx_history.iter_range(chain, address, since_ms, until_ms):
+        when = datetime.fromtimestamp(timestamp / 1000, timezone.utc).strftime('%Y-%m-%d %H:%M:%S') if timestamp else ''
+        yield [when, chain, address, tx_type, counterparty, repr(value), token, tx_hash, block, failed]
+
+
+async def export_documents(rows, basename: str):
+    """
+    Записать строки в gzip-CSV во временные файлы.
+
+    Async-генератор путей готовых частей: часть закрывается, как только сжатый
+    размер доходит до EXPORT_PART_BYTES, поэтому в памяти - только буферы
+    сжатия, сколько бы ни было строк. Удалять файлы - забота вызывающего.
+    """
+    part = 0
+    raw = text = writer = path = None
+    async for row in rows:
+        if text is None:
+            part += 1
+            fd, path = tempfile.mkstemp(prefix=f"{basename}_{part}_", suffix=".csv.gz")
+            raw = os.fdopen(fd, 'wb')
+            text = io.TextIOWrapper(gzip.GzipFile(fileobj=raw, mode='wb'), encoding='utf-8', newline='')
+            writer = csv.writer(text)
+            writer.writerow(EXPORT_COLUMNS)
+
+        writer.writerow(row)
+        if raw.tell() >= EXPORT_PART_BYTES:
+            text.close()
+            raw.close()
+            text = None
+            yield path
+
+    if text is not None:
+        text.close()
+        raw.close()
+        yield path
+
+
+async def backfill_history(address: str, since_ms: int, until_ms: int) -> Tuple[int, bool]:
+    """
+    Дозаполнить архив транзакциями кошелька за период из TronGrid.
+
+    Страницы читаются от until_ms к прошлому, не больше EXPORT_BACKFILL_PAGES
+    на поток - выгрузка не должна съедать бюджет API; уже известные транзакции
+    архив пропускает.
+
+    Returns:
+        (добавлено записей, обрезан ли период - самые ранние транзакции не загружены)
+    """
+    watch_hex = address_to_hex(address)
+    added = 0
+    truncated = False
+    async with TronAPI() as api:
+        for trc20, process in ((False, process_trx_transaction), (True, process_trc20_transaction)):
+            pages = api.iter_account_transactions(
+                address, since_ms, max_pages=EXPORT_BACKFILL_PAGES, trc20=trc20, max_timestamp=until_ms,
+                newest_first=True
+            )
+            fingerprint = None
+            async for page, fingerprint in pages:
+                txs = [tx for tx in (process(raw, address, watch_hex) for raw in page) if tx]
+                tx_history.add('tron', address, txs)
+                added += len(txs)
+            # Остался курсор - бюджет страниц кончился (или запрос не удался) раньше начала периода
+            truncated = truncated or fingerprint is not None
+    logger.info(f"Архив {format_address(address)}: дозаполнено {added} транзакций{', период обрезан' if truncated else ''}")
+    return added, truncated
+
+
+def parse_export_date(value: str, end_of_day: bool = False) -> int:
+    """YYYY-MM-DD (UTC) -> миллисекунды; для конца периода - последняя миллисекунда дня"""
+    day = datetime.strptime(value, '%Y-%m-%d').replace(tzinfo=timezone.utc)
+    return int(day.timestamp() * 1000) + (86400 * 1000 - 1 if end_of_day else 0)
+
+
 # ==================== ФОРМАТИРОВАНИЕ СООБЩЕНИЙ ====================
 def format_tx_message(tx: dict, address: str) -> str:
     addr_short = format_address(address)
@@ -373,6 +1924,10 @@ async def start(message: Message):
         "/list - Показать кошельки\n"
         "/remove <номер> - Удалить кошелек\n"
         "/filter <номер> - Фильтр уведомлений (входящие/исходящие)\n"
+        "/import - Импорт кошельков из файла\n"
+        "/export - Экспорт кошельков в файл\n"
+        "/history <номер> - История транзакций кошелька\n"
+        "/export_txs <номер> [с] [по] - Выгрузка транзакций в CSV\n"
         "/help - Показать помощь"
     )
 
@@ -406,12 +1961,7 @@ async def track(message: Message):
 
     current_timestamp = int(time.time() * 1000)
 
-    user_subs[chat_id][address] = {
-        'last_timestamp': current_timestamp,
-        'added_at': time.time(),
-        'notify_incoming': True,
-        'notify_outgoing': True,
-    }
+    user_subs[chat_id][address] = make_wallet_data(address, current_timestamp)
     save_data()
 
     await message.reply(
@@ -481,8 +2031,9 @@ async def filter_wallet(message: Message):
 
     if not args:
         await message.reply(
-            "Использование: /filter <номер>\n"
+            "Использование: /filter <номер> [min|tokens|allow|deny|unlist|reset ...]\n"
             "Пример: /filter 1\n"
+            "Пример: /filter 1 min USDT 100\n"
             "Используйте /list для просмотра номеров кошельков"
         )
         return
@@ -501,27 +2052,201 @@ async def filter_wallet(message: Message):
         return
 
     addr, data = wallets[idx]
-    addr_short = format_address(addr)
 
-    notify_incoming = data.get('notify_incoming', True)
-    notify_outgoing = data.get('notify_outgoing', True)
+    if len(args) > 1:
+        ok, result = apply_filter_command(data, args[1].lower(), args[2:])
+        if not ok:
+            await message.reply(f"❌ {result}")
+            return
+        save_data()
+        await message.reply(f"✅ {result}")
 
-    in_icon = "✅" if notify_incoming else "❌"
-    out_icon = "✅" if notify_outgoing else "❌"
+    text, keyboard = filter_settings_view(idx, addr, data)
+    await message.reply(text, parse_mode='Markdown', reply_markup=keyboard)
 
-    keyboard = get_inline_keyboard([
-        (f"📥 Входящие {in_icon}", f"toggle_in_{idx}"),
-        (f"📤 Исходящие {out_icon}", f"toggle_out_{idx}"),
-    ], row_width=2)
 
-    await message.reply(
-        f"⚙️ *Настройки уведомлений*\n"
-        f"Кошелек #{idx + 1}: 🔴 TRON `{addr_short}`\n\n"
-        f"📥 Входящие транзакции: {in_icon}\n"
-        f"📤 Исходящие транзакции: {out_icon}",
-        parse_mode='Markdown',
-        reply_markup=keyboard
+@dp.message(Command("import"))
+async def import_wallets(message: Message):
+    document = message.document
+    if not document and message.reply_to_message:
+        document = message.reply_to_message.document
+
+    if not document:
+        await message.reply(
+            "Использование: отправьте CSV/TXT файл с подписью /import\n"
+            "или ответьте /import на сообщение с файлом.\n\n"
+            "Формат строк: `адрес` или `tron,адрес`\n"
+            "Пример: `tron,T...`",
+            parse_mode='Markdown'
+        )
+        return
+
+    if document.file_size and document.file_size > IMPORT_MAX_BYTES:
+        await message.reply(f"❌ Файл слишком большой (максимум {IMPORT_MAX_BYTES // 1024} КБ)")
+        return
+
+    try:
+        content = await bot.download(document)
+        text = content.read().decode('utf-8-sig', errors='replace')
+    except Exception as e:
+        logger.error(f"Ошибка загрузки файла импорта: {e}")
+        await message.reply("❌ Не удалось загрузить файл")
+        return
+
+    accepted, rejected = parse_import_document(text)
+    if len(accepted) + len(rejected) > IMPORT_MAX_LINES:
+        await message.reply(f"❌ Слишком много строк (максимум {IMPORT_MAX_LINES})")
+        return
+
+    chat_id = message.chat.id
+    if chat_id not in user_subs:
+        user_subs[chat_id] = {}
+
+    new_wallets = []
+    for line_no, address in accepted:
+        if address in user_subs[chat_id]:
+            rejected.append((line_no, address, "уже отслеживается"))
+        else:
+            new_wallets.append(address)
+
+    current_timestamp = int(time.time() * 1000)
+    for address in new_wallets:
+        user_subs[chat_id][address] = make_wallet_data(address, current_timestamp)
+    if new_wallets:
+        save_data()
+
+    logger.info(f"Импорт в чат {chat_id}: {len(new_wallets)} добавлено, {len(rejected)} отклонено")
+
+    msg = (
+        f"📥 *Импорт завершен*\n"
+        f"✅ Добавлено: {len(new_wallets)}\n"
+        f"❌ Отклонено: {len(rejected)}"
     )
+    if rejected:
+        rejected.sort()
+        msg += "\n\n" + "\n".join(f"Строка {n}: {reason}" for n, _, reason in rejected[:10])
+        if len(rejected) > 10:
+            msg += f"\n... и еще {len(rejected) - 10}"
+    await message.reply(msg, parse_mode='Markdown')
+
+
+@dp.message(Command("export"))
+async def export_wallets(message: Message):
+    chat_id = message.chat.id
+    if not get_all_wallets(chat_id):
+        await message.reply("📭 Нет отслеживаемых кошельков. Используйте /track для добавления.")
+        return
+
+    document = BufferedInputFile(export_wallets_csv(chat_id), filename="tron_wallets.csv")
+    await message.reply_document(document, caption="📤 Экспорт кошельков")
+
+
+@dp.message(Command("history"))
+async def history(message: Message):
+    args = message.text.split()[1:]
+    if not args:
+        await message.reply(
+            "Использование: /history <номер> [страница]\n"
+            "Используйте /list для просмотра номеров кошельков"
+        )
+        return
+
+    try:
+        idx = int(args[0]) - 1
+        page = int(args[1]) - 1 if len(args) > 1 else 0
+    except ValueError:
+        await message.reply("❌ Неверный номер. Используйте /list для просмотра номеров")
+        return
+
+    wallets = get_all_wallets(message.chat.id)
+    if idx < 0 or idx >= len(wallets) or page < 0:
+        await message.reply("❌ Неверный номер")
+        return
+
+    addr, data = wallets[idx]
+    text, keyboard = history_view(idx, addr, page)
+    await message.reply(text, parse_mode='Markdown', reply_markup=keyboard, disable_web_page_preview=True)
+
+
+@dp.message(Command("export_txs"))
+async def export_txs(message: Message):
+    args = message.text.split()[1:]
+    if not args:
+        await message.reply(
+            "Использование: /export_txs <номер> [с YYYY-MM-DD] [по YYYY-MM-DD]\n"
+            "Пример: /export_txs 1 2024-01-01 2024-12-31\n"
+            "Используйте /list для просмотра номеров кошельков"
+        )
+        return
+
+    try:
+        idx = int(args[0]) - 1
+        since_ms = parse_export_date(args[1]) if len(args) > 1 else 0
+        until_ms = parse_export_date(args[2], end_of_day=True) if len(args) > 2 else int(time.time() * 1000)
+    except ValueError:
+        await message.reply("❌ Неверный номер или дата (формат YYYY-MM-DD)")
+        return
+
+    wallets = get_all_wallets(message.chat.id)
+    if idx < 0 or idx >= len(wallets):
+        await message.reply("❌ Неверный номер")
+        return
+
+    addr, data = wallets[idx]
+    await message.reply("⏳ Готовлю выгрузку...")
+    sent = 0
+    # Дозаполненные записи старше срока хранения не должны удалиться сжатием до выгрузки
+    tx_history.holds += 1
+    try:
+        _, truncated = await backfill_history(addr, since_ms, until_ms)
+        async for path in export_documents(export_rows('tron', addr, since_ms, until_ms), f"tron_{addr[-8:]}"):
+            sent += 1
+            try:
+                await message.reply_document(
+                    FSInputFile(path, filename=f"tron_{addr}_{sent}.csv.gz"),
+                    caption=f"📤 Транзакции `{format_address(addr)}`, часть {sent}",
+                    parse_mode='Markdown'
+                )
+            except Exception as e:
+                logger.error(f"Ошибка отправки выгрузки в чат {message.chat.id}: {e}")
+            finally:
+                os.remove(path)
+    finally:
+        tx_history.holds -= 1
+
+    if not sent:
+        await message.reply("📭 За этот период транзакций в архиве нет")
+    if truncated:
+        await message.reply(
+            f"⚠️ Из TronGrid загружены только последние {EXPORT_BACKFILL_PAGES} страниц каждого потока: "
+            f"более ранние транзакции периода в выгрузку не попали. Сузьте период, чтобы получить их."
+        )
+
+
+@dp.message(Command("profile"))
+async def profile(message: Message):
+    """Профилировать живой процесс N секунд (только для ADMIN_IDS)"""
+    if not message.from_user or message.from_user.id not in ADMIN_IDS:
+        return
+
+    parts = message.text.split()
+    try:
+        seconds = int(parts[1]) if len(parts) > 1 else 30
+    except ValueError:
+        await message.reply("❌ Использование: /profile [секунды]")
+        return
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+
+    if profile_lock.locked():
+        await message.reply("⏳ Профилирование уже идет")
+        return
+
+    async with profile_lock:
+        await message.reply(f"⏱ Профилирование {seconds}с...")
+        summary, report = await profile_process(seconds)
+
+    await message.reply(summary, parse_mode='Markdown')
+    await message.reply_document(BufferedInputFile(report.encode(), filename="profile.txt"))
 
 
 @dp.callback_query()
@@ -570,7 +2295,6 @@ async def button_handler(callback: CallbackQuery):
 
         if idx < len(wallets):
             addr, data = wallets[idx]
-            addr_short = format_address(addr)
 
             if direction == 'in':
                 data['notify_incoming'] = not data.get('notify_incoming', True)
@@ -579,92 +2303,298 @@ async def button_handler(callback: CallbackQuery):
 
             save_data()
 
-            notify_incoming = data.get('notify_incoming', True)
-            notify_outgoing = data.get('notify_outgoing', True)
-            in_icon = "✅" if notify_incoming else "❌"
-            out_icon = "✅" if notify_outgoing else "❌"
+            text, keyboard = filter_settings_view(idx, addr, data)
+            await callback.message.edit_text(text, parse_mode='Markdown', reply_markup=keyboard)
+
+    elif callback.data.startswith("filter_reset_"):
+        idx = int(callback.data.split("_")[2])
+        chat_id = callback.message.chat.id
+        wallets = get_all_wallets(chat_id)
+
+        if idx < len(wallets):
+            addr, data = wallets[idx]
+            apply_filter_command(data, 'reset', [])
+            save_data()
 
-            keyboard = get_inline_keyboard([
-                (f"📥 Входящие {in_icon}", f"toggle_in_{idx}"),
-                (f"📤 Исходящие {out_icon}", f"toggle_out_{idx}"),
-            ], row_width=2)
+            text, keyboard = filter_settings_view(idx, addr, data)
+            await callback.message.edit_text(text, parse_mode='Markdown', reply_markup=keyboard)
 
+    elif callback.data.startswith("history_"):
+        _, idx, page = callback.data.split("_")
+        idx, page = int(idx), int(page)
+        wallets = get_all_wallets(callback.message.chat.id)
+
+        if idx < len(wallets):
+            addr, data = wallets[idx]
+            text, keyboard = history_view(idx, addr, page)
             await callback.message.edit_text(
-                f"⚙️ *Настройки уведомлений*\n"
-                f"Кошелек #{idx + 1}: 🔴 TRON `{addr_short}`\n\n"
-                f"📥 Входящие транзакции: {in_icon}\n"
-                f"📤 Исходящие транзакции: {out_icon}",
-                parse_mode='Markdown',
-                reply_markup=keyboard
+                text, parse_mode='Markdown', reply_markup=keyboard, disable_web_page_preview=True
             )
 
 
 # ==================== ФОНОВАЯ ЗАДАЧА ====================
+async def notify_chat(chat_id: int, address: str, txs: List[dict]):
+    """Отправить уведомления (максимум 5 последних)"""
+    for tx in txs[-5:]:
+        msg = format_tx_message(tx, address)
+        try:
+            with timers.stage('deliver'):
+                await bot.send_message(
+                    chat_id=chat_id,
+                    text=msg,
+                    parse_mode='Markdown',
+                    disable_web_page_preview=True
+                )
+            logger.info(
+                f"Уведомление: {tx['type']} {tx['value']} {tx.get('token', 'TRX')}")
+            await asyncio.sleep(0.5)
+        except Exception as e:
+            logger.error(f"Ошибка отправки: {e}")
+
+
+def poll_concurrency() -> int:
+    """Сколько кошельков опрашивать одновременно: из настройки или по бюджету API"""
+    if TRON_POLL_CONCURRENCY > 0:
+        return TRON_POLL_CONCURRENCY
+    # Кошелек - это минимум 2 запроса, ответ ~1 с: держим в работе примерно бюджет запросов в секунду
+    return max(2, int(api_rate_budget()))
+
+
+def build_subscribers() -> dict:
+    """Подписки по адресам: адрес -> [(chat_id, данные кошелька)]"""
+    subscribers = {}
+    for chat_id, wallets in list(user_subs.items()):
+        for address, data in list(wallets.items()):
+            subscribers.setdefault(address, []).append((chat_id, data))
+    return subscribers
+
+
+def address_cursors(address: str, subs: List[Tuple[int, dict]]) -> dict:
+    """Курсоры потоков адреса - общие для всех чатов, которые его отслеживают"""
+    all_cursors = scan_state.setdefault('address_cursors', {})
+    if address not in all_cursors:
+        # Переход со старого формата, где курсоры хранились в каждом кошельке
+        legacy = next((data['cursors'] for _, data in subs if data.get('cursors')), None)
+        all_cursors[address] = dict(legacy) if legacy else {}
+    return all_cursors[address]
+
+
+async def poll_address(api: TronAPI, semaphore: asyncio.Semaphore, address: str,
+                       subs: List[Tuple[int, dict]]) -> Tuple[str, Optional[List[dict]], dict]:
+    """
+    Опросить один адрес: (адрес, транзакции или None при ошибке, новые курсоры).
+
+    Курсоры читаются из копии: сохранять их вызывающий должен только после
+    того, как транзакции розданы.
+    """
+    async with semaphore:
+        cursors = dict(address_cursors(address, subs))
+        default_since = min(data.get('last_timestamp', 0) for _, data in subs) + 1
+
+        try:
+            txs = await get_new_transactions(
+                api, address, cursors, default_since,
+                include_trc20=TRON_TRC20_MODE != 'events'
+            )
+        except Exception as e:
+            logger.error(f"Ошибка проверки {format_address(address)}: {e}")
+            txs = None
+
+        return address, txs, cursors
+
+
+async def poll_accounts(subscribers: dict) -> bool:
+    """
+    Режим 'account': запросы к TronGrid по каждому уникальному адресу.
+
+    Адрес, который отслеживают несколько чатов, опрашивается один раз с одним
+    курсором, результат раздается всем подписчикам через dispatch_matches.
+    Опрашиваются только адреса, которым подошла очередь в scheduler.
+    Адреса опрашиваются параллельно (не больше poll_concurrency() одновременно),
+    результаты обрабатываются по мере готовности.
+
+    Returns:
+        изменились ли данные кошельков
+    """
+    scheduler.sync(set(subscribers), time.monotonic())
+    due = scheduler.pop_due(time.monotonic())
+    hot, cold = scheduler.stats()
+    logger.info(f"К опросу {len(due)} из {len(subscribers)} адресов (активных {hot}, спящих {cold})")
+
+    semaphore = asyncio.Semaphore(poll_concurrency())
+    changed = False
+    cursors_changed = False
+
+    # pop_due уже убрал адреса из очереди: все, что не перепланировано, вернуть в finally
+    unscheduled = set(due)
+    try:
+        async with TronAPI() as api:
+            tasks = [poll_address(api, semaphore, address, subscribers[address]) for address in due]
+
+            for next_done in asyncio.as_completed(tasks):
+                address, txs, cursors = await next_done
+                if txs is None:
+                    scheduler.retry(address, time.monotonic())
+                    unscheduled.discard(address)
+                    continue
+
+                if txs:
+                    changed = await dispatch_matches({address: txs}, subscribers) or changed
+                # Курсор сдвигается только после раздачи: при сбое транзакции перечитаются
+                all_cursors = scan_state.setdefault('address_cursors', {})
+                if all_cursors.get(address) != cursors:
+                    all_cursors[address] = cursors
+                    cursors_changed = True
+                scheduler.record(address, bool(txs), time.monotonic())
+                unscheduled.discard(address)
+    finally:
+        for address in unscheduled:
+            scheduler.retry(address, time.monotonic())
+
+        # Курсоры адресов, которые больше никто не отслеживает
+        all_cursors = scan_state.get('address_cursors', {})
+        for address in [a for a in all_cursors if a not in subscribers]:
+            del all_cursors[address]
+            cursors_changed = True
+
+        if cursors_changed:
+            save_state()
+    return changed
+
+
+async def dispatch_matches(found: dict, subscribers: dict, advance_cursor: bool = True) -> bool:
+    """
+    Раздать найденные транзакции всем чатам, подписанным на адрес.
+
+    Повторы исключают курсор сканера и кэш дедупликации, поэтому для чата
+    отсекается только история до момента подписки; фильтры (compile_tx_filter)
+    у каждого чата свои. advance_cursor - сдвигать ли last_timestamp кошелька
+    (в режиме 'events' его ведет опрос TRX).
+
+    Returns:
+        изменились ли данные кошельков
+    """
+    changed = False
+    for address, txs in found.items():
+        fresh = []
+        for tx in txs:
+            if not cache.is_tx_processed(address, tx['hash']):
+                cache.mark_tx_processed(address, tx['hash'])
+                fresh.append(tx)
+        if not fresh:
+            continue
+        tx_history.add('tron', address, fresh)
+
+        for chat_id, data in subscribers.get(address, []):
+            added_ms = int(data.get('added_at', 0) * 1000)
+            new_txs = [tx for tx in fresh if tx['timestamp'] > added_ms]
+            if not new_txs:
+                continue
+
+            if advance_cursor:
+                data['last_timestamp'] = max(data.get('last_timestamp', 0), max(tx['timestamp'] for tx in new_txs))
+                changed = True
+
+            predicate = compile_tx_filter(data)
+            new_txs = [tx for tx in new_txs if predicate(tx)]
+            if new_txs:
+                await notify_chat(chat_id, address, new_txs)
+
+    return changed
+
+
 async def check_transactions():
     """Фоновая задача для проверки транзакций"""
     while True:
         try:
-            total_wallets = sum(len(w) for w in user_subs.values())
-            logger.info(f"🔍 Проверка {total_wallets} TRON кошельков...")
-
-            for chat_id, wallets in list(user_subs.items()):
-                for address, data in list(wallets.items()):
-                    last_timestamp = data.get('last_timestamp', 0)
-
-                    try:
-                        txs = await get_new_transactions(address, last_timestamp)
-
-                        if txs:
-                            new_timestamp = max(tx['timestamp'] for tx in txs)
-                            data['last_timestamp'] = new_timestamp
-                            save_data()
-
-                            notify_incoming = data.get('notify_incoming', True)
-                            notify_outgoing = data.get('notify_outgoing', True)
-
-                            filtered_txs = [
-                                tx for tx in txs
-                                if (tx['type'] == 'in' and notify_incoming) or
-                                   (tx['type'] == 'out' and notify_outgoing)
-                            ]
-
-                            # Отправляем уведомления (максимум 5 последних)
-                            for tx in filtered_txs[-5:]:
-                                msg = format_tx_message(tx, address)
-                                try:
-                                    await bot.send_message(
-                                        chat_id=chat_id,
-                                        text=msg,
-                                        parse_mode='Markdown',
-                                        disable_web_page_preview=True
-                                    )
-                                    logger.info(
-                                        f"Уведомление: {tx['type']} {tx['value']} {tx.get('token', 'TRX')}")
-                                    await asyncio.sleep(0.5)
-                                except Exception as e:
-                                    logger.error(f"Ошибка отправки: {e}")
-
-                    except Exception as e:
-                        logger.error(f"Ошибка проверки {format_address(address)}: {e}")
-
-                    await asyncio.sleep(0.5)
+            subscribers = build_subscribers()
+            total_wallets = sum(len(subs) for subs in subscribers.values())
+            logger.info(
+                f"🔍 Проверка {total_wallets} TRON кошельков, {len(subscribers)} уникальных адресов "
+                f"({TRON_SCAN_MODE})..."
+            )
+
+            changed = False
+            if TRON_SCAN_MODE == 'block':
+                changed = await dispatch_matches(await scan_blocks(), subscribers)
+            else:
+                if TRON_TRC20_MODE == 'events':
+                    found = await scan_trc20_events()
+                    for address in found:
+                        scheduler.wake(address, time.monotonic())
+                    await dispatch_matches(found, subscribers, advance_cursor=False)
+                changed = await poll_accounts(subscribers)
+
+            if changed:
+                save_data()
+            cache.save(set(subscribers))
 
         except Exception as e:
             logger.error(f"Ошибка в фоновой задаче: {e}")
 
+        log_cycle_stats()
         await asyncio.sleep(CHECK_INTERVAL)
 
 
+# ==================== ВЕБХУК ====================
+def build_webhook_app() -> web.Application:
+    """
+    aiohttp-приложение с обработчиком вебхука на WEBHOOK_PATH.
+
+    Запросы без верного секрета получают 401. Для локальной проверки достаточно
+    поднять приложение и отправить POST с JSON апдейта и заголовком секрета.
+    """
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+async def run_webhook():
+    """Поднять сервер вебхука и, если задан WEBHOOK_BASE_URL, зарегистрировать его в Telegram"""
+    if not WEBHOOK_SECRET:
+        raise RuntimeError("Для BOT_MODE=webhook нужен WEBHOOK_SECRET")
+
+    runner = web.AppRunner(build_webhook_app())
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    logger.info(f"Вебхук слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+    if WEBHOOK_BASE_URL:
+        await bot.set_webhook(f"{WEBHOOK_BASE_URL}{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET)
+        logger.info(f"Вебхук зарегистрирован: {WEBHOOK_BASE_URL}{WEBHOOK_PATH}")
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
 # ==================== ЗАПУСК ====================
 async def main():
     load_data()
+    load_state()
+    cache.load()
+    token_registry.load()
+    tx_history.open()
 
     asyncio.create_task(check_transactions())
+    asyncio.create_task(compact_history())
+    if PROFILING:
+        asyncio.create_task(loop_lag.run())
 
     logger.info("🔴 TRON Бот запущен!")
+    logger.info(
+        f"TronGrid: {len(TRON_API_ENDPOINTS)} endpoint(ов), {len(TRON_API_KEYS)} API-ключей, "
+        f"бюджет {api_rate_budget():.0f} запр/с"
+    )
 
-    # Запускаем поллинг
-    await dp.start_polling(bot)
+    if BOT_MODE == 'webhook':
+        await run_webhook()
+    else:
+        # Запускаем поллинг; вебхук, оставшийся от другого режима, мешает getUpdates
+        await bot.delete_webhook()
+        await dp.start_polling(bot)
 
 
 if __name__ == "__main__":